@@ -9,7 +9,7 @@ Example Usage:
       --cpp_bin_dir /data/faiss-cpu-profiling/build/demos/bigann_search \
       --index_parent_dir /data/Faiss_experiments/trained_CPU_indexes/ \
       --gt_parent_dir /data/Faiss_experiments/bigann/gnd/ \
-      --nprobe_dict_dir '../recall_info/cpu_recall_index_nprobe_pairs_SIFT1000M.pkl' --perf_enable 1
+      --nprobe_dict_dir '../recall_info/cpu_recall_index_nprobe_pairs_SIFT1000M.json' --perf_enable 1
 """
 
 from __future__ import print_function
@@ -17,19 +17,24 @@ import os
 import sys
 import time
 import re
-import pickle
 import getpass
 import argparse 
+
+import faiss
+from faiss.contrib.ivf_tools import NprobeSolver, load_nprobe_table, save_nprobe_table
+from faiss.contrib.vecs_io import bvecs_mmap, ivecs_read
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--dbname', type=str, default='SIFT1000M', help="dataset name, e.g., SIFT100M")
 parser.add_argument('--topK', type=int, default=10, help="return topK most similar vector, related to recall, e.g., R@10=50perc or R@100=80perc")
 parser.add_argument('--recall_goal', type=float, default=0.8, help="recall goal 0~1")
-parser.add_argument('--qbs', type=int, default=10000, help="batch size")
+parser.add_argument('--qbs', type=int, default=10000, help="query batch size of each search call, e.g., 1 for the latency of single queries")
 parser.add_argument('--repeat_time', type=int, default=1, help="repeat_time of the 10000 queries, higher repeat time typically has a better stability")
 parser.add_argument('--cpp_bin_dir', type=str, default='/data/faiss-cpu-profiling/build/demos/bigann_search', help="c++ search binary")
 parser.add_argument('--index_parent_dir', type=str, default='/data/Faiss_experiments/trained_CPU_indexes/', help="parent directory of index storage")
 parser.add_argument('--gt_parent_dir', type=str, default='/data/Faiss_experiments/bigann/gnd/', help="parent directory of ground truth")
-parser.add_argument('--nprobe_dict_dir', type=str, default='../recall_info/cpu_recall_index_nprobe_pairs_SIFT1000M.pkl', help="recall dictionary, stores the min nprobe to achieve certain recall")
+parser.add_argument('--nprobe_dict_dir', type=str, default='../recall_info/cpu_recall_index_nprobe_pairs_SIFT1000M.json', help="recall table, stores the min nprobe to achieve certain recall, missing entries are solved and added")
+parser.add_argument('--query_dir', type=str, default='/data/Faiss_experiments/bigann/bigann_query.bvecs', help="queries, used to solve the missing entries of the recall table")
 
 parser.add_argument('--perf_enable', type=int, default=1, help="whether to profile by perf")
 
@@ -43,18 +48,32 @@ cpp_bin_dir = args.cpp_bin_dir
 index_parent_dir = args.index_parent_dir
 gt_parent_dir = args.gt_parent_dir
 nprobe_dict_dir = args.nprobe_dict_dir
+query_dir = args.query_dir
 perf_enable = args.perf_enable
 
-assert qbs == 10000, "Currently the c++ search program only support batch size = 10000"
 
-# dictionary format: d_nprobes[dbname][index_key][topK][recall_goal] = min_nprobe
-d_nprobes = None
+# table format: d_nprobes[dbname][index_key][topK][recall_goal] = min_nprobe
+d_nprobes = dict()
 if os.path.exists(nprobe_dict_dir):
-    with open(nprobe_dict_dir, 'rb') as f:
-        d_nprobes = pickle.load(f)
+    d_nprobes = load_nprobe_table(nprobe_dict_dir)
 else:
-    print("ERROR! input dictionary does not exists")
-    raise ValueError
+    print("WARNING: recall table {} does not exist, all the entries will be solved".format(nprobe_dict_dir))
+
+def get_min_nprobe(index_key, index_dir):
+    """
+    Look up the min nprobe to achieve the recall goal in the recall table, 
+        if missing, solve it on the populated index and cache it in the table
+    """
+    d_recall = d_nprobes.setdefault(dbname, dict()).setdefault(index_key, dict()).setdefault(topK, dict())
+    if recall_goal not in d_recall:
+        print("Solving the min nprobe of {} for R@{}={}".format(index_key, topK, recall_goal))
+        index = faiss.read_index(index_dir)
+        xq = bvecs_mmap(query_dir).astype('float32')
+        gt = ivecs_read(gt_dir)
+        solver = NprobeSolver(index, xq, gt, max_k=topK)
+        d_recall[recall_goal] = solver.min_nprobe(topK, recall_goal)
+        save_nprobe_table(nprobe_dict_dir, d_nprobes)
+    return d_recall[recall_goal]
 
 out_dir = "result_experiment_2_algorithm_settings"
 if not os.path.exists(out_dir):
@@ -65,6 +84,11 @@ logname = "./{out_dir}/out_{dbname}_R@{topK}={recall_goal}_qbs_{qbs}".format(
 if os.path.exists(logname):
     os.remove(logname)
 
+# one record per run, see load_search_results in plot_SIFT*/analyze_perf.py
+results_name = os.path.join(out_dir, 'results_' + os.path.basename(logname) + '.csv')
+if os.path.exists(results_name):
+    os.remove(results_name)
+
 gt_dir = None
 if dbname == 'SIFT1M':
     gt_dir = os.path.join(gt_parent_dir, 'idx_1M.ivecs')
@@ -83,22 +107,23 @@ index_keys = ['IVF1024,PQ16', 'IVF2048,PQ16', 'IVF4096,PQ16', 'IVF8192,PQ16', 'I
 
 for index_key in index_keys:
 
-    nprobe = d_nprobes[dbname][index_key][topK][recall_goal]
+    index_sub_dir = 'bench_cpu_{dbname}_{index_key}/{dbname}_{index_key}_populated.index'.format(dbname=dbname, index_key=index_key)
+    index_dir = os.path.join(index_parent_dir, index_sub_dir)
+
+    nprobe = get_min_nprobe(index_key, index_dir)
     if nprobe is None: 
         continue
     os.system('echo ==== {index_key} ==== >> {logname}'.format(index_key=index_key, logname=logname))
 
-    index_sub_dir = 'bench_cpu_{dbname}_{index_key}/{dbname}_{index_key}_populated.index'.format(dbname=dbname, index_key=index_key)
-    index_dir = os.path.join(index_parent_dir, index_sub_dir)
-    # Usage: ./binary index_dir gt_dir topK nprobe
-    cmd = "{cpp_bin_dir} {index_dir} {gt_dir} {topK} {nprobe} {repeat_time} >> {logname}".format(
-        cpp_bin_dir=cpp_bin_dir, index_dir=index_dir, gt_dir=gt_dir, topK=topK, nprobe=nprobe, repeat_time=repeat_time, logname=logname)
+    # Usage: ./binary index_dir gt_dir topK nprobe repeat_time qbs results_file index_key
+    cmd = "{cpp_bin_dir} {index_dir} {gt_dir} {topK} {nprobe} {repeat_time} {qbs} {results_name} {index_key} >> {logname}".format(
+        cpp_bin_dir=cpp_bin_dir, index_dir=index_dir, gt_dir=gt_dir, topK=topK, nprobe=nprobe, repeat_time=repeat_time, qbs=qbs, results_name=results_name, index_key=index_key, logname=logname)
 
     if not perf_enable:
         print(cmd)
         os.system(cmd)
     else:
-        cmd_prefix = "perf record -v -g -F 99 "
+        cmd_prefix = "perf record -v -g -F 99 -k CLOCK_MONOTONIC "
         cmd_prof = "sudo " + cmd_prefix + cmd
         print(cmd_prof)
         os.system(cmd_prof)
@@ -6,7 +6,7 @@ Example Usage:
           --cpp_bin_dir /data/faiss-cpu-profiling/build/demos/bigann_search \
           --index_parent_dir /data/Faiss_experiments/trained_CPU_indexes/ \
           --gt_parent_dir /data/Faiss_experiments/bigann/gnd/ \
-          --nprobe_dict_dir '../recall_info/cpu_recall_index_nprobe_pairs_SIFT1000M.pkl' --perf_enable 1
+          --nprobe_dict_dir '../recall_info/cpu_recall_index_nprobe_pairs_SIFT1000M.json' --perf_enable 1
 
 """
 
@@ -23,14 +23,15 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--dbname', type=str, default='SIFT1000M', help="dataset name, e.g., SIFT100M")
 parser.add_argument('--index_key', type=str, default='IVF4096,PQ16', help="index parameters, e.g., IVF4096,PQ16 or OPQ16,IVF4096,PQ16")
 parser.add_argument('--nprobe', type=int, default=16, help="number of cells to search in")
-parser.add_argument('--qbs', type=int, default=10000, help="batch size")
+parser.add_argument('--qbs', type=int, default=10000, help="query batch size of each search call, e.g., 1 for the latency of single queries")
 parser.add_argument('--repeat_time', type=int, default=1, help="repeat_time of the 10000 queries, higher repeat time typically has a better stability")
 parser.add_argument('--cpp_bin_dir', type=str, default='/data/faiss-cpu-profiling/build/demos/bigann_search', help="c++ search binary")
 parser.add_argument('--index_parent_dir', type=str, default='/data/Faiss_experiments/trained_CPU_indexes/', help="parent directory of index storage")
 parser.add_argument('--gt_parent_dir', type=str, default='/data/Faiss_experiments/bigann/gnd/', help="parent directory of ground truth")
-parser.add_argument('--nprobe_dict_dir', type=str, default='../recall_info/cpu_recall_index_nprobe_pairs_SIFT1000M.pkl', help="recall dictionary, stores the min nprobe to achieve certain recall")
+parser.add_argument('--nprobe_dict_dir', type=str, default='../recall_info/cpu_recall_index_nprobe_pairs_SIFT1000M.json', help="recall dictionary, stores the min nprobe to achieve certain recall")
 
 parser.add_argument('--perf_enable', type=int, default=1, help="whether to profile by perf")
+parser.add_argument('--sweep', type=int, default=1, help="whether to search all the topK in a single process, i.e., load the index once")
 
 args = parser.parse_args()
 dbname = args.dbname
@@ -43,8 +44,8 @@ index_parent_dir = args.index_parent_dir
 gt_parent_dir = args.gt_parent_dir
 nprobe_dict_dir = args.nprobe_dict_dir
 perf_enable = args.perf_enable
+sweep = args.sweep
 
-assert qbs == 10000, "Currently the c++ search program only support batch size = 10000"
 
 
 out_dir = "result_experiment_5_topK"
@@ -56,6 +57,11 @@ logname = "./{out_dir}/out_{dbname}_{index_key}_qbs_{qbs}".format(
 if os.path.exists(logname):
     os.remove(logname)
 
+# one record per run, see load_search_results in plot_SIFT*/analyze_perf.py
+results_name = os.path.join(out_dir, 'results_' + os.path.basename(logname) + '.csv')
+if os.path.exists(results_name):
+    os.remove(results_name)
+
 gt_dir = None
 if dbname == 'SIFT1M':
     gt_dir = os.path.join(gt_parent_dir, 'idx_1M.ivecs')
@@ -71,22 +77,31 @@ else:
 
 topK_list = [1, 10, 20, 50, 100, 200, 500, 1000]
 
-for topK in topK_list:
+# with sweep, a single launch of the binary searches all the topK (the index is loaded once),
+#   and prints the ==== topK=X ==== header of each run itself
+if sweep:
+    topK_runs = [topK_list]
+else:
+    topK_runs = [[topK] for topK in topK_list]
+
+for topK_run in topK_runs:
 
 
-    os.system('echo ==== topK={topK} ==== >> {logname}'.format(topK=topK, logname=logname))
+    if len(topK_run) == 1:
+        os.system('echo ==== topK={topK} ==== >> {logname}'.format(topK=topK_run[0], logname=logname))
+    topK_arg = ','.join([str(topK) for topK in topK_run])
 
     index_sub_dir = 'bench_cpu_{dbname}_{index_key}/{dbname}_{index_key}_populated.index'.format(dbname=dbname, index_key=index_key)
     index_dir = os.path.join(index_parent_dir, index_sub_dir)
-    # Usage: ./binary index_dir gt_dir topK nprobe
-    cmd = "{cpp_bin_dir} {index_dir} {gt_dir} {topK} {nprobe} {repeat_time} >> {logname}".format(
-        cpp_bin_dir=cpp_bin_dir, index_dir=index_dir, gt_dir=gt_dir, topK=topK, nprobe=nprobe, repeat_time=repeat_time, logname=logname)
+    # Usage: ./binary index_dir gt_dir topK nprobe repeat_time qbs results_file index_key (topK / nprobe can be comma-separated lists)
+    cmd = "{cpp_bin_dir} {index_dir} {gt_dir} {topK} {nprobe} {repeat_time} {qbs} {results_name} {index_key} >> {logname}".format(
+        cpp_bin_dir=cpp_bin_dir, index_dir=index_dir, gt_dir=gt_dir, topK=topK_arg, nprobe=nprobe, repeat_time=repeat_time, qbs=qbs, results_name=results_name, index_key=index_key, logname=logname)
 
     if not perf_enable:
         print(cmd)
         os.system(cmd)
     else:
-        cmd_prefix = "perf record -v -g -F 99 "
+        cmd_prefix = "perf record -v -g -F 99 -k CLOCK_MONOTONIC "
         cmd_prof = "sudo " + cmd_prefix + cmd
         print(cmd_prof)
         os.system(cmd_prof)
@@ -94,10 +109,20 @@ for topK in topK_list:
         # generate the perf.out, i.e., the trace of each sample
 
         reportname = "./{out_dir}/perf.out_{dbname}_{index_key}_K_{topK}_nprobe_{nprobe}_qbs_{qbs}".format(
-            out_dir=out_dir, dbname=dbname, index_key=index_key, topK=topK, nprobe=nprobe,qbs=qbs)
+            out_dir=out_dir, dbname=dbname, index_key=index_key, topK=topK_arg, nprobe=nprobe,qbs=qbs)
 
         cmd_stats = "sudo perf script > {reportname}".format(reportname=reportname)
         os.system(cmd_stats)
         username = getpass.getuser()
         os.system("sudo chown {username} {reportname}".format(username=username, reportname=reportname))
         os.system("sudo rm perf.data perf.data.old")
+
+        # the plotting scripts expect one trace per topK: in a sweep, the runs share
+        #   the trace (as symlinks), each run is located by its header in the log
+        if len(topK_run) > 1:
+            for topK in topK_run:
+                linkname = "./{out_dir}/perf.out_{dbname}_{index_key}_K_{topK}_nprobe_{nprobe}_qbs_{qbs}".format(
+                    out_dir=out_dir, dbname=dbname, index_key=index_key, topK=topK, nprobe=nprobe,qbs=qbs)
+                if os.path.lexists(linkname):
+                    os.remove(linkname)
+                os.symlink(os.path.basename(reportname), linkname)
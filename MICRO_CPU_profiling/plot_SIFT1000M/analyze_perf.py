@@ -5,9 +5,22 @@ Analyze the perf.out file generated by perf script > perf.out
 
 Example Usage:
     python analyze_perf.py --filename perf.out  --t_search_start 10.5 --t_search_end 20.3
+    python analyze_perf.py --filename perf.out  --logname out_SIFT100M_OPQ16,IVF65536,PQ16_qbs_10000 --run_name nprobe=16
 """
 
 import argparse 
+import array
+import collections
+import csv
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import re
+import shutil
+
+import numpy as np
 
 def group_perf_by_events(filedir):
 
@@ -74,6 +87,510 @@ def group_perf_by_events(filedir):
 
     return all_events
 
+
+class SymbolTable:
+    """
+    Intern the function names of the stack frames as dense integer ids,
+        such that a parsed event only keeps a tuple of small ints per frame
+        and every unique symbol is stored once per trace
+    """
+
+    def __init__(self):
+        self.names = [] # frame id -> function name
+        self.ids = dict() # function name -> frame id
+
+    def intern(self, name):
+        fid = self.ids.get(name)
+        if fid is None:
+            fid = len(self.names)
+            self.ids[name] = fid
+            self.names.append(name)
+        return fid
+
+    def __getitem__(self, fid):
+        return self.names[fid]
+
+    def __len__(self):
+        return len(self.names)
+
+
+"""
+A compact event (CPU sample):
+    tid: thread id
+    timestamp: time (in sec)
+    frames: tuple of interned frame ids, from the top of the stack to the bottom
+"""
+PerfEvent = collections.namedtuple('PerfEvent', ['tid', 'timestamp', 'frames'])
+
+
+def parse_event_header(line):
+    """
+    Return the thread ID & timestamp (in sec) from the first line of an event, e.g.,
+        demo_sift1M_rea  3100   945.398942:          1 cycles: 
+    """
+    fields = line.replace(":", "").split()
+    return int(fields[1]), float(fields[2])
+
+
+def iter_perf_events(filedir, symbols=None, byte_start=0, byte_end=None):
+    """
+    Streaming counterpart of group_perf_by_events: read the perf trace incrementally
+        and yield one PerfEvent per CPU sample, without keeping the trace in memory
+
+    (input) symbols: a SymbolTable, shared by the caller to decode the frame ids
+        (a new one is created if None)
+    (input) byte_start, byte_end: only parse the events in this byte range of the file,
+        both should be event boundaries (see split_perf_file)
+    """
+    if symbols is None:
+        symbols = SymbolTable()
+
+    # the same frame line is seen millions of times, only parse it once
+    frame_ids = dict()
+
+    header = None
+    frames = []
+    pos = byte_start
+    with open(filedir, 'rb') as file:
+        file.seek(byte_start)
+        for line in file:
+            if header is None and byte_end is not None and pos >= byte_end:
+                break
+            pos += len(line)
+            if line == b'\n':
+                # an event ends with an empty line
+                if header is not None:
+                    tid, timestamp = parse_event_header(header.decode())
+                    yield PerfEvent(tid, timestamp, tuple(frames))
+                header = None
+                frames = []
+            elif header is None:
+                header = line
+            else:
+                fid = frame_ids.get(line)
+                if fid is None:
+                    fid = symbols.intern(get_function_name_from_trace(line.decode()))
+                    frame_ids[line] = fid
+                frames.append(fid)
+
+
+def split_perf_file(filedir, n_shards, byte_start=0, byte_end=None):
+    """
+    Split a perf trace (or the byte range of it) into (up to) n_shards byte ranges 
+        of about the same size, return the list of byte offsets [byte_start, ..., byte_end], 
+        all of them being event boundaries
+    """
+    if byte_end is None:
+        byte_end = os.path.getsize(filedir)
+    offsets = [byte_start]
+    with open(filedir, 'rb') as file:
+        for i in range(1, n_shards):
+            file.seek(max(byte_start + (byte_end - byte_start) * i // n_shards, offsets[-1]))
+            # the position can be in the middle of a line, look for the next empty line
+            file.readline()
+            for line in file:
+                if line == b'\n':
+                    break
+            pos = file.tell()
+            if pos >= byte_end:
+                break
+            if pos > offsets[-1]:
+                offsets.append(pos)
+    offsets.append(byte_end)
+    return offsets
+
+
+def get_first_timestamp(filedir):
+    """ the timestamp of the first event of a perf trace """
+    for e in iter_perf_events(filedir):
+        return e.timestamp
+
+
+def get_last_timestamp(filedir, block_size=1 << 16):
+    """ the timestamp of the last event of a perf trace, read from the end of the file """
+    size = os.path.getsize(filedir)
+    with open(filedir, 'rb') as file:
+        while True:
+            pos = max(0, size - block_size)
+            file.seek(pos)
+            lines = file.read(size - pos).split(b'\n')
+            if pos > 0:
+                # the first line can be incomplete
+                lines = lines[1:]
+            # the header is the only line of an event that is not indented
+            for i in range(len(lines) - 1, -1, -1):
+                if lines[i] and not lines[i].startswith((b'\t', b' ')) and (i == 0 or lines[i - 1] == b'') \
+                        and (pos == 0 or i > 0):
+                    return parse_event_header(lines[i].decode())[1]
+            if pos == 0:
+                return None
+            block_size *= 2
+
+
+def seek_perf_event(filedir, t, block_size=1 << 20):
+    """
+    Return the byte offset of the first event with timestamp >= t (the file size if there is none)
+    perf script sorts the events by time, so the offset is found by binary search on the file:
+        bisect until the range is smaller than block_size, then scan the events linearly 
+    """
+    size = os.path.getsize(filedir)
+    lo = 0 # an event boundary, all the events before it are earlier than t
+    hi = size
+    with open(filedir, 'rb') as file:
+        while hi - lo > block_size:
+            mid = (lo + hi) // 2
+            file.seek(mid)
+            # the next event boundary after mid
+            file.readline()
+            for line in file:
+                if line == b'\n':
+                    break
+            boundary = file.tell()
+            header = file.readline()
+            if boundary >= hi or not header:
+                hi = mid
+            elif parse_event_header(header.decode())[1] < t:
+                lo = boundary
+            else:
+                hi = mid
+
+        file.seek(lo)
+        pos = lo
+        is_header = True
+        for line in file:
+            if is_header and line != b'\n':
+                if parse_event_header(line.decode())[1] >= t:
+                    return pos
+                is_header = False
+            elif line == b'\n':
+                is_header = True
+            pos += len(line)
+    return size
+
+
+def get_window_byte_range(filedir, t_search_start, t_search_end):
+    """
+    Same events as filter_events_after_timestamp, as a byte range of the trace (byte_start, byte_end)
+    """
+    t_start = get_first_timestamp(filedir)
+    byte_start = seek_perf_event(filedir, t_start + t_search_start)
+    byte_end = seek_perf_event(filedir, t_start + t_search_end)
+    return byte_start, max(byte_start, byte_end)
+
+
+def parse_search_log(logname):
+    """
+    Parse the log of an experiment, i.e., the outputs of bigann_search appended after 
+        a "==== <run name> ====" line per run, e.g.:
+            ==== nprobe=1 ====
+            [6.665 s] Perform a search on 10000 queries
+            PHASE search_start 5446.582354
+            [3.086 s] Search complete, QPS=32404.407
+            PHASE search_end 5449.668127
+            [9.752 s] Compute recalls
+    Return: a dict, run name -> dict of
+        't_search_start', 't_search_end': the search window (in sec) since the program starts
+        'mono_search_start', 'mono_search_end': the search window in CLOCK_MONOTONIC, 
+            if the PHASE markers are printed
+    A run name that appears several times keeps the last run, as its perf trace overwrote the others
+    """
+    runs = dict()
+    run = None
+    with open(logname, 'r') as file:
+        for line in file:
+            m = re.match(r'==== (.*) ====$', line)
+            if m:
+                run = dict()
+                runs[m.group(1)] = run
+                continue
+            if run is None:
+                continue
+            m = re.match(r'\[([0-9.]+) s\] (Perform a search|Compute recalls)', line)
+            if m:
+                key = 't_search_start' if m.group(2) == 'Perform a search' else 't_search_end'
+                run[key] = float(m.group(1))
+                continue
+            m = re.match(r'PHASE (search_start|search_end) ([0-9.]+)$', line)
+            if m:
+                run['mono_' + m.group(1)] = float(m.group(2))
+
+    return runs
+
+
+def load_search_results(filename):
+    """
+    Load the results table written by bigann_search, i.e., one record per run 
+        as a CSV row (.csv) or a JSON line (otherwise)
+    Return: a list of dict, field -> value, with the numbers converted and 
+        the missing values (e.g., R@100 of topK=10) as None
+    """
+    if not filename.endswith('.csv'):
+        with open(filename, 'r') as file:
+            return [json.loads(line) for line in file if line.strip()]
+
+    def convert(value):
+        if value == '':
+            return None
+        for number_type in (int, float):
+            try:
+                return number_type(value)
+            except ValueError:
+                pass
+        return value
+
+    with open(filename, 'r', newline='') as file:
+        return [{key: convert(value) for key, value in row.items()} for row in csv.DictReader(file)]
+
+
+def get_search_window(filedir, logname, run_name):
+    """
+    Return the search window (t_search_start, t_search_end) of a perf trace, 
+        relative to its first event, given the log of the experiment and the name of the run
+    If the trace is recorded with perf record -k CLOCK_MONOTONIC, the PHASE markers 
+        are in the same clock as the trace and give the exact window;
+        otherwise, the window is the time since the program starts printed by bigann_search
+    """
+    run = parse_search_log(logname)[run_name]
+    t_first = get_first_timestamp(filedir)
+    if 'mono_search_start' in run and 'mono_search_end' in run:
+        t_last = get_last_timestamp(filedir)
+        if t_first <= run['mono_search_start'] <= t_last:
+            return run['mono_search_start'] - t_first, run['mono_search_end'] - t_first
+    return run['t_search_start'], run['t_search_end']
+
+
+class SgemmRewriter:
+    """
+    Streaming counterpart of rewrite_sgemm_events: 
+        the per-thread state (the stage of the last knn_L2sqr / fvec_norm(s)_L2sqr call)
+        is kept across events, and the sgemm frames are renamed as new interned symbols
+    """
+
+    def __init__(self, symbols):
+        self.symbols = symbols
+        self.last_func_stage_tid = dict()
+        self.frame_kind = dict() # frame id -> 'stage_1_2' / 'stage_4' / 'sgemm' / None
+        self.renamed = dict() # (frame id, stage) -> frame id
+
+    def get_frame_kind(self, fid):
+        kind = self.frame_kind.get(fid, False)
+        if kind is False:
+            func_name = self.symbols[fid]
+            if '::knn_L2sqr' in func_name:
+                kind = 'stage_1_2'
+            elif '::fvec_norm_L2sqr' in func_name or 'fvec_norms_L2sqr' in func_name:
+                kind = 'stage_4'
+            elif 'sgemm' in func_name:
+                kind = 'sgemm'
+            else:
+                kind = None
+            self.frame_kind[fid] = kind
+        return kind
+
+    def rename(self, fid, stage):
+        key = (fid, stage)
+        new_fid = self.renamed.get(key)
+        if new_fid is None:
+            new_name = self.symbols[fid].replace("sgemm", "faiss::{}_sgemm".format(stage))
+            new_fid = self.symbols.intern(new_name)
+            self.renamed[key] = new_fid
+        return new_fid
+
+    def rewrite(self, event):
+        """ return the event with renamed sgemm frames (the same object if nothing changed) """
+        event, stage = self.rewrite_with_state(event, self.last_func_stage_tid.get(event.tid))
+        if stage is not None:
+            self.last_func_stage_tid[event.tid] = stage
+        return event
+
+    def rewrite_with_state(self, event, last_stage):
+        """
+        rewrite an event given the stage of the last knn_L2sqr / fvec_norm(s)_L2sqr call
+            of its thread, without updating the state of the thread
+        return: the rewritten event, the stage set by this event (None if it does not set any)
+        """
+        frames = None
+        stage = None
+        for i, fid in enumerate(event.frames):
+            kind = self.get_frame_kind(fid)
+            if kind is None:
+                continue
+            elif kind == 'sgemm':
+                if last_stage is not None:
+                    if frames is None:
+                        frames = list(event.frames)
+                    frames[i] = self.rename(fid, last_stage)
+            else:
+                stage = kind
+                break
+
+        if frames is not None:
+            event = event._replace(frames=tuple(frames))
+        return event, stage
+
+
+class PerfTrace:
+    """
+    Columnar representation of a perf trace, i.e., one row per event:
+        tid (int32), timestamp (float64, sec), 
+        frame_offsets (int64, n_events + 1): the frames of event i are frames[frame_offsets[i]: frame_offsets[i + 1]]
+        frames (int32): interned frame ids, decoded by symbols
+    The arrays are memory-mapped when loaded from the cache (see load_perf_trace)
+    """
+
+    def __init__(self, tid, timestamp, frame_offsets, frames, symbols):
+        self.tid = tid
+        self.timestamp = timestamp
+        self.frame_offsets = frame_offsets
+        self.frames = frames
+        self.symbols = symbols
+
+    def __len__(self):
+        return len(self.tid)
+
+    def get_window(self, t_search_start, t_search_end):
+        """
+        Same event range as filter_events_after_timestamp, return (i_start, i_end)
+        perf script sorts the events by time, so the range is found by binary search
+        """
+        t_start = self.timestamp[0]
+        i_start = np.searchsorted(self.timestamp, t_start + t_search_start, side='left')
+        i_end = np.searchsorted(self.timestamp, t_start + t_search_end, side='left')
+        return int(i_start), int(max(i_start, i_end))
+
+    def iter_events(self, i_start=0, i_end=None, chunk_size=1 << 16):
+        """ yield the events within [i_start, i_end) as PerfEvent, decoded chunk by chunk """
+        if i_end is None:
+            i_end = len(self)
+        for i0 in range(i_start, i_end, chunk_size):
+            i1 = min(i0 + chunk_size, i_end)
+            tids = self.tid[i0: i1].tolist()
+            timestamps = self.timestamp[i0: i1].tolist()
+            offsets = self.frame_offsets[i0: i1 + 1].tolist()
+            base = offsets[0]
+            frames = self.frames[base: offsets[-1]].tolist()
+            for i in range(i1 - i0):
+                yield PerfEvent(tids[i], timestamps[i], 
+                    tuple(frames[offsets[i] - base: offsets[i + 1] - base]))
+
+
+# dtype of each column stored on disk
+perf_trace_columns = [
+    ('tid', 'int32'), ('timestamp', 'float64'), ('frame_offsets', 'int64'), ('frames', 'int32')]
+
+
+def get_perf_trace_cache_dir(filedir):
+    """ the traces of a sweep are symlinks to a single file, which share one cache """
+    return os.path.realpath(filedir) + '.columnar'
+
+
+def get_file_signature(filedir):
+    """ the cache is only valid for a source file of the same size & modification time """
+    st = os.stat(filedir)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def convert_perf_to_columnar(filedir, cache_dir=None, chunk_size=1 << 20):
+    """
+    One-time conversion of a perf trace (perf script > perf.out) into the columnar
+        format of PerfTrace, the columns are written chunk by chunk such that the 
+        conversion does not keep the trace in memory
+    Return: the cache directory
+    """
+    if cache_dir is None:
+        cache_dir = get_perf_trace_cache_dir(filedir)
+    signature = get_file_signature(filedir)
+
+    # write to a temporary directory first, such that an interrupted conversion
+    #   never leaves an incomplete cache behind
+    tmp_dir = cache_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    typecodes = {'int32': 'i', 'float64': 'd', 'int64': 'q'}
+    files = {name: open(os.path.join(tmp_dir, name + '.bin'), 'wb') for name, _ in perf_trace_columns}
+    buffers = {name: array.array(typecodes[dtype]) for name, dtype in perf_trace_columns}
+
+    def flush(name):
+        buffers[name].tofile(files[name])
+        del buffers[name][:]
+
+    symbols = SymbolTable()
+    n_events = 0
+    n_frames = 0
+    buffers['frame_offsets'].append(0)
+    for e in iter_perf_events(filedir, symbols):
+        buffers['tid'].append(e.tid)
+        buffers['timestamp'].append(e.timestamp)
+        buffers['frames'].extend(e.frames)
+        n_frames += len(e.frames)
+        buffers['frame_offsets'].append(n_frames)
+        n_events += 1
+        if len(buffers['frames']) >= chunk_size:
+            for name, _ in perf_trace_columns:
+                flush(name)
+    for name, _ in perf_trace_columns:
+        flush(name)
+        files[name].close()
+
+    with open(os.path.join(tmp_dir, 'symbols.txt'), 'w') as file:
+        for name in symbols.names:
+            file.write(name + '\n')
+
+    meta = {'source': signature, 'n_events': n_events, 'n_frames': n_frames, 
+        'columns': dict(perf_trace_columns)}
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as file:
+        json.dump(meta, file)
+
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_dir, cache_dir)
+
+    print('converted {} events ({} frames, {} symbols) to {}'.format(
+        n_events, n_frames, len(symbols), cache_dir))
+
+    return cache_dir
+
+
+def load_perf_trace(filedir, cache_dir=None):
+    """
+    Load the columnar PerfTrace of a perf trace, memory-mapped, 
+        the trace is (re-)converted if there is no cache or the cache is stale
+    """
+    if cache_dir is None:
+        cache_dir = get_perf_trace_cache_dir(filedir)
+
+    meta = None
+    meta_dir = os.path.join(cache_dir, 'meta.json')
+    if os.path.exists(meta_dir):
+        with open(meta_dir, 'r') as file:
+            meta = json.load(file)
+        if meta['source'] != get_file_signature(filedir):
+            print('stale cache {}, re-converting'.format(cache_dir))
+            meta = None
+    if meta is None:
+        convert_perf_to_columnar(filedir, cache_dir)
+        with open(meta_dir, 'r') as file:
+            meta = json.load(file)
+
+    columns = dict()
+    for name, dtype in perf_trace_columns:
+        column_dir = os.path.join(cache_dir, name + '.bin')
+        if os.path.getsize(column_dir) == 0:
+            columns[name] = np.zeros(0, dtype=dtype)
+        else:
+            columns[name] = np.memmap(column_dir, dtype=dtype, mode='r')
+
+    symbols = SymbolTable()
+    with open(os.path.join(cache_dir, 'symbols.txt'), 'r') as file:
+        for line in file:
+            symbols.intern(line[:-1])
+
+    return PerfTrace(columns['tid'], columns['timestamp'], columns['frame_offsets'], 
+        columns['frames'], symbols)
+
+
 def get_tid_timestamp_from_event(event):
     """
     Return the thread ID & timestamp (in sec) from a event
@@ -146,27 +663,11 @@ def get_function_name_from_trace(trace_line):
         263e0 faiss::(anonymous namespace)::IVFPQScanner<(faiss::MetricType)1, faiss::CMax<float, long>, faiss::PQDecoder8>::set_list (/data/faiss-cpu-profiling/build/demos/demo_sift1M_read_index)
         return: faiss::(anonymous namespace)::IVFPQScanner<(faiss::MetricType)1, faiss::CMax<float, long>, faiss::PQDecoder8>::set_list (/data/faiss-cpu-profiling/build/demos/demo_sift1M_read_index)
     """
-    line = trace_line.replace("\t", "").replace("\n", "")
-
-    # removing the starting spaces
-    addr_start_cnt = None
-    for j in range(len(line)):
-        if line[j] == ' ':
-            addr_start_cnt = j + 1
-        else:
-            break
-    line = line[addr_start_cnt: ]
+    line = trace_line.replace("\t", "").replace("\n", "").lstrip(" ")
 
     # removing the address
-    func_start_cnt = None
-    for j in range(len(line)):
-        if line[j] == ' ':
-            func_start_cnt = j + 1
-            break
-    line = line[func_start_cnt: ]
-    func_name = line
-
-    return func_name
+    fields = line.split(" ", 1)
+    return fields[-1]
 
 def get_all_faiss_function(events):
     """
@@ -296,10 +797,19 @@ class ThreadTrack:
                 first_faiss_func = func_name
                 break
 
+        self.push_sample(timestamp, first_faiss_func)
+
+    def push_sample(self, timestamp, first_faiss_func):
+        """
+        push a sample that belongs to this thread, given its timestamp and 
+            the first faiss function in its call stack (None if there is no faiss function)
+        the functions not in faiss_functions are tracked once they consume time
+        """
         if self.track_non_faiss_func:
 
             if self.last_faiss_func_timestamp is not None:
-                self.time_consumption_per_func[self.last_func_name] += \
+                self.time_consumption_per_func[self.last_func_name] = \
+                    self.time_consumption_per_func.get(self.last_func_name, 0) + \
                     timestamp - self.last_faiss_func_timestamp
 
             # track name & timestamp
@@ -318,7 +828,8 @@ class ThreadTrack:
                 no last func -> other func / faiss func: discard time consumption; track current timestamp & name
             """
             if (self.last_faiss_func_timestamp is not None) and (self.last_func_name != 'others'):
-                self.time_consumption_per_func[self.last_func_name] += \
+                self.time_consumption_per_func[self.last_func_name] = \
+                    self.time_consumption_per_func.get(self.last_func_name, 0) + \
                     timestamp - self.last_faiss_func_timestamp
 
             # track name & timestamp
@@ -331,11 +842,13 @@ class ThreadTrack:
     def get_time_consumption_dict(self):
         return self.time_consumption_per_func
 
-def classify_events_by_stages(events, track_non_faiss_func=True, remove_unrecognized_faiss_function=False):
+def classify_events_by_stages(events, track_non_faiss_func=True, remove_unrecognized_faiss_function=False, 
+        stage_classifier=None):
     """
     Given a set of events, 
         first aggregate the time consumption by function names
         then aggregate the time consumption by stages (return values)
+    stage_classifier: the StageClassifier of the stages, default_stage_classifier if None
     """
     tids = get_all_tid(events)
 
@@ -370,104 +883,380 @@ def classify_events_by_stages(events, track_non_faiss_func=True, remove_unrecogn
             # print("func: {}\ttime: {} sec".format(func, time_consumption_per_func[func]))
             time_consumption_all_threads[func] += time_consumption_per_func[func]
 
-    time_consumption_all_threads_arr = [(func, time_consumption_all_threads[func]) for func in time_consumption_all_threads]
-    time_consumption_all_threads_arr = sorted(time_consumption_all_threads_arr, key=lambda tup: tup[1], reverse=True)
+    return aggregate_time_by_stages(time_consumption_all_threads, remove_unrecognized_faiss_function, 
+        stage_classifier)
+
+
+def track_perf_events(events, symbols, track_non_faiss_func=True):
+    """
+    Given an iterable of PerfEvent (decoded by symbols), rewrite the sgemm frames 
+        and push every event to its ThreadTrack in a single pass 
+    Return: a dict, tid -> ThreadTrack
+    """
+    sgemm_rewriter = SgemmRewriter(symbols)
+    is_faiss_frame = dict()
+
+    time_consumption_dict = dict()
+    for e in events:
+        e = sgemm_rewriter.rewrite(e)
+        first_faiss_func = get_first_faiss_func(e, symbols, is_faiss_frame)
+
+        thread_track = time_consumption_dict.get(e.tid)
+        if thread_track is None:
+            thread_track = ThreadTrack(e.tid, set(), track_non_faiss_func)
+            time_consumption_dict[e.tid] = thread_track
+        thread_track.push_sample(e.timestamp, first_faiss_func)
+
+    return time_consumption_dict
+
 
+def get_first_faiss_func(event, symbols, is_faiss_frame):
+    """
+    Return the name of the first faiss function in the call stack of a PerfEvent (None if there is none)
+    (input/output) is_faiss_frame: dict, frame id -> is it a faiss function, resolved once per symbol
+    """
+    for fid in event.frames:
+        is_faiss = is_faiss_frame.get(fid)
+        if is_faiss is None:
+            is_faiss = 'faiss::' in symbols[fid]
+            is_faiss_frame[fid] = is_faiss
+        if is_faiss:
+            return symbols[fid]
+    return None
+
+
+def classify_perf_file_by_stages(filedir, t_search_start=0.0, t_search_end=float('inf'),
+        track_non_faiss_func=True, remove_unrecognized_faiss_function=False, use_cache=False,
+        stage_classifier=None):
+    """
+    Streaming counterpart of 
+        group_perf_by_events -> filter_events_after_timestamp -> classify_events_by_stages:
+        the trace is parsed in a single pass, and the memory consumption is bounded by 
+        the number of threads and unique symbols rather than the number of events
+    The search window is found by binary search on the timestamps, e.g., from get_search_window
+    use_cache: read the events from the columnar cache of the trace (see load_perf_trace)
+        instead of parsing the text
+    """
+    if use_cache:
+        trace = load_perf_trace(filedir)
+        symbols = trace.symbols
+        filtered_events = trace.iter_events(*trace.get_window(t_search_start, t_search_end))
+    else:
+        symbols = SymbolTable()
+        byte_start, byte_end = get_window_byte_range(filedir, t_search_start, t_search_end)
+        filtered_events = iter_perf_events(filedir, symbols, byte_start, byte_end)
+    time_consumption_dict = track_perf_events(filtered_events, symbols, track_non_faiss_func)
+    time_consumption_all_threads = sum_time_consumption_over_threads(time_consumption_dict)
+
+    return aggregate_time_by_stages(time_consumption_all_threads, remove_unrecognized_faiss_function, 
+        stage_classifier)
+
+
+def sum_time_consumption_over_threads(time_consumption_dict):
+    """
+    Given a dict tid -> ThreadTrack, return the entire time consumption per function name
+    """
+    time_consumption_all_threads = dict()
+    time_consumption_all_threads['others'] = 0
+    for tid in time_consumption_dict:
+        time_consumption_per_func = time_consumption_dict[tid].get_time_consumption_dict()
+        for func in time_consumption_per_func:
+            time_consumption_all_threads[func] = \
+                time_consumption_all_threads.get(func, 0) + time_consumption_per_func[func]
 
-    t_1_4 = 0
-    t_5 = 0
-    t_6 = 0
-    t_other = 0
-
-
-    def get_stage(fname):
-        """ Return which stage the faiss function belongs to """
-        
-        # S 1~2
-        if \
-            "::knn_L2sqr" in fname or \
-            "::stage_1_2_sgemm" in fname or \
-            "::search" in fname and "::search_preassigned" not in fname:
-            return 't_1_4'
-        # S 3
-        elif \
-            "::search_preassigned" in fname or \
-            "::add_results" in fname or \
-            "::operator()" in fname:
-            return 't_1_4'
-        # S 4
-        elif \
-            "::fvec_madd" in fname or \
-            "::fvec_inner_product_ref" in fname or \
-            "::ArrayInvertedLists::list_size" in fname or \
-            "::fvec_inner_products_ny_ref" in fname or \
-            "::fvec_norm_L2sqr" in fname or \
-            "::fvec_norms_L2sqr" in fname or \
-            "::precompute_list_tables" in fname or \
-            "::faiss::stage_4_sgemm" in fname or \
-            "compute_distance_table" in fname: 
-            return 't_1_4'
-        # S 1~4 but unknown which
-        elif \
-            "sgemm" in fname or \
-            "inner_prod" in fname or \
-            "L2sqr" in fname or \
-            "compute_residual" in fname:
-            return 't_1_4'
-        elif "::scan_codes" in fname or \
-            "::get_codes" in fname or \
-            "::set_list" in fname:
-            return 't_5'
-        elif "::add" in fname and "::add_results" not in fname or \
-            "Heap" in fname:
-            return 't_6'
+    return time_consumption_all_threads
+
+
+class ShardTrack:
+    """
+    The per-thread time consumption of a shard of a trace (a byte range of the text,
+        or an event range of the columnar cache), to be merged with the other shards
+        of the trace by merge_shard_tracks
+    The sgemm rewriting of a thread depends on its state at the end of the previous shard, 
+        thus the samples of a thread up to its first knn_L2sqr / fvec_norm(s)_L2sqr call 
+        are kept unresolved, i.e., with their first faiss function for every possible
+        incoming state, until the merge
+    """
+    incoming_states = (None, 'stage_1_2', 'stage_4')
+
+    def __init__(self, track_non_faiss_func=True):
+        self.track_non_faiss_func = track_non_faiss_func
+        self.leading_samples = dict() # tid -> list of (timestamp, {incoming state: first faiss func})
+        self.exit_state = dict() # tid -> sgemm state at the end of the shard, once known
+        self.first_sample = dict() # tid -> (timestamp, first faiss func) of the first resolved sample
+        self.thread_tracks = dict() # tid -> ThreadTrack of the resolved samples
+
+    def push_events(self, events, symbols):
+        sgemm_rewriter = SgemmRewriter(symbols)
+        is_faiss_frame = dict()
+
+        for e in events:
+            tid = e.tid
+            if tid in self.exit_state:
+                rewritten, stage = sgemm_rewriter.rewrite_with_state(e, self.exit_state[tid])
+                if stage is not None:
+                    self.exit_state[tid] = stage
+                first_faiss_func = get_first_faiss_func(rewritten, symbols, is_faiss_frame)
+
+                thread_track = self.thread_tracks.get(tid)
+                if thread_track is None:
+                    thread_track = ThreadTrack(tid, set(), self.track_non_faiss_func)
+                    self.thread_tracks[tid] = thread_track
+                    self.first_sample[tid] = (e.timestamp, first_faiss_func)
+                thread_track.push_sample(e.timestamp, first_faiss_func)
+            else:
+                candidates = dict()
+                for incoming_state in self.incoming_states:
+                    rewritten, stage = sgemm_rewriter.rewrite_with_state(e, incoming_state)
+                    candidates[incoming_state] = get_first_faiss_func(rewritten, symbols, is_faiss_frame)
+                self.leading_samples.setdefault(tid, []).append((e.timestamp, candidates))
+                # whether an event sets the state does not depend on the incoming state
+                if stage is not None:
+                    self.exit_state[tid] = stage
+
+    def get_tids(self):
+        return set(self.leading_samples) | set(self.thread_tracks)
+
+
+def merge_shard_tracks(shard_tracks, track_non_faiss_func=True):
+    """
+    Merge the ShardTrack of consecutive shards (in the order of the trace) 
+    Return: a dict, tid -> ThreadTrack, the same as tracking the whole trace in one pass
+    """
+    time_consumption_dict = dict()
+    states = dict()
+    for shard_track in shard_tracks:
+        for tid in sorted(shard_track.get_tids()):
+            thread_track = time_consumption_dict.get(tid)
+            if thread_track is None:
+                thread_track = ThreadTrack(tid, set(), track_non_faiss_func)
+                time_consumption_dict[tid] = thread_track
+
+            state = states.get(tid)
+            for timestamp, candidates in shard_track.leading_samples.get(tid, []):
+                thread_track.push_sample(timestamp, candidates[state])
+            if tid in shard_track.exit_state:
+                states[tid] = shard_track.exit_state[tid]
+
+            shard_thread_track = shard_track.thread_tracks.get(tid)
+            if shard_thread_track is None:
+                continue
+            # the time between the previous sample and the first resolved sample of the shard
+            timestamp, first_faiss_func = shard_track.first_sample[tid]
+            thread_track.push_sample(timestamp, first_faiss_func)
+            time_consumption_per_func = shard_thread_track.get_time_consumption_dict()
+            for func in time_consumption_per_func:
+                thread_track.time_consumption_per_func[func] = \
+                    thread_track.time_consumption_per_func.get(func, 0) + time_consumption_per_func[func]
+            thread_track.last_faiss_func_timestamp = shard_thread_track.last_faiss_func_timestamp
+            thread_track.last_func_name = shard_thread_track.last_func_name
+
+    return time_consumption_dict
+
+
+def track_perf_shard(task):
+    """
+    Process pool worker: track a shard of a trace, return its ShardTrack
+    task: (filedir, start, end, track_non_faiss_func, use_cache)
+        start, end: byte range in the text, or event range in the columnar cache if use_cache
+    """
+    filedir, start, end, track_non_faiss_func, use_cache = task
+
+    if use_cache:
+        trace = load_perf_trace(filedir)
+        symbols = trace.symbols
+        events = trace.iter_events(start, end)
+    else:
+        symbols = SymbolTable()
+        events = iter_perf_events(filedir, symbols, start, end)
+
+    shard_track = ShardTrack(track_non_faiss_func)
+    shard_track.push_events(events, symbols)
+    return shard_track
+
+
+def classify_perf_files_by_stages(filedirs, time_ranges, 
+        track_non_faiss_func=True, remove_unrecognized_faiss_function=False, use_cache=False,
+        stage_classifier=None, n_processes=None, n_shards_per_file=None):
+    """
+    Batch driver of classify_perf_file_by_stages: the trace files, and ranges inside
+        each trace, are processed by a pool of n_processes processes, then the shards 
+        are merged per file in the order of the trace 
+    The shards only cover the search window of each trace (see get_window_byte_range)
+
+    (input) time_ranges: list of (t_search_start, t_search_end) per file
+    Return: a list of the time consumption per stage, e.g., (t_1_4, t_5, t_6, t_other), one per file
+    """
+    assert len(filedirs) == len(time_ranges)
+    if n_processes is None:
+        n_processes = multiprocessing.cpu_count()
+    if n_shards_per_file is None:
+        n_shards_per_file = max(1, int(math.ceil(n_processes / len(filedirs))))
+
+    tasks = []
+    task_file_ids = []
+    for file_id, (filedir, (t_search_start, t_search_end)) in enumerate(zip(filedirs, time_ranges)):
+        if use_cache:
+            # convert before dispatching, such that workers only read the cache
+            trace = load_perf_trace(filedir)
+            i_start, i_end = trace.get_window(t_search_start, t_search_end)
+            step = max(1, int(math.ceil((i_end - i_start) / n_shards_per_file)))
+            ranges = [(i, min(i + step, i_end)) for i in range(i_start, i_end, step)]
         else:
-            return 't_other'
+            byte_start, byte_end = get_window_byte_range(filedir, t_search_start, t_search_end)
+            offsets = split_perf_file(filedir, n_shards_per_file, byte_start, byte_end)
+            ranges = list(zip(offsets[:-1], offsets[1:]))
+        for start, end in ranges:
+            tasks.append((filedir, start, end, track_non_faiss_func, use_cache))
+            task_file_ids.append(file_id)
+
+    pool = multiprocessing.Pool(n_processes)
+    shard_tracks = pool.map(track_perf_shard, tasks, chunksize=1)
+    pool.close()
+    pool.join()
+
+    results = []
+    for file_id, filedir in enumerate(filedirs):
+        print("Processing {}".format(filedir))
+        time_consumption_dict = merge_shard_tracks(
+            [st for st, fid in zip(shard_tracks, task_file_ids) if fid == file_id], track_non_faiss_func)
+        time_consumption_all_threads = sum_time_consumption_over_threads(time_consumption_dict)
+        results.append(aggregate_time_by_stages(time_consumption_all_threads, remove_unrecognized_faiss_function, 
+            stage_classifier))
+
+    return results
+
+
+"""
+A rule of the stage table: functions whose name matches pattern (and not exclude, if given) 
+    belong to stage; the patterns are regular expressions searched in the function name
+"""
+StageRule = collections.namedtuple('StageRule', ['stage', 'pattern', 'exclude'])
+StageRule.__new__.__defaults__ = (None,)
+
+# the stages the faiss functions are classified into, by the first matching rule,
+#   the time of functions that no rule matches goes to the last stage
+default_stages = ('t_1_4', 't_5', 't_6', 't_other')
+
+default_stage_rules = [
+    # S 1~2
+    StageRule('t_1_4', r'::knn_L2sqr|::stage_1_2_sgemm'),
+    StageRule('t_1_4', r'::search', exclude=r'::search_preassigned'),
+    # S 3
+    StageRule('t_1_4', r'::search_preassigned|::add_results|::operator\(\)'),
+    # S 4
+    StageRule('t_1_4', 
+        r'::fvec_madd|::fvec_inner_product_ref|::ArrayInvertedLists::list_size|'
+        r'::fvec_inner_products_ny_ref|::fvec_norm_L2sqr|::fvec_norms_L2sqr|'
+        r'::precompute_list_tables|::faiss::stage_4_sgemm|compute_distance_table'),
+    # S 1~4 but unknown which
+    StageRule('t_1_4', r'sgemm|inner_prod|L2sqr|compute_residual'),
+    # S 5
+    StageRule('t_5', r'::scan_codes|::get_codes|::set_list'),
+    # S 6
+    StageRule('t_6', r'::add', exclude=r'::add_results'),
+    StageRule('t_6', r'Heap'),
+]
+
+"""
+Example of a new stage: separate the OPQ rotation (Stage 1) from the rest of Stage 1~4, use with
+    StageClassifier(split_opq_stage_rules, split_opq_stages)
+"""
+split_opq_stages = ('t_1', 't_2_4', 't_5', 't_6', 't_other')
+
+split_opq_stage_rules = [
+    StageRule('t_1', r'::LinearTransform::apply|::IndexPreTransform::apply_chain|::OPQMatrix')] + \
+    [StageRule('t_2_4' if r.stage == 't_1_4' else r.stage, r.pattern, r.exclude) for r in default_stage_rules]
+
+
+class StageClassifier:
+    """
+    Classify function names into stages with a table of StageRule, 
+        the rules are compiled once and every unique function name is only 
+        matched once, later lookups are a dict access
+    """
+
+    def __init__(self, rules=default_stage_rules, stages=default_stages):
+        self.stages = tuple(stages)
+        self.stage_ids = {stage: i for i, stage in enumerate(self.stages)}
+        self.default_stage_id = len(self.stages) - 1
+        self.rules = []
+        for rule in rules:
+            assert rule.stage in self.stage_ids, "unknown stage {}".format(rule.stage)
+            exclude = re.compile(rule.exclude) if rule.exclude is not None else None
+            self.rules.append((self.stage_ids[rule.stage], re.compile(rule.pattern), exclude))
+        self.cache = dict() # function name -> stage id
+
+    def get_stage_id(self, fname):
+        stage_id = self.cache.get(fname)
+        if stage_id is None:
+            stage_id = self.default_stage_id
+            for rule_stage_id, pattern, exclude in self.rules:
+                if pattern.search(fname) and not (exclude is not None and exclude.search(fname)):
+                    stage_id = rule_stage_id
+                    break
+            self.cache[fname] = stage_id
+        return stage_id
+
+    def get_stage(self, fname):
+        return self.stages[self.get_stage_id(fname)]
+
+
+default_stage_classifier = StageClassifier()
+
+
+def get_stage(fname):
+    """ Return which stage the faiss function belongs to """
+    return default_stage_classifier.get_stage(fname)
+
+
+def aggregate_time_by_stages(time_consumption_all_threads, remove_unrecognized_faiss_function=False, 
+        stage_classifier=None):
+    """
+    Given the time consumption of all threads per function name (a dict),
+        aggregate the time consumption by stages 
+    Return: the time consumption per stage, in the order of stage_classifier.stages,
+        i.e., (t_1_4, t_5, t_6, t_other) by default
+    """
+    if stage_classifier is None:
+        stage_classifier = default_stage_classifier
+
+    time_consumption_all_threads_arr = [(func, time_consumption_all_threads[func]) for func in time_consumption_all_threads]
+    time_consumption_all_threads_arr = sorted(time_consumption_all_threads_arr, key=lambda tup: tup[1], reverse=True)
+
+    t_stages = [0] * len(stage_classifier.stages)
 
     print("\nAll threads time consumption:")
     faiss_func_set = set()
     for fname, time in time_consumption_all_threads_arr:
         print("func: {}\ttime: {} sec".format(fname, time))
-        stage = get_stage(fname)
-        if stage == 't_1_4':
-            t_1_4 += time
-        elif stage == 't_5':
-            t_5 += time
-        elif stage == 't_6':
-            t_6 += time
-        elif stage == 't_other':
-            t_other += time
+        t_stages[stage_classifier.get_stage_id(fname)] += time
         faiss_func_set.add(fname)
 
     print("All faiss functions:")
     for f in faiss_func_set:
-        print("stage: {}\t{}".format(get_stage(f), f))
+        print("stage: {}\t{}".format(stage_classifier.get_stage(f), f))
 
     print("\nTime consumption per stage:")
-    print("S1~4: {:.4f} sec".format(t_1_4))
-    print("S5: {:.4f} sec\t".format(t_5))
-    print("S6: {:.4f} sec\t".format(t_6))
-    print("other: {:.4f} sec\t".format(t_other))
+    for stage, t in zip(stage_classifier.stages, t_stages):
+        print("{}: {:.4f} sec\t".format(stage, t))
 
     if remove_unrecognized_faiss_function:
         print("Warning: For faiss functions with names that we cannot identify, we discard the time consumption!")
-        t_other = 0
-        print("other: {:.4f} sec\t".format(t_other))
+        t_stages[stage_classifier.default_stage_id] = 0
+        print("{}: {:.4f} sec\t".format(stage_classifier.stages[-1], 0))
 
-    return t_1_4, t_5, t_6, t_other
+    return tuple(t_stages)
 
 
-def get_percentage(t_1_4, t_5, t_6, t_other):
-
-    t_total = t_1_4 + t_5 + t_6 + t_other
-
-    # 0 ~ 100%
-    p_1_4 = t_1_4 / t_total * 100
-    p_5 = t_5 / t_total * 100
-    p_6 = t_6 / t_total * 100
-    p_other = t_other / t_total * 100
+def get_percentage(*t_stages):
+    """
+    Given the time consumption per stage, e.g., t_1_4, t_5, t_6, t_other,
+        return the percentage per stage (0 ~ 100%), in the same order
+    """
+    t_total = sum(t_stages)
 
-    return p_1_4, p_5, p_6, p_other
+    return tuple(t / t_total * 100 for t in t_stages)
 
 if __name__ == "__main__":
 
@@ -482,11 +1271,19 @@ if __name__ == "__main__":
     parser.add_argument('--t_search_end', type=float, 
         default=10000.0, 
         help="time (in sec) when the search is done and the rest are finish up functions like recall measure")
+    parser.add_argument('--logname', type=str, 
+        default=None, 
+        help="the search log of the experiment, if given, the search window is read from it instead of --t_search_start / --t_search_end")
+    parser.add_argument('--run_name', type=str, 
+        default=None, 
+        help="the run in the search log, e.g., nprobe=16 for the run after the line ==== nprobe=16 ====")
 
     args = parser.parse_args()
     filename = args.filename
     t_search_start = args.t_search_start
     t_search_end = args.t_search_end
+    if args.logname is not None:
+        t_search_start, t_search_end = get_search_window(filename, args.logname, args.run_name)
 
 
     # WENQI: I have looked at the log, the following way to extract the start / end of faiss call is very accurate
@@ -4,8 +4,7 @@ import numpy as np
 
 import os
 
-from analyze_perf import group_perf_by_events, filter_events_after_timestamp, \
-    classify_events_by_stages, get_percentage
+from analyze_perf import classify_perf_files_by_stages, get_percentage, get_search_window
 from profiling_stages import draw_profiling_plot
 
 
@@ -45,46 +44,30 @@ path_prefixes = []
 for p in file_prefixes:
     path_prefixes.append(os.path.join('../result_experiment_2_algorithm_settings', p))
 
-# time range of the search function, according to the search log, e.g.,
-    # time_bias_start = 135.656
-    # time_bias_end = 200.659
-time_ranges = [ # pair of (time_bias_start, time_bias_end)
-    # ==== IVF1024,PQ16 ====
-    (24.701, 109.128),
-    # ==== OPQ16,IVF1024,PQ16 ====
-    (135.656, 200.659),
-    # ==== IVF2048,PQ16 ====
-    (137.161, 181.207), 
-    # ==== OPQ16,IVF2048,PQ16 ====
-    (128.055, 164.959),
-    # ==== IVF4096,PQ16 ====
-    (24.460, 51.717),
-    # ==== OPQ16,IVF4096,PQ16 ====
-    (122.927, 146.346),
-    # ==== IVF8192,PQ16 ====
-    (24.548, 41.720),
-    # ==== OPQ16,IVF8192,PQ16 ====
-    (115.663, 132.339),
-    # ==== IVF16384,PQ16 ====
-    (119.551, 131.259), 
-    # ==== OPQ16,IVF16384,PQ16 ====
-    (132.458, 143.132),
-    # ==== IVF32768,PQ16 ====
-    (119.306, 126.174),
-    # ==== OPQ16,IVF32768,PQ16 ====
-    (130.724, 136.956),
-    # ==== IVF65536,PQ16 ====
-    (28.327, 32.994),
-    # ==== OPQ16,IVF65536,PQ16 ====
-    (135.239, 141.575),
-    # ==== IVF131072,PQ16 ====
-    (33.900, 37.819),
-    # ==== OPQ16,IVF131072,PQ16 ====
-    (33.665, 37.485),
-    # ==== IVF262144,PQ16 ====
-    (28.138, 31.533),
-    # ==== OPQ16,IVF262144,PQ16 ====
-    (28.112, 31.429)]
+# search window of each run, read from the search log of the experiment (see get_search_window)
+logname = os.path.join('../result_experiment_2_algorithm_settings', 'out_SIFT1000M_R@100=0.95_qbs_10000')
+run_names = [ \
+    'IVF1024,PQ16', \
+    'OPQ16,IVF1024,PQ16', \
+    'IVF2048,PQ16', \
+    'OPQ16,IVF2048,PQ16', \
+    'IVF4096,PQ16', \
+    'OPQ16,IVF4096,PQ16', \
+    'IVF8192,PQ16', \
+    'OPQ16,IVF8192,PQ16', \
+    'IVF16384,PQ16', \
+    'OPQ16,IVF16384,PQ16', \
+    'IVF32768,PQ16', \
+    'OPQ16,IVF32768,PQ16', \
+    'IVF65536,PQ16', \
+    'OPQ16,IVF65536,PQ16', \
+    'IVF131072,PQ16', \
+    'OPQ16,IVF131072,PQ16', \
+    'IVF262144,PQ16', \
+    'OPQ16,IVF262144,PQ16']
+
+assert len(run_names) == len(path_prefixes)
+time_ranges = [get_search_window(path_prefixes[i], logname, run_names[i]) for i in range(len(path_prefixes))]
 
 # Stage 1: OPQ
 # Stage 2: vector quantizer
@@ -101,12 +84,8 @@ profile_perc_array = []
 #     [32.7008185883583, 0.5164703077320218, 4.674772663594282, 33.70847203114799, 28.399466409167403]
 #     ]
 
-for i in range(len(path_prefixes)): 
-    print("Processing {}".format(path_prefixes[i]))
-    all_events = group_perf_by_events(path_prefixes[i])
-    time_bias_start, time_bias_end = time_ranges[i][0], time_ranges[i][1]
-    filtered_events = filter_events_after_timestamp(all_events, time_bias_start, time_bias_end)
-    t_1_4, t_5, t_6, t_other = classify_events_by_stages(filtered_events, track_non_faiss_func=False)
+stage_time_array = classify_perf_files_by_stages(path_prefixes, time_ranges, track_non_faiss_func=False, use_cache=True)
+for t_1_4, t_5, t_6, t_other in stage_time_array: 
     p_1_4, p_5, p_6, p_other = get_percentage(t_1_4, t_5, t_6, t_other)
     profile_perc_array.append([p_1_4, p_5, p_6, p_other])
 
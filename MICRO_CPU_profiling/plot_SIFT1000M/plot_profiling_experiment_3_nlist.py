@@ -4,8 +4,7 @@ import numpy as np
 
 import os
 
-from analyze_perf import group_perf_by_events, filter_events_after_timestamp, \
-    classify_events_by_stages, get_percentage
+from analyze_perf import classify_perf_files_by_stages, get_percentage, get_search_window
 from profiling_stages import draw_profiling_plot
 
 
@@ -36,46 +35,30 @@ path_prefixes = []
 for p in file_prefixes:
     path_prefixes.append(os.path.join('../result_experiment_3_nlist', p))
 
-# time range of the search function, according to the search log, e.g.,
-    # time_bias_start = 135.656
-    # time_bias_end = 200.659
-time_ranges = [ # pair of (time_bias_start, time_bias_end)
-    # ==== IVF1024,PQ16 ====
-    (25.614 , 105.094),
-    # ==== IVF2048,PQ16 ====
-    (133.937, 175.191),
-    # ==== IVF4096,PQ16 ====
-    (78.952, 100.255),
-    # ==== IVF8192,PQ16 ====
-    (24.153, 35.327),
-    # ==== IVF16384,PQ16 ====
-    (69.133, 74.918),
-    # ==== IVF32768,PQ16 ====
-    (85.616, 88.656),
-    # ==== IVF65536,PQ16 ====
-    (28.122, 30.020),
-    # ==== IVF131072,PQ16 ====
-    (33.747, 35.233),
-    # ==== IVF262144,PQ16 ====
-    (27.505, 29.768),
-    # ==== OPQ16,IVF1024,PQ16 ====
-    (136.694, 216.113),
-    # ==== OPQ16,IVF2048,PQ16 ====
-    (144.551, 186.266),
-    # ==== OPQ16,IVF4096,PQ16 ====
-    (92.206, 112.987),
-    # ==== OPQ16,IVF8192,PQ16 ====
-    (89.147, 100.082),
-    # ==== OPQ16,IVF16384,PQ16 ====
-    (137.739, 143.738),
-    # ==== OPQ16,IVF32768,PQ16 ====
-    (124.490, 127.577),
-    # ==== OPQ16,IVF65536,PQ16 ====
-    (57.015, 58.795),
-    # ==== OPQ16,IVF131072,PQ16 ====
-    (33.741, 35.117),
-    # ==== OPQ16,IVF262144,PQ16 ====
-    (27.414, 28.852)]
+# search window of each run, read from the search log of the experiment (see get_search_window)
+logname = os.path.join('../result_experiment_3_nlist', 'out_SIFT1000M_K_100_nprobe_16_qbs_10000')
+run_names = [ \
+    'IVF1024,PQ16', \
+    'IVF2048,PQ16', \
+    'IVF4096,PQ16', \
+    'IVF8192,PQ16', \
+    'IVF16384,PQ16', \
+    'IVF32768,PQ16', \
+    'IVF65536,PQ16', \
+    'IVF131072,PQ16', \
+    'IVF262144,PQ16', \
+    'OPQ16,IVF1024,PQ16', \
+    'OPQ16,IVF2048,PQ16', \
+    'OPQ16,IVF4096,PQ16', \
+    'OPQ16,IVF8192,PQ16', \
+    'OPQ16,IVF16384,PQ16', \
+    'OPQ16,IVF32768,PQ16', \
+    'OPQ16,IVF65536,PQ16', \
+    'OPQ16,IVF131072,PQ16', \
+    'OPQ16,IVF262144,PQ16']
+
+assert len(run_names) == len(path_prefixes)
+time_ranges = [get_search_window(path_prefixes[i], logname, run_names[i]) for i in range(len(path_prefixes))]
 
 # Stage 1: OPQ
 # Stage 2: vector quantizer
@@ -92,12 +75,8 @@ profile_perc_array = []
 #     [32.7008185883583, 0.5164703077320218, 4.674772663594282, 33.70847203114799, 28.399466409167403]
 #     ]
 
-for i in range(len(path_prefixes)): 
-    print("Processing {}".format(path_prefixes[i]))
-    all_events = group_perf_by_events(path_prefixes[i])
-    time_bias_start, time_bias_end = time_ranges[i][0], time_ranges[i][1]
-    filtered_events = filter_events_after_timestamp(all_events, time_bias_start, time_bias_end)
-    t_1_4, t_5, t_6, t_other = classify_events_by_stages(filtered_events, track_non_faiss_func=False)
+stage_time_array = classify_perf_files_by_stages(path_prefixes, time_ranges, track_non_faiss_func=False, use_cache=True)
+for t_1_4, t_5, t_6, t_other in stage_time_array: 
     p_1_4, p_5, p_6, p_other = get_percentage(t_1_4, t_5, t_6, t_other)
     profile_perc_array.append([p_1_4, p_5, p_6, p_other])
 
@@ -4,8 +4,7 @@ import numpy as np
 
 import os
 
-from analyze_perf import group_perf_by_events, filter_events_after_timestamp, \
-    classify_events_by_stages, get_percentage
+from analyze_perf import classify_perf_files_by_stages, get_percentage, get_search_window
 from profiling_stages import draw_profiling_plot
 
 print("Warning: For SIFT1000M, this setting does not achieve 95% R@100 recall. I should have used another nprobe")
@@ -37,26 +36,20 @@ for p in file_prefixes:
     path_prefixes.append(os.path.join('../result_experiment_5_topK', p))
 
 
-# time range of the search function, according to the search log, e.g.,
-    # time_bias_start = 135.656
-    # time_bias_end = 200.659
-time_ranges = [ # pair of (time_bias_start, time_bias_end)
-    # ==== topK=1 ====
-    (28.016, 48.952),
-    # ==== topK=10 ====
-    (27.390, 48.406),
-    # ==== topK=20 ====
-    (27.431, 48.832),
-    # ==== topK=50 ====
-    (28.412, 49.459),
-    # ==== topK=100 ====
-    (27.279, 48.343),
-    # ==== topK=200 ====
-    (27.408, 48.591),
-    # ==== topK=500 ====
-    (28.107, 50.689),
-    # ==== topK=1000 ====
-    (27.390, 49.570)]
+# search window of each run, read from the search log of the experiment (see get_search_window)
+logname = os.path.join('../result_experiment_5_topK', 'out_SIFT1000M_OPQ16,IVF262144,PQ16_qbs_10000')
+run_names = [ \
+    'topK=1', \
+    'topK=10', \
+    'topK=20', \
+    'topK=50', \
+    'topK=100', \
+    'topK=200', \
+    'topK=500', \
+    'topK=1000']
+
+assert len(run_names) == len(path_prefixes)
+time_ranges = [get_search_window(path_prefixes[i], logname, run_names[i]) for i in range(len(path_prefixes))]
 
 # Stage 1: OPQ
 # Stage 2: vector quantizer
@@ -73,12 +66,8 @@ profile_perc_array = []
 #     [32.7008185883583, 0.5164703077320218, 4.674772663594282, 33.70847203114799, 28.399466409167403]
 #     ]
 
-for i in range(len(path_prefixes)): 
-    print("Processing {}".format(path_prefixes[i]))
-    all_events = group_perf_by_events(path_prefixes[i])
-    time_bias_start, time_bias_end = time_ranges[i][0], time_ranges[i][1]
-    filtered_events = filter_events_after_timestamp(all_events, time_bias_start, time_bias_end)
-    t_1_4, t_5, t_6, t_other = classify_events_by_stages(filtered_events, track_non_faiss_func=False, remove_unrecognized_faiss_function=False)
+stage_time_array = classify_perf_files_by_stages(path_prefixes, time_ranges, track_non_faiss_func=False, remove_unrecognized_faiss_function=False, use_cache=True)
+for t_1_4, t_5, t_6, t_other in stage_time_array: 
     p_1_4, p_5, p_6, p_other = get_percentage(t_1_4, t_5, t_6, t_other)
     profile_perc_array.append([p_1_4, p_5, p_6, p_other])
 
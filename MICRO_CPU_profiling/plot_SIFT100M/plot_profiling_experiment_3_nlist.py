@@ -4,8 +4,7 @@ import numpy as np
 
 import os
 
-from analyze_perf import group_perf_by_events, filter_events_after_timestamp, \
-    classify_events_by_stages, get_percentage
+from analyze_perf import classify_perf_files_by_stages, get_percentage, get_search_window
 from profiling_stages import draw_profiling_plot
 
 
@@ -48,46 +47,30 @@ path_prefixes = []
 for p in file_prefixes:
     path_prefixes.append(os.path.join('../result_experiment_3_nlist', p))
 
-# time range of the search function, according to the search log, e.g.,
-    # time_bias_start = 135.656
-    # time_bias_end = 200.659
-time_ranges = [ # pair of (time_bias_start, time_bias_end)
-    # ==== IVF1024,PQ16 ====
-    (2.807 , 11.893),
-    # ==== IVF2048,PQ16 ====
-    (2.915, 8.534),
-    # ==== IVF4096,PQ16 ====
-    (3.018, 5.739),
-    # ==== IVF8192,PQ16 ====
-    (3.364, 4.672),
-    # ==== IVF16384,PQ16 ====
-    (3.937, 4.827),
-    # ==== IVF32768,PQ16 ====
-    (4.824, 5.783),
-    # ==== IVF65536,PQ16 ====
-    (6.821, 7.675),
-    # ==== IVF131072,PQ16 ====
-    (10.458, 11.656),
-    # ==== IVF262144,PQ16 ====
-    (3.985, 20.681),
-    # ==== OPQ16,IVF1024,PQ16 ====
-    (2.722, 11.790),
-    # ==== OPQ16,IVF2048,PQ16 ====
-    (2.933, 7.308),
-    # ==== OPQ16,IVF4096,PQ16 ====
-    (3.033, 5.811),
-    # ==== OPQ16,IVF8192,PQ16 ====
-    (3.309, 4.886),
-    # ==== OPQ16,IVF16384,PQ16 ====
-    (3.872, 4.932),
-    # ==== OPQ16,IVF32768,PQ16 ====
-    (4.847, 5.612),
-    # ==== OPQ16,IVF65536,PQ16 ====
-    (6.733, 7.484),
-    # ==== OPQ16,IVF131072,PQ16 ====
-    (10.298, 11.359),
-    # ==== OPQ16,IVF262144,PQ16 ====
-    (4.017, 21.640)]
+# search window of each run, read from the search log of the experiment (see get_search_window)
+logname = os.path.join('../result_experiment_3_nlist', 'out_SIFT100M_K_100_nprobe_16_qbs_10000')
+run_names = [ \
+    'IVF1024,PQ16', \
+    'IVF2048,PQ16', \
+    'IVF4096,PQ16', \
+    'IVF8192,PQ16', \
+    'IVF16384,PQ16', \
+    'IVF32768,PQ16', \
+    'IVF65536,PQ16', \
+    'IVF131072,PQ16', \
+    'IVF262144,PQ16', \
+    'OPQ16,IVF1024,PQ16', \
+    'OPQ16,IVF2048,PQ16', \
+    'OPQ16,IVF4096,PQ16', \
+    'OPQ16,IVF8192,PQ16', \
+    'OPQ16,IVF16384,PQ16', \
+    'OPQ16,IVF32768,PQ16', \
+    'OPQ16,IVF65536,PQ16', \
+    'OPQ16,IVF131072,PQ16', \
+    'OPQ16,IVF262144,PQ16']
+
+assert len(run_names) == len(path_prefixes)
+time_ranges = [get_search_window(path_prefixes[i], logname, run_names[i]) for i in range(len(path_prefixes))]
 
 # Stage 1: OPQ
 # Stage 2: vector quantizer
@@ -104,12 +87,8 @@ profile_perc_array = []
 #     [32.7008185883583, 0.5164703077320218, 4.674772663594282, 33.70847203114799, 28.399466409167403]
 #     ]
 
-for i in range(len(path_prefixes)): 
-    print("Processing {}".format(path_prefixes[i]))
-    all_events = group_perf_by_events(path_prefixes[i])
-    time_bias_start, time_bias_end = time_ranges[i][0], time_ranges[i][1]
-    filtered_events = filter_events_after_timestamp(all_events, time_bias_start, time_bias_end)
-    t_1_4, t_5, t_6, t_other = classify_events_by_stages(filtered_events, track_non_faiss_func=False)
+stage_time_array = classify_perf_files_by_stages(path_prefixes, time_ranges, track_non_faiss_func=False, use_cache=True)
+for t_1_4, t_5, t_6, t_other in stage_time_array: 
     p_1_4, p_5, p_6, p_other = get_percentage(t_1_4, t_5, t_6, t_other)
     profile_perc_array.append([p_1_4, p_5, p_6, p_other])
 
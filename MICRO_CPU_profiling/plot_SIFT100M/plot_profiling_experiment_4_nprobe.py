@@ -4,8 +4,7 @@ import numpy as np
 
 import os
 
-from analyze_perf import group_perf_by_events, filter_events_after_timestamp, \
-    classify_events_by_stages, get_percentage
+from analyze_perf import classify_perf_files_by_stages, get_percentage, get_search_window
 from profiling_stages import draw_profiling_plot
 
 
@@ -44,26 +43,20 @@ for p in file_prefixes:
     path_prefixes.append(os.path.join('../result_experiment_4_nprobe', p))
 
 
-# time range of the search function, according to the search log, e.g.,
-    # time_bias_start = 135.656
-    # time_bias_end = 200.659
-time_ranges = [ # pair of (time_bias_start, time_bias_end)
-    # ==== nprobe=1 ====
-    (6.665, 9.752),
-    # ==== nprobe=2 ====
-    (6.615, 9.916),
-    # ==== nprobe=4 ====
-    (6.752, 11.596),
-    # ==== nprobe=8 ====
-    (6.745, 13.163),
-    # ==== nprobe=16 ====
-    (6.759, 19.137),
-    # ==== nprobe=32 ====
-    (6.817, 20.488),
-    # ==== nprobe=64 ====
-    (6.734, 33.639),
-    # ==== nprobe=128 ====
-    (6.768, 40.520)]
+# search window of each run, read from the search log of the experiment (see get_search_window)
+logname = os.path.join('../result_experiment_4_nprobe', 'out_SIFT100M_OPQ16,IVF65536,PQ16_qbs_10000')
+run_names = [ \
+    'nprobe=1', \
+    'nprobe=2', \
+    'nprobe=4', \
+    'nprobe=8', \
+    'nprobe=16', \
+    'nprobe=32', \
+    'nprobe=64', \
+    'nprobe=128']
+
+assert len(run_names) == len(path_prefixes)
+time_ranges = [get_search_window(path_prefixes[i], logname, run_names[i]) for i in range(len(path_prefixes))]
 
 # Stage 1: OPQ
 # Stage 2: vector quantizer
@@ -80,12 +73,8 @@ profile_perc_array = []
 #     [32.7008185883583, 0.5164703077320218, 4.674772663594282, 33.70847203114799, 28.399466409167403]
 #     ]
 
-for i in range(len(path_prefixes)): 
-    print("Processing {}".format(path_prefixes[i]))
-    all_events = group_perf_by_events(path_prefixes[i])
-    time_bias_start, time_bias_end = time_ranges[i][0], time_ranges[i][1]
-    filtered_events = filter_events_after_timestamp(all_events, time_bias_start, time_bias_end)
-    t_1_4, t_5, t_6, t_other = classify_events_by_stages(filtered_events, track_non_faiss_func=False, remove_unrecognized_faiss_function=False)
+stage_time_array = classify_perf_files_by_stages(path_prefixes, time_ranges, track_non_faiss_func=False, remove_unrecognized_faiss_function=False, use_cache=True)
+for t_1_4, t_5, t_6, t_other in stage_time_array: 
     p_1_4, p_5, p_6, p_other = get_percentage(t_1_4, t_5, t_6, t_other)
     profile_perc_array.append([p_1_4, p_5, p_6, p_other])
 
@@ -16,10 +16,12 @@ class CombinedIndex:
     masks part of those lists
     adds these inverted lists to an empty index that contains
     the info on how to perform searches
+    if cache_size > 0, the lists are accessed through a RAM cache of
+    that many bytes
     """
 
     def __init__(self, invlist_fnames, empty_index_fname,
-                 masked_index_fname=None):
+                 masked_index_fname=None, cache_size=0):
 
         self.indexes = indexes = []
         ilv = faiss.InvertedListsPtrVector()
@@ -46,6 +48,13 @@ class CombinedIndex:
                 faiss.extract_index_ivf(self.masked_index).invlists,
                 self.big_il_base)
 
+        self.cached_il = None
+        if cache_size > 0:
+            print('caching lists in %d bytes' % cache_size)
+            self.cached_il = faiss.CachedInvertedLists(
+                self.big_il, cache_size)
+            self.big_il = self.cached_il
+
         print('loading empty index', empty_index_fname)
         self.index = faiss.read_index(empty_index_fname)
         ntotal = self.big_il.compute_ntotal()
@@ -143,10 +152,25 @@ class CombinedIndex:
     def set_omp_num_threads(self, nt):
         faiss.omp_set_num_threads(nt)
 
+    def get_cache_stats(self):
+        if self.cached_il is None:
+            return None
+        stats = self.cached_il.stats
+        return {
+            'nhit': stats.nhit, 'nmiss': stats.nmiss,
+            'nadmit': stats.nadmit, 'nreject': stats.nreject,
+            'nevict': stats.nevict, 'bytes_loaded': stats.bytes_loaded,
+            'cache_size': self.cached_il.cache_size()
+        }
+
+    def pin_lists(self, list_nos):
+        list_nos = np.ascontiguousarray(list_nos, dtype='int64')
+        self.cached_il.pin_lists(len(list_nos), faiss.swig_ptr(list_nos))
+
 class CombinedIndexDeep1B(CombinedIndex):
     """ loads a CombinedIndex with the data from the big photodna index """
 
-    def __init__(self):
+    def __init__(self, cache_size=0):
         # set some paths
         workdir = "/checkpoint/matthijs/ondisk_distributed/"
 
@@ -159,7 +183,8 @@ class CombinedIndexDeep1B(CombinedIndex):
             '%s/hslices/slice%d.faissindex' % (workdir, i)
             for i in range(50)
         ]
-        CombinedIndex.__init__(self, invlist_fnames, indexfname, masked_index_fname)
+        CombinedIndex.__init__(self, invlist_fnames, indexfname,
+                               masked_index_fname, cache_size)
 
 
 def ivecs_read(fname):
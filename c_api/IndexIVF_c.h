@@ -143,8 +143,13 @@ typedef struct FaissIndexIVFStats {
     size_t nlist;             // nb of inverted lists scanned
     size_t ndis;              // nb of distances computed
     size_t nheap_updates;     // nb of times the heap was updated
+    size_t nprobe_skipped;    // nb of probes skipped by the adaptive nprobe
     double quantization_time; // time spent quantizing vectors (in ms)
     double search_time;       // time spent searching lists (in ms)
+    uint64_t quantization_cycles; // coarse quantizer + nprobe selection
+    uint64_t lut_cycles;          // scanner set_query / set_list (tables)
+    uint64_t scan_cycles;         // scanning the codes of inverted lists
+    uint64_t heap_cycles;         // result heap init, merge and reorder
 } FaissIndexIVFStats;
 
 void faiss_IndexIVFStats_reset(FaissIndexIVFStats* stats);
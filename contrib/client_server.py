@@ -3,24 +3,149 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-from multiprocessing.dummy import Pool as ThreadPool
+import asyncio
+import collections
+import heapq
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future, as_completed
 import faiss
+import numpy as np
 from typing import List, Tuple
 
 from . import rpc
+from .inspect_tools import get_invlist_sizes
+from .ivf_tools import apply_pre_transforms
 
 ############################################################
 # Server implementation
 ############################################################
 
 
+class SearchBatcher:
+    """
+    Coalesces concurrent search requests into single index.search calls.
+
+    A batch is started by the first pending request, and closed after
+    max_wait_ms (latency knob) or when it reaches max_batch_size queries
+    (throughput knob). It is searched with the largest k of its requests,
+    and the results are split back. Requests come from concurrent threads,
+    eg. the workers of a SearchServer: a batch cannot be larger than the nb
+    of requests in flight.
+    """
+
+    def __init__(self, index: faiss.Index, max_batch_size: int = 256,
+                 max_wait_ms: float = 1.0):
+        self.index = index
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.queue = queue.Queue()
+        self.stats_lock = threading.Lock()
+        # requests submitted and not answered yet (including the batch
+        # being formed or searched)
+        self.queue_depth = 0
+        self.reset_stats()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def reset_stats(self) -> None:
+        with self.stats_lock:
+            self.n_requests = 0
+            self.n_batches = 0
+            self.n_queries = 0
+            self.max_queue_depth = 0
+            self.sum_queue_depth = 0
+
+    def get_stats(self) -> dict:
+        with self.stats_lock:
+            return {
+                'n_requests': self.n_requests,
+                'n_batches': self.n_batches,
+                'n_queries': self.n_queries,
+                'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'mean_queue_depth':
+                    self.sum_queue_depth / max(self.n_requests, 1),
+                'mean_batch_size': self.n_queries / max(self.n_batches, 1),
+            }
+
+    def search(self, x, k: int):
+        """ blocks until the batch of this request is searched """
+        assert x.ndim == 2 and x.shape[1] == self.index.d
+        fut = Future()
+        with self.stats_lock:
+            self.queue_depth += 1
+            self.n_requests += 1
+            self.sum_queue_depth += self.queue_depth
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        self.queue.put((x, k, fut))
+        try:
+            return fut.result()
+        finally:
+            with self.stats_lock:
+                self.queue_depth -= 1
+
+    def stop(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self) -> None:
+        stop = False
+        while not stop:
+            req = self.queue.get()
+            if req is None:
+                break
+            batch = [req]
+            nq = len(req[0])
+            deadline = time.time() + self.max_wait_ms / 1000
+            while nq < self.max_batch_size:
+                try:
+                    req = self.queue.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if req is None:
+                    stop = True
+                    break
+                batch.append(req)
+                nq += len(req[0])
+            self.search_batch(batch)
+
+    def search_batch(self, batch) -> None:
+        try:
+            kmax = max(k for _, k, _ in batch)
+            if len(batch) == 1:
+                x = batch[0][0]
+            else:
+                x = np.vstack([x for x, _, _ in batch])
+            D, I = self.index.search(x, kmax)
+        except Exception as e:
+            for _, _, fut in batch:
+                fut.set_exception(e)
+            return
+        with self.stats_lock:
+            self.n_batches += 1
+            self.n_queries += len(x)
+        i0 = 0
+        for xi, k, fut in batch:
+            i1 = i0 + len(xi)
+            # the top-k results are the first ones of the top-kmax
+            fut.set_result((np.ascontiguousarray(D[i0:i1, :k]),
+                            np.ascontiguousarray(I[i0:i1, :k])))
+            i0 = i1
+
+
 class SearchServer(rpc.Server):
     """ Assign version that can be exposed via RPC """
 
-    def __init__(self, s: int, index: faiss.Index):
-        rpc.Server.__init__(self, s)
+    def __init__(self, s: int, index: faiss.Index, n_workers: int = 1,
+                 batcher: SearchBatcher = None):
+        rpc.Server.__init__(self, s, n_workers=n_workers)
         self.index = index
         self.index_ivf = faiss.extract_index_ivf(index)
+        # optional, shared by the connections
+        self.batcher = batcher
 
     def set_nprobe(self, nprobe: int) -> int:
         """ set nprobe field """
@@ -29,63 +154,456 @@ class SearchServer(rpc.Server):
     def get_ntotal(self) -> int:
         return self.index.ntotal
 
+    def set_omp_num_threads(self, nt: int) -> None:
+        faiss.omp_set_num_threads(nt)
+
+    def get_nprobe(self) -> int:
+        return self.index_ivf.nprobe
+
+    def get_coarse_quantizer(self) -> np.ndarray:
+        """ the pre-transforms and coarse quantizer of the index, serialized
+        as an IndexPreTransform (or just the quantizer if there are no
+        pre-transforms) """
+        quantizer = self.index_ivf.quantizer
+        if not isinstance(self.index, faiss.IndexPreTransform):
+            return faiss.serialize_index(quantizer)
+        coarse = faiss.IndexPreTransform(quantizer)
+        for i in range(self.index.chain.size()):
+            coarse.chain.push_back(self.index.chain.at(i))
+        return faiss.serialize_index(coarse)
+
+    def get_nonempty_lists(self) -> np.ndarray:
+        """ the list numbers of the non-empty inverted lists """
+        return np.flatnonzero(get_invlist_sizes(self.index_ivf.invlists))
+
+    def search_preassigned(self, x, k: int, Iq, Dq):
+        """ search with the coarse quantization done by the client: x are
+        the transformed queries, Iq and Dq their list numbers (-1 = none) and
+        coarse distances """
+        n = len(x)
+        x = np.ascontiguousarray(x, dtype='float32')
+        Iq = np.ascontiguousarray(Iq, dtype='int64')
+        Dq = np.ascontiguousarray(Dq, dtype='float32')
+        assert Iq.shape == Dq.shape and Iq.shape[0] == n
+        params = faiss.IVFSearchParameters()
+        params.nprobe = Iq.shape[1]
+        D = np.empty((n, k), dtype='float32')
+        I = np.empty((n, k), dtype='int64')
+        sp = faiss.swig_ptr
+        self.index_ivf.search_preassigned(
+            n, sp(x), k, sp(Iq), sp(Dq), sp(D), sp(I), False, params)
+        return D, I
+
+    def search(self, x, k: int):
+        if self.batcher is None:
+            return self.index.search(x, k)
+        return self.batcher.search(x, k)
+
+    def get_batcher_stats(self) -> dict:
+        """ queue depth and batch size metrics, None without batching """
+        if self.batcher is None:
+            return None
+        return self.batcher.get_stats()
+
     def __getattr__(self, f):
         # all other functions get forwarded to the index
         return getattr(self.index, f)
 
 
-def run_index_server(index: faiss.Index, port: int, v6: bool = False):
-    """ serve requests for that index forerver """
+def make_batcher(index: faiss.Index, max_batch_size: int,
+                 max_wait_ms: float) -> SearchBatcher:
+    if max_batch_size <= 0:
+        return None
+    return SearchBatcher(index, max_batch_size, max_wait_ms)
+
+
+def run_index_server(index: faiss.Index, port: int, v6: bool = False,
+                     n_workers: int = 1, max_batch_size: int = 0,
+                     max_wait_ms: float = 1.0):
+    """ serve requests for that index forerver. Each connection runs its
+    requests on n_workers threads. With max_batch_size > 0, the concurrent
+    searches are batched, see SearchBatcher """
+    batcher = make_batcher(index, max_batch_size, max_wait_ms)
     rpc.run_server(
-        lambda s: SearchServer(s, index),
+        lambda s: SearchServer(s, index, n_workers, batcher),
         port, v6=v6)
 
 
+def run_index_server_async(index: faiss.Index, port: int, v6: bool = False,
+                           n_workers: int = 1, max_batch_size: int = 0,
+                           max_wait_ms: float = 1.0):
+    """ serve requests for that index forever from an asyncio event loop """
+    batcher = make_batcher(index, max_batch_size, max_wait_ms)
+    asyncio.run(rpc.run_server_async(
+        lambda s: SearchServer(s, index, batcher=batcher),
+        port, v6=v6, n_workers=n_workers))
+
+
 ############################################################
 # Client implementation
 ############################################################
 
+class HedgeTimer:
+    """ runs callbacks at given times, from a single thread """
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def call_at(self, t: float, callback) -> None:
+        with self.cond:
+            heapq.heappush(self.heap, (t, next(self.counter), callback))
+            self.cond.notify()
+
+    def run(self) -> None:
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.cond.wait(
+                        self.heap[0][0] - time.time() if self.heap else None)
+                _, _, callback = heapq.heappop(self.heap)
+            callback()
+
+
+class ReplicaGroup:
+    """
+    Replicas of one sub-index. A request goes to the replica with the
+    lowest recent median latency. If it did not return after the
+    hedge_percentile of the recent latencies of the group (and at least
+    min_hedge_delay_ms), a duplicate is sent to the next replica, and so on.
+    The first result wins, the other requests are cancelled.
+    """
+
+    def __init__(self, clients: List[rpc.Client], timer: HedgeTimer,
+                 hedge_percentile: float = 95.0,
+                 min_hedge_delay_ms: float = 1.0, history: int = 100):
+        self.clients = clients
+        self.timer = timer
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay_ms = min_hedge_delay_ms
+        # recent latencies per replica, in s. The requests that lost to a
+        # hedge count with their time until the winner returned
+        self.latencies = [collections.deque(maxlen=history) for _ in clients]
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.n_hedges = 0     # nb of duplicate requests sent
+
+    def replica_order(self) -> List[int]:
+        with self.lock:
+            median = [np.median(l) if l else 0.0 for l in self.latencies]
+        return sorted(range(len(self.clients)), key=median.__getitem__)
+
+    def hedge_delay(self) -> float:
+        with self.lock:
+            recent = [t for l in self.latencies for t in l]
+        delay = np.percentile(recent, self.hedge_percentile) if recent else 0
+        return max(delay, self.min_hedge_delay_ms / 1000)
+
+    def broadcast(self, fname, *args) -> list:
+        """ call a method on all replicas """
+        futures = [client.submit(fname, *args) for client in self.clients]
+        return [fut.result() for fut in futures]
+
+    def submit(self, fname, *args) -> Future:
+        result = Future()
+        order = self.replica_order()
+        attempts = []     # (replica no, t0, Future) of the requests sent
+        lock = threading.Lock()
+
+        def send():
+            with lock:
+                if result.done() or len(attempts) == len(order):
+                    return False
+                i = order[len(attempts)]
+                fut = self.clients[i].submit(fname, *args)
+                attempts.append((i, time.time(), fut))
+            fut.add_done_callback(on_done)
+            return True
+
+        def on_done(fut):
+            if fut.cancelled():
+                return
+            with lock:
+                if result.done():
+                    return
+                if fut.exception() is not None:
+                    # try the next replica, fail if there is none
+                    retry = all(f.done() for _, _, f in attempts)
+                    if retry and len(attempts) == len(order):
+                        result.set_exception(fut.exception())
+                        return
+                else:
+                    retry = False
+                    t1 = time.time()
+                    with self.lock:
+                        for i, t0, f in attempts:
+                            if f is fut or not f.done():
+                                self.latencies[i].append(t1 - t0)
+                    for i, _, f in attempts:
+                        if f is not fut:
+                            self.clients[i].cancel(f)
+                    result.set_result(fut.result())
+            if retry:
+                send()
+
+        def hedge():
+            if send():
+                with self.lock:
+                    self.n_hedges += 1
+                self.timer.call_at(time.time() + delay, hedge)
+
+        with self.lock:
+            self.n_requests += 1
+        send()
+        if len(order) > 1:
+            delay = self.hedge_delay()
+            self.timer.call_at(time.time() + delay, hedge)
+        return result
+
+
+class ProbeRouter:
+    """
+    Coarse quantization of the queries on the client, and routing of the
+    probes to the sub-indexes. A sub-index receives only the queries that
+    probe one of its non-empty lists, with only the probes of those lists,
+    so a search sends each query to the sub-indexes that hold its lists
+    rather than to all of them.
+    """
+
+    def __init__(self, coarse_index: faiss.Index, nonempty_lists: List):
+        """ coarse_index is the quantizer, possibly in an IndexPreTransform
+        with the pre-transforms, nonempty_lists the list numbers of the
+        non-empty inverted lists of each sub-index """
+        self.coarse_index = coarse_index
+        self.owned = np.zeros((len(nonempty_lists), coarse_index.ntotal),
+                              dtype=bool)
+        for no, lists in enumerate(nonempty_lists):
+            self.owned[no, lists] = True
+
+    def quantize(self, x, nprobe: int):
+        """ returns the transformed queries, list numbers and coarse
+        distances """
+        coarse_index = self.coarse_index
+        if isinstance(coarse_index, faiss.IndexPreTransform):
+            x = apply_pre_transforms(coarse_index, x)
+            coarse_index = faiss.downcast_index(coarse_index.index)
+        Dq, Iq = coarse_index.search(x, nprobe)
+        return x, Iq, Dq
+
+    def route(self, Iq, Dq) -> list:
+        """ returns for each sub-index the rows of the queries it receives
+        and their list numbers and coarse distances, restricted to the lists
+        of the sub-index (padded with -1), or None if there are no such
+        queries """
+        routes = []
+        for owned in self.owned:
+            mask = (Iq >= 0) & owned[np.maximum(Iq, 0)]
+            rows = np.flatnonzero(mask.any(axis=1))
+            if len(rows) == 0:
+                routes.append(None)
+                continue
+            mask = mask[rows]
+            # the probes of the sub-index first, in order of coarse distance
+            order = np.argsort(~mask, axis=1, kind='stable')
+            order = order[:, :mask.sum(axis=1).max()]
+            Iqs = np.take_along_axis(Iq[rows], order, axis=1)
+            Dqs = np.take_along_axis(Dq[rows], order, axis=1)
+            Iqs[~np.take_along_axis(mask, order, axis=1)] = -1
+            routes.append((rows, Iqs, Dqs))
+        return routes
+
+
+def expand_rows(nq: int, rows, D, I):
+    """ results for nq queries from those of the queries in rows (the other
+    queries have no results) """
+    if rows is None:
+        return D, I
+    Dfull = np.full((nq, D.shape[1]), np.inf, dtype='float32')
+    Ifull = np.full((nq, D.shape[1]), -1, dtype='int64')
+    Dfull[rows] = D
+    Ifull[rows] = I
+    return Dfull, Ifull
+
+
 class ClientIndex:
     """manages a set of distance sub-indexes. The sub_indexes search a
-    subset of the inverted lists. Searches are merged afterwards
+    subset of the inverted lists. Searches are merged afterwards.
+
+    The requests to the sub-indexes are pipelined: a search is cut in
+    batches of batch_size queries that are all sent at once, and the
+    partial results are merged as they arrive.
+
+    Each sub-index can be served by a group of replicas, the requests are
+    then hedged over the replicas, see ReplicaGroup.
+
+    With enable_coarse_quantization, the pre-transforms and the coarse
+    quantizer run once on the client, instead of once per sub-index, and
+    the queries are sent only to the sub-indexes that hold their lists, see
+    ProbeRouter. This requires that the sub-indexes share them.
     """
 
-    def __init__(self, machine_ports: List[Tuple[str, int]], v6: bool = False):
-        """ connect to a series of (host, port) pairs """
+    def __init__(self, machine_ports: List, v6: bool = False,
+                 batch_size: int = 0, hedge_percentile: float = 95.0,
+                 min_hedge_delay_ms: float = 1.0):
+        """ connect to a series of (host, port) pairs, or of lists of
+        (host, port) pairs for replicated sub-indexes """
+        self.timer = HedgeTimer()
         self.sub_indexes = []
-        for machine, port in machine_ports:
-            self.sub_indexes.append(rpc.Client(machine, port, v6))
+        for replicas in machine_ports:
+            if isinstance(replicas[0], str):
+                replicas = [replicas]
+            clients = [rpc.Client(machine, port, v6)
+                       for machine, port in replicas]
+            self.sub_indexes.append(ReplicaGroup(
+                clients, self.timer, hedge_percentile, min_hedge_delay_ms))
 
         self.ni = len(self.sub_indexes)
-        # pool of threads. Each thread manages one sub-index.
-        self.pool = ThreadPool(self.ni)
+        self.batch_size = batch_size   # 0 = one batch per search
+        self.router = None
+        self.nprobe = None
         # test connection...
         self.ntotal = self.get_ntotal()
         self.verbose = False
 
+    def map_sub_indexes(self, fname, *args):
+        """ call a method on all sub-indexes in parallel """
+        futures = [idx.submit(fname, *args) for idx in self.sub_indexes]
+        return [fut.result() for fut in futures]
+
     def set_nprobe(self, nprobe: int) -> None:
-        self.pool.map(
-            lambda idx: idx.set_nprobe(nprobe),
-            self.sub_indexes
-        )
+        for idx in self.sub_indexes:
+            idx.broadcast('set_nprobe', nprobe)
+        self.nprobe = nprobe
+
+    def enable_coarse_quantization(self, coarse_index=None) -> None:
+        """ quantize the queries on the client. coarse_index is the
+        quantizer, possibly in an IndexPreTransform with the pre-transforms.
+        By default, it is fetched from the first sub-index. The non-empty
+        lists of the sub-indexes are fetched now: call again after adding
+        to them """
+        if coarse_index is None:
+            coarse_index = faiss.deserialize_index(
+                self.sub_indexes[0].submit('get_coarse_quantizer').result())
+        if self.nprobe is None:
+            self.nprobe = self.sub_indexes[0].submit('get_nprobe').result()
+        self.router = ProbeRouter(
+            coarse_index, self.map_sub_indexes('get_nonempty_lists'))
 
     def set_omp_num_threads(self, nt: int) -> None:
-        self.pool.map(
-            lambda idx: idx.set_omp_num_threads(nt),
-            self.sub_indexes
-        )
+        for idx in self.sub_indexes:
+            idx.broadcast('set_omp_num_threads', nt)
 
     def get_ntotal(self) -> None:
-        return sum(self.pool.map(
-            lambda idx: idx.get_ntotal(),
-            self.sub_indexes
-        ))
+        return sum(self.map_sub_indexes('get_ntotal'))
 
     def search(self, x, k: int):
+        nq = x.shape[0]
+        bs = self.batch_size or max(nq, 1)
 
-        rh = faiss.ResultHeap(x.shape[0], k)
+        futures = {}    # -> (heap no, rows of the queries sent)
+        heaps = []
+        for i0 in range(0, max(nq, 1), bs):
+            xb = x[i0:i0 + bs]
+            heaps.append(faiss.ResultHeap(xb.shape[0], k))
+            if self.router is None:
+                for idx in self.sub_indexes:
+                    fut = idx.submit('search', xb, k)
+                    futures[fut] = len(heaps) - 1, None
+                continue
+            xt, Iq, Dq = self.router.quantize(xb, self.nprobe)
+            routes = self.router.route(Iq, Dq)
+            for idx, route in zip(self.sub_indexes, routes):
+                if route is not None:
+                    rows, Iqs, Dqs = route
+                    fut = idx.submit(
+                        'search_preassigned', xt[rows], k, Iqs, Dqs)
+                    futures[fut] = len(heaps) - 1, rows
+
+        for fut in as_completed(futures):
+            hno, rows = futures[fut]
+            Di, Ii = expand_rows(heaps[hno].nq, rows, *fut.result())
+            heaps[hno].add_result(Di, Ii)
+
+        for rh in heaps:
+            rh.finalize()
+        if len(heaps) == 1:
+            return heaps[0].D, heaps[0].I
+        return (np.vstack([rh.D for rh in heaps]),
+                np.vstack([rh.I for rh in heaps]))
+
+
+class AsyncClientIndex:
+    """asyncio version of ClientIndex. It keeps one connection per
+    sub-index, and any number of searches can run concurrently from the
+    event loop. The partial results of a search are merged as they arrive.
+    Create with AsyncClientIndex.connect.
+    """
 
-        for Di, Ii in self.pool.imap(lambda idx: idx.search(x, k), self.sub_indexes):
+    def __init__(self, sub_indexes: List[rpc.AsyncClient]):
+        self.sub_indexes = sub_indexes
+        self.ni = len(sub_indexes)
+        self.ntotal = None
+        self.router = None
+        self.nprobe = None
+
+    @classmethod
+    async def connect(cls, machine_ports: List[Tuple[str, int]],
+                      v6: bool = False):
+        """ connect to a series of (host, port) pairs """
+        sub_indexes = await asyncio.gather(*[
+            rpc.AsyncClient.connect(machine, port, v6)
+            for machine, port in machine_ports
+        ])
+        self = cls(list(sub_indexes))
+        self.ntotal = await self.get_ntotal()
+        return self
+
+    async def set_nprobe(self, nprobe: int) -> None:
+        await asyncio.gather(*[
+            idx.call('set_nprobe', nprobe) for idx in self.sub_indexes])
+        self.nprobe = nprobe
+
+    async def enable_coarse_quantization(self, coarse_index=None) -> None:
+        """ see ClientIndex.enable_coarse_quantization """
+        if coarse_index is None:
+            coarse_index = faiss.deserialize_index(
+                await self.sub_indexes[0].call('get_coarse_quantizer'))
+        if self.nprobe is None:
+            self.nprobe = await self.sub_indexes[0].call('get_nprobe')
+        self.router = ProbeRouter(coarse_index, await asyncio.gather(*[
+            idx.call('get_nonempty_lists') for idx in self.sub_indexes]))
+
+    async def get_ntotal(self) -> int:
+        return sum(await asyncio.gather(*[
+            idx.call('get_ntotal') for idx in self.sub_indexes]))
+
+    async def search(self, x, k: int):
+        rh = faiss.ResultHeap(x.shape[0], k)
+        if self.router is None:
+            calls = [idx.call('search', x, k) for idx in self.sub_indexes]
+        else:
+            xt, Iq, Dq = self.router.quantize(x, self.nprobe)
+            calls = [
+                self.search_route(idx, xt, k, route)
+                for idx, route in zip(self.sub_indexes,
+                                      self.router.route(Iq, Dq))
+                if route is not None
+            ]
+        for res in asyncio.as_completed(calls):
+            Di, Ii = await res
             rh.add_result(Di, Ii)
         rh.finalize()
         return rh.D, rh.I
+
+    @staticmethod
+    async def search_route(idx: rpc.AsyncClient, xt, k: int, route):
+        rows, Iqs, Dqs = route
+        D, I = await idx.call('search_preassigned', xt[rows], k, Iqs, Dqs)
+        return expand_rows(len(xt), rows, D, I)
+
+    async def close(self) -> None:
+        for idx in self.sub_indexes:
+            await idx.close()
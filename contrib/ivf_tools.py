@@ -3,6 +3,9 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import json
+import os
+
 import numpy as np
 import faiss
 
@@ -89,3 +92,181 @@ def range_search_preassigned(index_ivf, x, radius, list_nos, coarse_dis=None):
     dist = faiss.rev_swig_ptr(res.distances, num_results).copy()
     indices = faiss.rev_swig_ptr(res.labels, num_results).copy()
     return lims, dist, indices
+
+
+def apply_pre_transforms(index, x):
+    """
+    Apply the vector transforms of an IndexPreTransform (if any) to the queries
+    """
+    if isinstance(index, faiss.IndexPreTransform):
+        for i in range(index.chain.size()):
+            vt = faiss.downcast_VectorTransform(index.chain.at(i))
+            x = vt.apply_py(x)
+    return x
+
+
+def learn_coarse_dis_ratio(index, xq, k, nprobe, quantile=0.95):
+    """
+    Learn the IVFSearchParameters.coarse_dis_ratio that keeps the exact
+    top-k results (those at the given nprobe) of a fraction quantile of
+    the training queries xq.
+
+    For each query, the ratio needed is the coarse distance of the
+    farthest list that contains one of its top-k results, divided by the
+    coarse distance of its nearest list. The queries for which the search
+    does not apply the ratio (nearest coarse distance below 1/1000 of the
+    second nearest one) need no ratio.
+    """
+    index_ivf = faiss.extract_index_ivf(index)
+    assert index_ivf.metric_type == faiss.METRIC_L2
+    xq = np.ascontiguousarray(apply_pre_transforms(index, xq), dtype='float32')
+    n = len(xq)
+    coarse_dis, list_nos = index_ivf.quantizer.search(xq, nprobe)
+
+    # with store_pairs, the labels are (list_no << 32 | offset)
+    D = np.empty((n, k), dtype='float32')
+    I = np.empty((n, k), dtype='int64')
+    params = faiss.IVFSearchParameters()
+    params.nprobe = nprobe
+    sp = faiss.swig_ptr
+    index_ivf.search_preassigned(
+        n, sp(xq), k, sp(list_nos), sp(coarse_dis), sp(D), sp(I), True,
+        params)
+
+    result_lists = np.where(I >= 0, I >> 32, -1)
+    ranks = (list_nos[:, None, :] == result_lists[:, :, None]).argmax(axis=2)
+    last_rank = ranks.max(axis=1)
+    needed = (coarse_dis[np.arange(n), last_rank] /
+              np.maximum(coarse_dis[:, 0], 1e-30))
+    if nprobe > 1:
+        needed[coarse_dis[:, 0] <= 1e-3 * coarse_dis[:, 1]] = 1
+    return float(np.quantile(needed, quantile))
+
+
+class NprobeSolver:
+    """
+    Find the minimum nprobe for which an IVF index reaches a recall goal,
+    measured on queries with known ground-truth.
+
+    The recall is the n-recall@k of the ground-truth nearest neighbor (as in
+    demos/bigann_search.cpp), assumed non-decreasing in nprobe, so the minimum
+    nprobe is found by a galloping search (nprobe = 1, 2, 4, ... until the
+    goal is reached, then a binary search in the last interval). The coarse
+    assignment of the queries is extended on demand to the next power of 2
+    of the largest nprobe tried, a smaller nprobe searches the first columns
+    of that assignment, and the rank of the ground-truth neighbor is memoized
+    per nprobe, so that all (k, recall goal) pairs share the searches.
+    The results of each nprobe searched are kept (12 * nq * max_k bytes
+    each): searching a larger nprobe only scans the lists beyond the largest
+    nprobe already searched and merges them into its results.
+    """
+
+    def __init__(self, index, xq, gt, max_k=100, max_nprobe=None):
+        self.index = index    # keeps the IVF index alive
+        self.index_ivf = faiss.extract_index_ivf(index)
+        self.xq = np.ascontiguousarray(
+            apply_pre_transforms(index, xq), dtype='float32')
+        self.gt_nn = gt[:, 0] if gt.ndim == 2 else gt
+        assert self.gt_nn.shape == (len(xq), )
+        self.max_k = max_k
+        # the coarse assignment takes 12 * nq * nprobe bytes, so by default
+        # the search does not go beyond 4096 lists
+        self.max_nprobe = min(max_nprobe or 4096, self.index_ivf.nlist)
+        self.coarse_dis = self.list_nos = None
+        self.ranks = {}    # nprobe -> rank of the ground-truth nn per query
+        self.results = {}  # nprobe -> (D, I) of the search at that nprobe
+
+    def assign(self, nprobe):
+        """ make sure the coarse assignment covers nprobe lists """
+        assert 1 <= nprobe <= self.max_nprobe
+        if self.list_nos is None or self.list_nos.shape[1] < nprobe:
+            n = min(1 << (nprobe - 1).bit_length(), self.max_nprobe)
+            self.coarse_dis, self.list_nos = self.index_ivf.quantizer.search(
+                self.xq, n)
+
+    def get_ranks(self, nprobe):
+        """ rank of the ground-truth nearest neighbor in the results
+        (max_k if not found) """
+        if nprobe not in self.ranks:
+            self.assign(nprobe)
+            # restart from the largest nprobe already searched below this one
+            nprobe1 = max([p for p in self.results if p < nprobe], default=0)
+            index_ivf = self.index_ivf
+            nprobe0 = index_ivf.nprobe
+            index_ivf.nprobe = nprobe - nprobe1
+            try:
+                D, I = search_preassigned(
+                    index_ivf, self.xq, self.max_k,
+                    np.ascontiguousarray(self.list_nos[:, nprobe1:nprobe]),
+                    np.ascontiguousarray(self.coarse_dis[:, nprobe1:nprobe]))
+            finally:
+                index_ivf.nprobe = nprobe0
+            if nprobe1 > 0:
+                rh = faiss.ResultHeap(
+                    len(self.xq), self.max_k,
+                    keep_max=index_ivf.metric_type == faiss.METRIC_INNER_PRODUCT)
+                rh.add_result(*self.results[nprobe1])
+                rh.add_result(D, I)
+                rh.finalize()
+                D, I = rh.D, rh.I
+            self.results[nprobe] = D, I
+            found = I == self.gt_nn[:, None]
+            self.ranks[nprobe] = np.where(
+                found.any(axis=1), found.argmax(axis=1), self.max_k)
+        return self.ranks[nprobe]
+
+    def recall(self, nprobe, k):
+        assert k <= self.max_k
+        return (self.get_ranks(nprobe) < k).mean()
+
+    def min_nprobe(self, k, recall_goal):
+        """ minimum nprobe to reach the recall goal at k,
+        None if it is not reached at max_nprobe """
+        lo, hi = 1, 1
+        while self.recall(hi, k) < recall_goal:
+            if hi == self.max_nprobe:
+                return None
+            lo, hi = hi + 1, min(2 * hi, self.max_nprobe)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.recall(mid, k) >= recall_goal:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+
+def load_nprobe_table(fname):
+    """
+    Load a table of minimum nprobe written by save_nprobe_table, as a
+    dictionary d[dbname][index_key][topK][recall_goal] = nprobe
+    (None if the recall goal is not reachable)
+    """
+    with open(fname, 'r') as f:
+        records = json.load(f)
+    table = {}
+    for r in records:
+        table.setdefault(r['dbname'], {}).setdefault(
+            r['index_key'], {}).setdefault(
+            r['topK'], {})[r['recall_goal']] = r['nprobe']
+    return table
+
+
+def save_nprobe_table(fname, table):
+    """
+    Store a table of minimum nprobe as a JSON list of records (one per
+    line), written to a temporary file first so that readers never see a
+    partial table
+    """
+    records = [
+        {'dbname': dbname, 'index_key': index_key, 'topK': topK,
+         'recall_goal': recall_goal, 'nprobe': nprobe}
+        for dbname, d_index in table.items()
+        for index_key, d_topK in d_index.items()
+        for topK, d_recall in d_topK.items()
+        for recall_goal, nprobe in d_recall.items()
+    ]
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'w') as f:
+        f.write('[\n' + ',\n'.join(json.dumps(r) for r in records) + '\n]\n')
+    os.replace(tmp_fname, fname)
@@ -3,17 +3,38 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-from typing import List
+from typing import List, Optional
+from multiprocessing.pool import ThreadPool
 import faiss
+import json
 import logging
+import os
+import time
+import numpy as np
+
+from faiss.contrib.inspect_tools import get_invlist_sizes
+from faiss.contrib.ivf_tools import apply_pre_transforms
 
 LOG = logging.getLogger(__name__)
 
 def merge_ondisk(trained_index: faiss.Index,
                  shard_fnames: List[str],
-                 ivfdata_fname: str) -> None:
+                 ivfdata_fname: str,
+                 nthread: Optional[int] = None,
+                 chunk_size: int = 256 << 20,
+                 resume: bool = False) -> None:
     """ Add the contents of the indexes stored in shard_fnames into the index
-    trained_index. The on-disk data is stored in ivfdata_fname """
+    trained_index. The on-disk data is stored in ivfdata_fname
+
+    The sizes of all the merged lists are computed first, which fixes the
+    layout of ivfdata_fname. The file is then filled by nthread threads
+    (default: the nb of OpenMP threads), each writing chunks of about
+    chunk_size bytes of consecutive lists, read from all the shards.
+
+    The finished chunks are recorded in ivfdata_fname + ".progress". If the
+    merge is interrupted, calling merge_ondisk again with resume=True and
+    the same arguments copies only the remaining chunks.
+    """
     # merge the images into an on-disk index
     # first load the inverted lists
     ivfs = []
@@ -46,10 +67,177 @@ def merge_ondisk(trained_index: faiss.Index,
     for ivf in ivfs:
         ivf_vector.push_back(ivf)
 
-    LOG.info("merge %d inverted lists " % ivf_vector.size())
-    ntotal = invlists.merge_from(ivf_vector.data(), ivf_vector.size())
+    # the merged lists are packed in list order
+    entry_size = index_ivf.code_size + 8
+    list_bytes = sum(get_invlist_sizes(ivf) for ivf in ivfs) * entry_size
+
+    progress_fname = ivfdata_fname + ".progress"
+    header = {
+        "shards": list(shard_fnames),
+        "nlist": index_ivf.nlist,
+        "code_size": index_ivf.code_size,
+        "chunk_size": chunk_size,
+        "totsize": int(list_bytes.sum()),
+    }
+    done = set()
+    if resume and os.path.exists(progress_fname):
+        with open(progress_fname) as f:
+            # a last line without newline was torn by the interruption
+            lines = f.read().split("\n")[:-1]
+        if (lines and json.loads(lines[0]) == header and
+                os.path.exists(ivfdata_fname) and
+                os.path.getsize(ivfdata_fname) == header["totsize"]):
+            done = set(int(l) for l in lines[1:])
+        else:
+            LOG.warning("%s does not match the merge, restarting it" %
+                        progress_fname)
+
+    LOG.info("compute the layout of %d inverted lists" % ivf_vector.size())
+    ntotal = invlists.prepare_merge(
+        ivf_vector.data(), ivf_vector.size(), None, 0, 4096, len(done) > 0)
+    assert invlists.totsize == header["totsize"]
+
+    # group consecutive lists into chunks of about chunk_size bytes
+    chunk_no = np.cumsum(list_bytes) // max(chunk_size, 1)
+    bounds = np.flatnonzero(np.diff(chunk_no)) + 1
+    chunks = np.split(np.arange(index_ivf.nlist, dtype='int64'), bounds)
+
+    # start the progress file afresh, without the torn line if any
+    with open(progress_fname + ".tmp", "w") as f:
+        f.write(json.dumps(header) + "\n")
+        f.write("".join("%d\n" % c for c in sorted(done)))
+    os.replace(progress_fname + ".tmp", progress_fname)
+
+    todo = [c for c in range(len(chunks)) if c not in done]
+    LOG.info("merge %d entries in %d chunks, %d already done" % (
+        ntotal, len(chunks), len(chunks) - len(todo)))
+
+    def fill_chunk(c):
+        list_nos = chunks[c]
+        invlists.fill_lists_from(
+            ivf_vector.data(), ivf_vector.size(),
+            len(list_nos), faiss.swig_ptr(list_nos), True)
+        return c
+
+    t0 = time.time()
+    nbytes = 0
+    with open(progress_fname, "a") as progress, \
+            ThreadPool(nthread or faiss.omp_get_max_threads()) as pool:
+        for i, c in enumerate(pool.imap_unordered(fill_chunk, todo)):
+            progress.write("%d\n" % c)
+            progress.flush()
+            os.fsync(progress.fileno())
+            nbytes += list_bytes[chunks[c]].sum()
+            LOG.info("merged %d/%d chunks, %.3f GiB in %.1f s" % (
+                i + 1, len(todo), nbytes / (1 << 30), time.time() - t0))
+    os.remove(progress_fname)
 
     # now replace the inverted lists in the output index
     index.ntotal = index_ivf.ntotal = ntotal
     index_ivf.replace_invlists(invlists, True)
     invlists.this.disown()
+
+
+def probed_lists_from_queries(index: faiss.Index, xq, nprobe=None):
+    """ returns the (nq, nprobe) list numbers that a search of xq in index
+    visits, in the order they are probed. This can be used as a sample run
+    for rewrite_ondisk_layout when there is no log of the probed lists """
+    index_ivf = faiss.extract_index_ivf(index)
+    xq = np.ascontiguousarray(apply_pre_transforms(index, xq), dtype='float32')
+    _, list_nos = index_ivf.quantizer.search(xq, nprobe or index_ivf.nprobe)
+    return list_nos
+
+
+def compute_list_layout(probed_lists, nlist: int,
+                        hot_ratio=0.8, ncoaccess=8):
+    """ compute the order in which the inverted lists should be stored from
+    the lists probed by a set of queries.
+
+    probed_lists is a (nq, nprobe) array of list numbers in the order they
+    were probed (-1 = none). The hot lists are the most accessed ones that
+    account for hot_ratio of the accesses. They are stored first, then the
+    other lists by decreasing nb of accesses. Within both groups, the lists
+    are chained greedily: each list is followed by the unplaced list most
+    often probed together with it in the first ncoaccess probes of a query.
+
+    Returns the order (a permutation of the list numbers) and the nb of hot
+    lists at the start of it.
+    """
+    probed_lists = np.asarray(probed_lists, dtype='int64')
+    if probed_lists.ndim == 1:
+        probed_lists = probed_lists[:, None]
+    assert probed_lists.max(initial=-1) < nlist
+
+    freq = np.bincount(probed_lists[probed_lists >= 0], minlength=nlist)
+    by_freq = np.argsort(-freq, kind='stable')
+    cum_freq = np.cumsum(freq[by_freq])
+    n_hot = 0
+    if cum_freq[-1] > 0:
+        n_hot = int(np.searchsorted(cum_freq, hot_ratio * cum_freq[-1])) + 1
+        n_hot = min(n_hot, int((freq > 0).sum()))
+
+    # co-access counts of all pairs of lists, sorted by list then
+    # decreasing count
+    p = probed_lists[:, :ncoaccess]
+    a, b = p[:, :, None], p[:, None, :]
+    pairs = ((a * nlist + b)[(a >= 0) & (b >= 0) & (a != b)])
+    pairs, counts = np.unique(pairs, return_counts=True)
+    src, dst = pairs // nlist, pairs % nlist
+    o = np.lexsort((-counts, src))
+    src, dst = src[o], dst[o]
+    lims = np.searchsorted(src, np.arange(nlist + 1))
+
+    placed = np.zeros(nlist, dtype=bool)
+    order = []
+
+    def chain(group):
+        in_group = np.zeros(nlist, dtype=bool)
+        in_group[group] = True
+        for l in group:
+            while not placed[l]:
+                placed[l] = True
+                order.append(l)
+                for m in dst[lims[l]:lims[l + 1]]:
+                    if in_group[m] and not placed[m]:
+                        l = m
+                        break
+
+    chain(by_freq[:n_hot])
+    chain(by_freq[n_hot:])
+    return np.array(order, dtype='int64'), n_hot
+
+
+def rewrite_ondisk_layout(index: faiss.Index, ivfdata_fname: str,
+                          probed_lists, page_size=4096,
+                          hot_ratio=0.8, ncoaccess=8) -> None:
+    """ Copy the inverted lists of index to ivfdata_fname, laid out according
+    to the accesses in probed_lists (see compute_list_layout), so that lists
+    probed together are contiguous on disk. The hot lists are stored first,
+    each one starting on a page_size boundary. The inverted lists of index
+    are replaced with the new ones, the index should then be written with
+    write_index. ivfdata_fname cannot be the file the lists are read from.
+    """
+    index_ivf = faiss.extract_index_ivf(index)
+    src = faiss.downcast_InvertedLists(index_ivf.invlists)
+    if isinstance(src, faiss.CachedInvertedLists):
+        src = faiss.downcast_InvertedLists(src.il)
+    assert not (
+        isinstance(src, faiss.OnDiskInvertedLists) and
+        os.path.realpath(src.filename) == os.path.realpath(ivfdata_fname)
+    ), "cannot rewrite %s in place" % ivfdata_fname
+    order, n_hot = compute_list_layout(
+        probed_lists, index_ivf.nlist, hot_ratio, ncoaccess)
+
+    invlists = faiss.OnDiskInvertedLists(
+        index_ivf.nlist, index_ivf.code_size,
+        ivfdata_fname)
+
+    ivf_vector = faiss.InvertedListsPtrVector()
+    ivf_vector.push_back(index_ivf.invlists)
+
+    LOG.info("rewrite inverted lists with %d hot lists" % n_hot)
+    invlists.merge_from_ordered(
+        ivf_vector.data(), 1, faiss.swig_ptr(order), n_hot, page_size)
+
+    index_ivf.replace_invlists(invlists, True)
+    invlists.this.disown()
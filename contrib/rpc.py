@@ -7,10 +7,24 @@
 Simplistic RPC implementation.
 Exposes all functions of a Server object.
 
-Uses pickle for serialization and the socket interface.
+Uses pickle for serialization and the socket interface. Two wire formats
+are supported:
+- plain pickle streams
+- binary frames, where the arrays (eg. search queries and results) are sent
+  as raw buffers next to a small pickle of the rest of the message, and
+  received without copy into preallocated arrays. This is the default of
+  the Client, the server answers in the format of each request.
+
+AsyncClient and run_server_async are asyncio versions of the client and
+server, they use the binary frames.
 """
 
 import os,pdb,pickle,time,errno,sys,_thread,traceback,socket,threading,gc
+import struct
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
 
 import logging
 
@@ -74,8 +88,123 @@ class FileSock:
         while True:
             c=self.read(1)
             s+=c
-        if len(c)==0 or chr(c[0])=='\n':
-            return s
+            if len(c)==0 or chr(c[0])=='\n':
+                return s
+
+
+#########################################################################
+# binary wire format
+#
+# frame = header: magic, size of the pickled skeleton, nb of buffers
+#         buffer sizes (uint64 each)
+#         skeleton: the message pickled with protocol 5, with the arrays
+#                   replaced by out-of-band buffers
+#         raw buffers
+
+
+FRAME_MAGIC = b'FRPC'
+FRAME_HEADER = struct.Struct('<4sII')
+
+
+def sendmsg_all(sock, parts):
+    """ send a list of buffers with scatter/gather I/O """
+    parts = [memoryview(p).cast('B') for p in parts]
+    parts = [p for p in parts if len(p) > 0]
+    while parts:
+        sent = sock.sendmsg(parts[:512])
+        while parts and sent >= len(parts[0]):
+            sent -= len(parts[0])
+            parts.pop(0)
+        if sent > 0:
+            parts[0] = parts[0][sent:]
+
+
+def recv_into_all(sock, buf):
+    """ fill buf from the socket """
+    view = memoryview(buf).cast('B')
+    nr = 0
+    while nr < len(view):
+        r = sock.recv_into(view[nr:])
+        if r == 0:
+            raise EOFError("connection closed")
+        nr += r
+
+
+def frame_parts(obj):
+    """ the buffers that make up the frame of obj """
+    buffers = []
+    skeleton = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    raws = [b.raw() for b in buffers]
+    header = FRAME_HEADER.pack(FRAME_MAGIC, len(skeleton), len(raws))
+    sizes = struct.pack('<%dQ' % len(raws), *[r.nbytes for r in raws])
+    return [header + sizes, skeleton] + raws
+
+
+def send_frame(sock, obj):
+    sendmsg_all(sock, frame_parts(obj))
+
+
+def recv_frame(sock):
+    header = bytearray(FRAME_HEADER.size)
+    recv_into_all(sock, header)
+    magic, skeleton_size, nbuf = FRAME_HEADER.unpack(header)
+    if magic != FRAME_MAGIC:
+        raise EOFError("invalid frame")
+    sizes = bytearray(8 * nbuf)
+    recv_into_all(sock, sizes)
+    skeleton = bytearray(skeleton_size)
+    recv_into_all(sock, skeleton)
+    buffers = []
+    for size in struct.unpack('<%dQ' % nbuf, sizes):
+        # the arrays are rebuilt on top of these without copy
+        buf = np.empty(size, dtype='uint8')
+        recv_into_all(sock, buf)
+        buffers.append(buf)
+    return pickle.loads(skeleton, buffers=buffers)
+
+
+# same for non-blocking sockets driven by an asyncio loop
+
+async def recv_into_all_async(loop, sock, buf):
+    view = memoryview(buf).cast('B')
+    nr = 0
+    while nr < len(view):
+        r = await loop.sock_recv_into(sock, view[nr:])
+        if r == 0:
+            raise EOFError("connection closed")
+        nr += r
+
+
+async def send_frame_async(loop, sock, obj):
+    for part in frame_parts(obj):
+        if len(part) > 0:
+            await loop.sock_sendall(sock, part)
+
+
+async def recv_frame_async(loop, sock):
+    header = bytearray(FRAME_HEADER.size)
+    await recv_into_all_async(loop, sock, header)
+    magic, skeleton_size, nbuf = FRAME_HEADER.unpack(header)
+    if magic != FRAME_MAGIC:
+        raise EOFError("invalid frame")
+    sizes = bytearray(8 * nbuf)
+    await recv_into_all_async(loop, sock, sizes)
+    skeleton = bytearray(skeleton_size)
+    await recv_into_all_async(loop, sock, skeleton)
+    buffers = []
+    for size in struct.unpack('<%dQ' % nbuf, sizes):
+        buf = np.empty(size, dtype='uint8')
+        await recv_into_all_async(loop, sock, buf)
+        buffers.append(buf)
+    return pickle.loads(skeleton, buffers=buffers)
+
+
+def is_frame_next(sock):
+    """ does the next message on the socket use the binary format """
+    head = sock.recv(len(FRAME_MAGIC), socket.MSG_PEEK | socket.MSG_WAITALL)
+    if not head:
+        raise EOFError("connection closed")
+    return head == FRAME_MAGIC
 
 class ClientExit(Exception):
     pass
@@ -84,13 +213,17 @@ class ServerException(Exception):
     pass
 
 
+# method name of the requests that cancel another one
+CANCEL_REQUEST = '__cancel__'
+
+
 class Server:
     """
     server protocol. Methods from classes that subclass Server can be called
     transparently from a client
     """
 
-    def __init__(self, s, logf=sys.stderr, log_prefix=''):
+    def __init__(self, s, logf=sys.stderr, log_prefix='', n_workers=1):
         self.logf = logf
         self.log_prefix = log_prefix
 
@@ -99,6 +232,16 @@ class Server:
         self.conn = s
         self.fs = FileSock(s)
 
+        # requests with an id are run by a pool of n_workers threads,
+        # several of them can be in flight on the connection. It is
+        # created by the first request read by exec_loop, run_server_async
+        # uses its own executor
+        self.n_workers = n_workers
+        self.pool = None
+        self.send_lock = threading.Lock()
+        self.in_flight = {}   # request id -> Future in the pool
+        self.in_flight_lock = threading.Lock()
+
 
     def log(self, s):
         self.logf.write("Sever log %s: %s\n" % (self.log_prefix, s))
@@ -107,28 +250,65 @@ class Server:
         """
         Executes a single function with associated I/O.
         Protocol:
-        - the arguments and results are serialized with the pickle protocol
-        - client sends : (fname,args)
+        - the arguments and results are serialized with the pickle protocol,
+          or in binary frames (see send_frame). The result uses the format
+          of the request
+        - client sends : (rid,fname,args)
+            rid = request id
             fname = method name to call
             args = tuple of arguments
         - server sends result: (rid,st,ret)
             rid = request id
             st = None, or exception if there was during execution
             ret = return value or None if st!=None
+        Requests with an id are handed over to the worker pool, so the
+        results may come back in a different order than the requests. A
+        request without id, (fname,args), is executed before reading the
+        next one and its result is sent as (st,ret). The request
+        (None,CANCEL_REQUEST,(rid,)) drops request rid if it did not start
+        yet, nothing is sent back for either.
         """
 
         try:
-            (fname,args)=pickle.load(self.fs)
+            binary = is_frame_next(self.conn)
+            if binary:
+                request=recv_frame(self.conn)
+            else:
+                request=pickle.load(self.fs)
         except EOFError:
             raise ClientExit("read args")
+        if len(request) == 2:
+            (fname,args) = request
+            self.send_result(binary, None, *self.call(fname, args))
+        else:
+            (rid,fname,args) = request
+            if fname == CANCEL_REQUEST:
+                with self.in_flight_lock:
+                    fut = self.in_flight.pop(args[0], None)
+                if fut is not None:
+                    fut.cancel()
+                return
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(self.n_workers)
+            fut = self.pool.submit(self.run_request, binary, rid, fname, args)
+            with self.in_flight_lock:
+                self.in_flight[rid] = fut
+            fut.add_done_callback(lambda _: self.forget_request(rid))
+
+    def forget_request(self, rid):
+        with self.in_flight_lock:
+            self.in_flight.pop(rid, None)
+
+    def call(self, fname, args):
+        """ run method fname, returns (st,ret) """
         self.log("executing method %s"%(fname))
         st = None
         ret = None
         try:
             f=getattr(self,fname)
         except AttributeError:
-            st = AttributeError("unknown method "+fname)
             self.log("unknown method ")
+            return "unknown method "+fname, None
 
         try:
             ret = f(*args)
@@ -143,13 +323,28 @@ class Server:
             self.log("exception in method")
             traceback.print_exc(50,self.logf)
             self.logf.flush()
+        return st, ret
 
+    def send_result(self, binary, rid, st, ret):
         LOG.info("return")
+        result = (st, ret) if rid is None else (rid, st, ret)
         try:
-            pickle.dump((st ,ret), self.fs, protocol=4)
+            with self.send_lock:
+                if binary:
+                    send_frame(self.conn, result)
+                else:
+                    pickle.dump(result, self.fs, protocol=4)
         except EOFError:
             raise ClientExit("function return")
 
+    def run_request(self, binary, rid, fname, args):
+        """ executed in the worker pool """
+        try:
+            self.send_result(binary, rid, *self.call(fname, args))
+        except (ClientExit, socket.error) as e:
+            # the client is gone, exec_loop will see it
+            self.log("could not return result of request %s: %s" % (rid, e))
+
     def exec_loop(self):
         """ main execution loop. Loops and handles exit states"""
 
@@ -169,6 +364,9 @@ class Server:
             # unexpected
             traceback.print_exc(50,sys.stderr)
             sys.exit(1)
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(wait=True)
 
         LOG.info("exit sever")
 
@@ -192,33 +390,189 @@ class Server:
 class Client:
     """
     Methods of the server object can be called transparently. Exceptions are
-    re-raised.
+    re-raised. With binary=False, the plain pickle format is used (eg. for
+    servers that do not support the binary frames).
+
+    Calls can also be pipelined: submit() sends a request and returns a
+    Future without waiting for the result. The results are read by a
+    background thread and matched to their requests by id.
     """
-    def __init__(self, HOST, port=PORT, v6=False):
+    def __init__(self, HOST, port=PORT, v6=False, binary=True):
         socktype = socket.AF_INET6 if v6 else socket.AF_INET
 
         sock = socket.socket(socktype, socket.SOCK_STREAM)
-        LOG.info("connecting", HOST, port, socktype)
+        LOG.info("connecting %s:%d %s", HOST, port, socktype)
         sock.connect((HOST, port))
         self.sock = sock
         self.fs = FileSock(sock)
+        self.binary = binary
+
+        self.send_lock = threading.Lock()
+        self.pending = {}     # request id -> Future
+        self.pending_lock = threading.Lock()
+        self.next_rid = 0
+        self.reader = threading.Thread(target=self.read_results, daemon=True)
+        self.reader.start()
+
+    def submit(self, fname, *args):
+        """ send a request, returns a Future of its result """
+        fut = Future()
+        with self.pending_lock:
+            rid = self.next_rid
+            self.next_rid += 1
+            if self.reader is None:
+                raise EOFError("connection closed")
+            self.pending[rid] = fut
+        fut.rid = rid
+        with self.send_lock:
+            if self.binary:
+                send_frame(self.sock, (rid, fname, args))
+            else:
+                pickle.dump((rid, fname, args), self.fs, protocol=4)
+        return fut
 
     def generic_fun(self, fname, args):
         # int "gen fun",fname
-        pickle.dump((fname, args), self.fs, protocol=4)
-        return self.get_result()
-
-    def get_result(self):
-        (st, ret) = pickle.load(self.fs)
-        if st!=None:
-            raise ServerException(st)
-        else:
-            return ret
+        return self.submit(fname, *args).result()
+
+    def cancel(self, fut):
+        """ cancel a submitted request. The server drops it if it did not
+        start, otherwise its result is ignored. Returns whether the request
+        was still pending """
+        with self.pending_lock:
+            if self.pending.pop(fut.rid, None) is None:
+                return False
+        fut.cancel()
+        try:
+            with self.send_lock:
+                request = (None, CANCEL_REQUEST, (fut.rid, ))
+                if self.binary:
+                    send_frame(self.sock, request)
+                else:
+                    pickle.dump(request, self.fs, protocol=4)
+        except OSError:
+            pass    # connection closed, nothing to cancel
+        return True
+
+    def read_results(self):
+        """ reader thread: dispatches the results to their Futures """
+        try:
+            while True:
+                if self.binary:
+                    (rid, st, ret) = recv_frame(self.sock)
+                else:
+                    (rid, st, ret) = pickle.load(self.fs)
+                with self.pending_lock:
+                    fut = self.pending.pop(rid, None)
+                if fut is None:
+                    continue    # cancelled
+                if st!=None:
+                    fut.set_exception(ServerException(st))
+                else:
+                    fut.set_result(ret)
+        except Exception as e:
+            # EOF, socket closed or corrupted stream
+            error = e
+        with self.pending_lock:
+            self.reader = None
+            pending, self.pending = self.pending, {}
+        for fut in pending.values():
+            fut.set_exception(EOFError("connection closed: %s" % error))
+
+    def close(self):
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.sock.close()
 
     def __getattr__(self,name):
         return lambda *x: self.generic_fun(name,x)
 
 
+class AsyncClient:
+    """
+    asyncio version of the Client, using binary frames. Several calls can
+    be awaited concurrently on the same connection, their results are
+    matched by request id. Create with AsyncClient.connect.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.loop = asyncio.get_running_loop()
+        self.send_lock = asyncio.Lock()
+        self.pending = {}     # request id -> asyncio Future
+        self.next_rid = 0
+        self.closed = False
+        self.reader = self.loop.create_task(self.read_results())
+
+    @classmethod
+    async def connect(cls, HOST, port=PORT, v6=False):
+        socktype = socket.AF_INET6 if v6 else socket.AF_INET
+        sock = socket.socket(socktype, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        LOG.info("connecting %s:%d %s", HOST, port, socktype)
+        await asyncio.get_running_loop().sock_connect(sock, (HOST, port))
+        return cls(sock)
+
+    async def call(self, fname, *args):
+        """ run method fname on the server. If the call is cancelled, its
+        result is dropped when it arrives """
+        if self.closed:
+            raise EOFError("connection closed")
+        rid = self.next_rid
+        self.next_rid += 1
+        fut = self.loop.create_future()
+        self.pending[rid] = fut
+        # a frame sent partially would corrupt the connection: the send is
+        # not interrupted by the cancellation of the call
+        send = self.loop.create_task(self.send_frame((rid, fname, args)))
+        try:
+            await asyncio.shield(send)
+            return await fut
+        except asyncio.CancelledError:
+            if rid in self.pending:
+                self.loop.create_task(self.send_cancel(rid, send))
+            raise
+        finally:
+            self.pending.pop(rid, None)
+
+    async def send_frame(self, obj):
+        async with self.send_lock:
+            await send_frame_async(self.loop, self.sock, obj)
+
+    async def send_cancel(self, rid, send):
+        """ cancel request rid once its frame is sent """
+        try:
+            await send
+            if not self.closed:
+                await self.send_frame((None, CANCEL_REQUEST, (rid, )))
+        except OSError:
+            pass
+
+    async def read_results(self):
+        try:
+            while True:
+                (rid, st, ret) = await recv_frame_async(self.loop, self.sock)
+                fut = self.pending.pop(rid, None)
+                if fut is None or fut.done():
+                    continue    # cancelled
+                if st!=None:
+                    fut.set_exception(ServerException(st))
+                else:
+                    fut.set_result(ret)
+        except Exception as e:
+            error = e
+        self.closed = True
+        for fut in self.pending.values():
+            if not fut.done():
+                fut.set_exception(EOFError("connection closed: %s" % error))
+
+    async def close(self):
+        self.reader.cancel()
+        self.sock.close()
+
+    def __getattr__(self,name):
+        return lambda *x: self.call(name, *x)
+
+
 def run_server(new_handler, port=PORT, report_to_file=None, v6=False):
 
     HOST = ''                 # Symbolic name meaning the local host
@@ -232,7 +586,7 @@ def run_server(new_handler, port=PORT, report_to_file=None, v6=False):
 
     LOG.info("accepting connections")
     if report_to_file is not None:
-        LOG.info('storing host+port in', report_to_file)
+        LOG.info('storing host+port in %s', report_to_file)
         open(report_to_file, 'w').write('%s:%d ' % (socket.gethostname(), port))
 
     while True:
@@ -242,10 +596,77 @@ def run_server(new_handler, port=PORT, report_to_file=None, v6=False):
             if e[1]=='Interrupted system call': continue
             raise
 
-        LOG.info('Connected by', addr, end=' ')
+        LOG.info('Connected by %s', addr)
 
         ibs = new_handler(conn)
 
         tid = _thread.start_new_thread(ibs.exec_loop,())
 
-        LOG.info("tid",tid)
+        LOG.info("tid %s", tid)
+
+
+async def run_server_async(new_handler, port=PORT, v6=False, n_workers=1):
+    """
+    asyncio version of run_server: all the connections are served by one
+    event loop, and the methods run in a pool of n_workers threads. Only
+    binary frames are supported.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(n_workers)
+
+    HOST = ''                 # Symbolic name meaning the local host
+    socktype = socket.AF_INET6 if v6 else socket.AF_INET
+    s = socket.socket(socktype, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    LOG.info("bind %s:%d" % (HOST, port))
+    s.bind((HOST, port))
+    s.listen(5)
+    s.setblocking(False)
+
+    async def run_request(ibs, conn, send_lock, request):
+        if len(request) == 2:
+            rid, (fname, args) = None, request
+        else:
+            (rid, fname, args) = request
+        st, ret = await loop.run_in_executor(executor, ibs.call, fname, args)
+        result = (st, ret) if rid is None else (rid, st, ret)
+        async with send_lock:
+            await send_frame_async(loop, conn, result)
+
+    async def serve_connection(ibs, conn):
+        send_lock = asyncio.Lock()
+        tasks = {}     # request id -> task
+        try:
+            while True:
+                request = await recv_frame_async(loop, conn)
+                if len(request) == 2:
+                    # no request id: in-order execution
+                    await run_request(ibs, conn, send_lock, request)
+                    continue
+                rid, fname, args = request
+                if fname == CANCEL_REQUEST:
+                    task = tasks.pop(args[0], None)
+                    if task is not None:
+                        task.cancel()
+                    continue
+                task = loop.create_task(
+                    run_request(ibs, conn, send_lock, request))
+                tasks[rid] = task
+                task.add_done_callback(lambda _, rid=rid: tasks.pop(rid, None))
+        except (EOFError, OSError) as e:
+            ibs.log("ClientExit %s" % e)
+        finally:
+            for task in list(tasks.values()):
+                task.cancel()
+            conn.close()
+
+    LOG.info("accepting connections")
+    try:
+        while True:
+            conn, addr = await loop.sock_accept(s)
+            LOG.info('Connected by %s', addr)
+            conn.setblocking(False)
+            loop.create_task(serve_connection(new_handler(conn), conn))
+    finally:
+        s.close()
+        executor.shutdown(wait=False)
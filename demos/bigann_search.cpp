@@ -1,7 +1,15 @@
 /*
-  Usage: ./binary index_dir gt_dir topK nprobe (optional repeat_time)
+  Usage: ./binary index_dir gt_dir topK nprobe (optional repeat_time) (optional qbs) (optional results_file) (optional index_key)
+    qbs is the query batch size of each index->search call, by default all the queries
+      in one batch; qbs=1 measures the latency of single queries
+    topK, nprobe and qbs can be comma-separated lists, the index is then loaded once and
+    searched for every (topK, nprobe, qbs) setting, each run starting with a "==== ... ====" header
+    results_file receives one record per run, as a CSV row if it ends with .csv, otherwise as
+      a JSON line; index_key labels the records (by default the name of the index file)
   Example Usage:
     ./build/demos/bigann_search /data/trained_CPU_indexes_python/bench_cpu_SIFT100M_OPQ16,IVF65536,PQ16/SIFT100M_OPQ16,IVF65536,PQ16_populated.index /data/Faiss_experiments/bigann/gnd/idx_100M.ivecs 100 64 1
+    ./build/demos/bigann_search /data/trained_CPU_indexes_python/bench_cpu_SIFT100M_OPQ16,IVF65536,PQ16/SIFT100M_OPQ16,IVF65536,PQ16_populated.index /data/Faiss_experiments/bigann/gnd/idx_100M.ivecs 100 1,2,4,8,16 1
+    ./build/demos/bigann_search /data/trained_CPU_indexes_python/bench_cpu_SIFT100M_OPQ16,IVF65536,PQ16/SIFT100M_OPQ16,IVF65536,PQ16_populated.index /data/Faiss_experiments/bigann/gnd/idx_100M.ivecs 100 64 1 1,16,256
  */
 
 #include <cassert>
@@ -10,11 +18,20 @@
 #include <cstdlib>
 #include <cstring>
 
+#include <fcntl.h>
+#include <sys/mman.h>
 #include <sys/stat.h>
 #include <sys/types.h>
 #include <unistd.h>
 
+#ifdef __AVX2__
+#include <immintrin.h>
+#endif
+
 #include <sys/time.h>
+#include <time.h>
+
+#include <omp.h>
 
 #include <faiss/AutoTune.h>
 #include <faiss/index_factory.h>
@@ -22,7 +39,10 @@
 
 // Wenqi
 #include <faiss/IndexIVFPQ.h>
+#include <algorithm>
 #include <chrono>
+#include <string>
+#include <vector>
 
 /**
  * To run this demo, please download the ANN_SIFT1M dataset from
@@ -33,80 +53,188 @@
  **/
 
 /*****************************************************
- * I/O functions for fvecs and ivecs
+ * I/O functions for fvecs, ivecs and bvecs
  *****************************************************/
 
-float* fvecs_read(const char* fname, size_t* d_out, size_t* n_out) {
-    FILE* f = fopen(fname, "r");
-    if (!f) {
-        fprintf(stderr, "could not open %s\n", fname);
-        perror("");
-        abort();
+// memory-mapped .fvecs / .ivecs (4-byte components) or .bvecs (uint8 components):
+//   each row is an int header (the dimension) followed by d components. The rows are
+//   accessed in place, without reading the whole file or shifting the headers away
+struct MappedVecs {
+    const uint8_t* data;
+    size_t file_size;
+    size_t elem_size; // bytes per component
+    size_t row_size;  // bytes per row, including the header
+    size_t d, n;
+
+    MappedVecs(const char* fname, size_t elem_size) : elem_size(elem_size) {
+        int fd = open(fname, O_RDONLY);
+        if (fd < 0) {
+            fprintf(stderr, "could not open %s\n", fname);
+            perror("");
+            abort();
+        }
+        struct stat st;
+        fstat(fd, &st);
+        file_size = st.st_size;
+        void* ptr = mmap(nullptr, file_size, PROT_READ, MAP_SHARED, fd, 0);
+        close(fd);
+        if (ptr == MAP_FAILED) {
+            fprintf(stderr, "could not mmap %s\n", fname);
+            perror("");
+            abort();
+        }
+        data = (const uint8_t*)ptr;
+
+        int d_header;
+        memcpy(&d_header, data, sizeof(int));
+        assert((d_header > 0 && d_header < 1000000) || !"unreasonable dimension");
+        d = d_header;
+        row_size = sizeof(int) + d * elem_size;
+        assert(file_size % row_size == 0 || !"weird file size");
+        n = file_size / row_size;
     }
-    int d;
-    fread(&d, 1, sizeof(int), f);
-    assert((d > 0 && d < 1000000) || !"unreasonable dimension");
-    fseek(f, 0, SEEK_SET);
-    struct stat st;
-    fstat(fileno(f), &st);
-    size_t sz = st.st_size;
-    assert(sz % ((d + 1) * 4) == 0 || !"weird file size");
-    size_t n = sz / ((d + 1) * 4);
 
-    *d_out = d;
-    *n_out = n;
-    float* x = new float[n * (d + 1)];
-    size_t nr = fread(x, sizeof(float), n * (d + 1), f);
-    assert(nr == n * (d + 1) || !"could not read whole file");
+    ~MappedVecs() {
+        munmap((void*)data, file_size);
+    }
 
-    // shift array to remove row headers
-    for (size_t i = 0; i < n; i++)
-        memmove(x + i * d, x + 1 + i * (d + 1), d * sizeof(*x));
+    // the d components of row i
+    const void* row(size_t i) const {
+        return data + i * row_size + sizeof(int);
+    }
+};
 
-    fclose(f);
-    return x;
+// copy rows [i0, i0 + n) of a mapped fvecs or bvecs file to a float matrix, 
+//   the uint8 components of bvecs are converted 8 at a time with AVX2
+void vecs_to_float(const MappedVecs& vecs, size_t i0, size_t n, float* out) {
+    size_t d = vecs.d;
+    for (size_t i = 0; i < n; i++) {
+        float* dst = out + i * d;
+        if (vecs.elem_size == sizeof(float)) {
+            memcpy(dst, vecs.row(i0 + i), d * sizeof(float));
+            continue;
+        }
+        const uint8_t* src = (const uint8_t*)vecs.row(i0 + i);
+        size_t j = 0;
+#ifdef __AVX2__
+        for (; j + 8 <= d; j += 8) {
+            __m128i u8 = _mm_loadl_epi64((const __m128i*)(src + j));
+            _mm256_storeu_ps(dst + j, _mm256_cvtepi32_ps(_mm256_cvtepu8_epi32(u8)));
+        }
+#endif
+        for (; j < d; j++) {
+            dst[j] = src[j];
+        }
+    }
+}
+
+// print a phase marker in CLOCK_MONOTONIC, i.e., the clock of "perf record -k CLOCK_MONOTONIC",
+// such that the analysis can locate the search window in the perf trace
+void print_phase_marker(const char* phase) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    printf("PHASE %s %ld.%06ld\n", phase, (long)ts.tv_sec, (long)ts.tv_nsec / 1000);
+}
+
+// parse a comma-separated list of integers, e.g., "1,2,4,8"
+std::vector<int> parse_int_list(const char* arg) {
+    std::vector<int> values;
+    std::string s(arg);
+    size_t begin = 0;
+    while (begin <= s.size()) {
+        size_t end = s.find(',', begin);
+        if (end == std::string::npos) {
+            end = s.size();
+        }
+        values.push_back(std::stoi(s.substr(begin, end - begin)));
+        begin = end + 1;
+    }
+    return values;
 }
 
-// not very clean, but works as long as sizeof(int) == sizeof(float)
-int* ivecs_read(const char* fname, size_t* d_out, size_t* n_out) {
-    return (int*)fvecs_read(fname, d_out, n_out);
+// nearest-rank percentile of sorted values
+double get_percentile(const std::vector<double>& sorted_values, double p) {
+    size_t rank = (size_t) ceil(p / 100.0 * sorted_values.size());
+    if (rank == 0) { rank = 1; }
+    return sorted_values[rank - 1];
 }
 
-// WENQI: load bvecs (1 int + uint8 * 128 per vec) in memory, as float format
-float* bvecs_read(const char* fname, size_t* d_out, size_t* n_out) {
-    FILE* f = fopen(fname, "r");
+/*****************************************************
+ * Result records, one per run
+ *****************************************************/
+
+// ordered (field, value) pairs of a run, the values are formatted as JSON
+struct ResultRecord {
+    std::vector<std::pair<std::string, std::string>> fields;
+
+    void add(const std::string& key, const std::string& json_value) {
+        fields.push_back(std::make_pair(key, json_value));
+    }
+
+    void add_str(const std::string& key, const std::string& value) {
+        add(key, "\"" + value + "\"");
+    }
+
+    void add_int(const std::string& key, long value) {
+        add(key, std::to_string(value));
+    }
+
+    void add_double(const std::string& key, double value) {
+        char buf[64];
+        snprintf(buf, sizeof(buf), "%.6g", value);
+        add(key, buf);
+    }
+
+    void add_null(const std::string& key) {
+        add(key, "null");
+    }
+
+    std::string to_json() const {
+        std::string line = "{";
+        for (size_t i = 0; i < fields.size(); i++) {
+            line += (i ? ", \"" : "\"") + fields[i].first + "\": " + fields[i].second;
+        }
+        return line + "}";
+    }
+
+    std::string csv_header() const {
+        std::string line;
+        for (size_t i = 0; i < fields.size(); i++) {
+            line += (i ? "," : "") + fields[i].first;
+        }
+        return line;
+    }
+
+    // strings stay double-quoted (index keys contain commas), null is an empty field
+    std::string to_csv() const {
+        std::string line;
+        for (size_t i = 0; i < fields.size(); i++) {
+            line += (i ? "," : "") + (fields[i].second == "null" ? "" : fields[i].second);
+        }
+        return line;
+    }
+};
+
+// append a record to a CSV file (with a header if the file is new) or a JSON-lines file
+void append_result_record(const std::string& fname, const ResultRecord& record) {
+    bool is_csv = fname.size() >= 4 && fname.compare(fname.size() - 4, 4, ".csv") == 0;
+    struct stat st;
+    bool is_new = stat(fname.c_str(), &st) != 0 || st.st_size == 0;
+    FILE* f = fopen(fname.c_str(), "a");
     if (!f) {
-        fprintf(stderr, "could not open %s\n", fname);
+        fprintf(stderr, "could not open %s\n", fname.c_str());
         perror("");
         abort();
     }
-    int d;
-    fread(&d, 1, sizeof(int), f);
-    assert((d > 0 && d < 1000000) || !"unreasonable dimension");
-    fseek(f, 0, SEEK_SET);
-    struct stat st;
-    fstat(fileno(f), &st);
-    size_t sz = st.st_size;
-    assert(sz % (d + 4) == 0 || !"weird file size");
-    size_t n = sz / (d + 4);
-
-    *d_out = d;
-    *n_out = n;
-    unsigned char* x = new unsigned char[n * (d + 4)];
-    size_t nr = fread(x, sizeof(unsigned char), n * (d + 4), f);
-    assert(nr == n * (d + 4) || !"could not read whole file");
-
-    float* vec = new float[n * d];
-    // remove header and convert uint8 to float
-    for (size_t i = 0; i < n; i++) {
-        for (size_t j = 0; j < d; j++) {
-            vec[i * d + j] = (float) x[i * (d + 4) + 4 + j]; 
+    if (is_csv) {
+        if (is_new) {
+            fprintf(f, "%s\n", record.csv_header().c_str());
         }
+        fprintf(f, "%s\n", record.to_csv().c_str());
+    } else {
+        fprintf(f, "%s\n", record.to_json().c_str());
     }
-    delete []x;
-
     fclose(f);
-    return vec;
 }
 
 double elapsed() {
@@ -121,7 +249,7 @@ int main(int argc, char *argv[]) {
     //double t0 = elapsed();
 
     if (argc < 5) {
-        printf("Usage: ./binary index_dir gt_dir topK nprobe (optional repeat_time) \nExit\n");
+        printf("Usage: ./binary index_dir gt_dir topK nprobe (optional repeat_time) (optional qbs) \nExit\n");
         exit(1);
     }
 
@@ -129,13 +257,23 @@ int main(int argc, char *argv[]) {
     // std::string index_dir = "/home/ubuntu/trained_CPU_indexes_C/SIFT1M_IVF1024,PQ16_populated_index";
     std::string gt_dir = argv[2];
     // std::string gt_dir = "/data/Faiss_experiments/bigann/gnd/idx_1M.ivecs";
-    int k = std::stoi(argv[3]);
-    int nprobe = std::stoi(argv[4]);
+    // topK and nprobe can be comma-separated lists, e.g., 1,2,4,8: the index is
+    //   then loaded once and searched with each setting in turn
+    std::vector<int> topK_list = parse_int_list(argv[3]);
+    std::vector<int> nprobe_list = parse_int_list(argv[4]);
     int repeat_time = 1; // repeat the 10000 queries for N times to increase the performance measurement precision
     if (argc >= 6) { repeat_time = std::stoi(argv[5]); }
+    std::vector<int> qbs_list = {0}; // 0 = all the queries in a single batch
+    if (argc >= 7) { qbs_list = parse_int_list(argv[6]); }
+    std::string results_file; // no record written by default
+    if (argc >= 8) { results_file = argv[7]; }
+    std::string index_key = index_dir.substr(index_dir.find_last_of('/') + 1);
+    if (argc >= 9) { index_key = argv[8]; }
 
     // faiss::IndexIVFPQ* index = (faiss::IndexIVFPQ*) faiss::read_index(index_dir.c_str());
+    auto t_before_load = std::chrono::high_resolution_clock::now();
     faiss::Index* index = faiss::read_index(index_dir.c_str());
+    double t_load = std::chrono::duration<double>(std::chrono::high_resolution_clock::now() - t_before_load).count();
     // faiss::Index* index = faiss::read_index("/home/ubuntu/trained_CPU_indexes_python/bench_cpu_SIFT1M_IMI2x8,PQ16/SIFT1M_IMI2x8,PQ16_populated.index");
 
     // printf("imbalance factor of the index: %f\n", index -> invlists -> imbalance_factor());
@@ -149,51 +287,50 @@ int main(int argc, char *argv[]) {
     }
 
     size_t d = 128;
-    size_t nq;
-    float* xq;
 
-    {
-        printf("[%.3f s] Loading queries\n", std::chrono::duration_cast<milli>(std::chrono::high_resolution_clock::now() - t0).count() / 1000.0);
-        //printf("[%.3f s] Loading queries\n", elapsed() - t0);
+    printf("[%.3f s] Loading queries\n", std::chrono::duration_cast<milli>(std::chrono::high_resolution_clock::now() - t0).count() / 1000.0);
+    //printf("[%.3f s] Loading queries\n", elapsed() - t0);
 
-        size_t d2;
-        xq = bvecs_read("/data/Faiss_experiments/bigann/bigann_query.bvecs", &d2, &nq);
-        assert(d == d2 || !"query does not have same dimension as train set");
-    }
-/*
-    printf("content of the first query:\n");
-    for (int i = 0; i < d; i++) {
-        printf("%f\t", xq[i]);
-    }
-*/
-    size_t k_max;                // topK of results per query in the GT
-    faiss::Index::idx_t* gt; // nq * k matrix of ground-truth nearest-neighbors
+    // the queries are converted to float batch by batch, right before they are searched,
+    // the conversion is timed separately from the search (t_convert)
+    MappedVecs xq_file("/data/Faiss_experiments/bigann/bigann_query.bvecs", sizeof(uint8_t));
+    assert(d == xq_file.d || !"query does not have same dimension as train set");
+    size_t nq = xq_file.n;
 
-    {
-        printf("[%.3f s] Loading ground truth for %ld queries\n",
-               std::chrono::duration_cast<milli>(std::chrono::high_resolution_clock::now() - t0).count() / 1000.0,
-               //elapsed() - t0,
-               nq);
+    printf("[%.3f s] Loading ground truth for %ld queries\n",
+           std::chrono::duration_cast<milli>(std::chrono::high_resolution_clock::now() - t0).count() / 1000.0,
+           //elapsed() - t0,
+           nq);
 
-        // load ground-truth and convert int to long
-        size_t nq2;
-        int* gt_int = ivecs_read(gt_dir.c_str(), &k_max, &nq2);
-printf("k=%d k_max=%d\n", k, k_max);
-        assert(nq2 == nq || !"incorrect nb of ground truth entries");
+    // nq * k_max matrix of ground-truth nearest-neighbors, read in place as int
+    MappedVecs gt_file(gt_dir.c_str(), sizeof(int));
+    size_t k_max = gt_file.d; // topK of results per query in the GT
+    assert(gt_file.n == nq || !"incorrect nb of ground truth entries");
 
-        gt = new faiss::Index::idx_t[k_max * nq];
-        for (int i = 0; i < k_max * nq; i++) {
-            gt[i] = gt_int[i];
-        }
-        delete[] gt_int;
-    }
+    { // Use the found configuration to perform a search, for each of the settings
 
-    // Result of the auto-tuning
-    std::string selected_params = std::string("nprobe=") + std::to_string(nprobe);
+        faiss::ParameterSpace params;
 
-    { // Use the found configuration to perform a search
+        for (int topK_id = 0; topK_id < topK_list.size(); topK_id++) {
+        for (int nprobe_id = 0; nprobe_id < nprobe_list.size(); nprobe_id++) {
+        for (int qbs_id = 0; qbs_id < qbs_list.size(); qbs_id++) {
+
+        int k = topK_list[topK_id];
+        int nprobe = nprobe_list[nprobe_id];
+        size_t qbs = qbs_list[qbs_id] > 0 ? std::min((size_t) qbs_list[qbs_id], nq) : nq;
+
+        // in a sweep, name each run after the swept settings like the experiment drivers do,
+        // such that the log (and the perf trace window of the run) can be located by analyze_perf.py
+        std::string run_name;
+        if (topK_list.size() > 1) { run_name += " topK=" + std::to_string(k); }
+        if (nprobe_list.size() > 1) { run_name += " nprobe=" + std::to_string(nprobe); }
+        if (qbs_list.size() > 1) { run_name += " qbs=" + std::to_string(qbs_list[qbs_id]); }
+        if (!run_name.empty()) {
+            printf("====%s ====\n", run_name.c_str());
+        }
 
-        faiss::ParameterSpace params;
+        // Result of the auto-tuning
+        std::string selected_params = std::string("nprobe=") + std::to_string(nprobe);
 
         printf("[%.3f s] Setting parameter configuration \"%s\" on index\n",
                std::chrono::duration_cast<milli>(std::chrono::high_resolution_clock::now() - t0).count() / 1000.0,
@@ -202,16 +339,22 @@ printf("k=%d k_max=%d\n", k, k_max);
 
         params.set_index_parameters(index, selected_params.c_str());
 
-        printf("[%.3f s] Perform a search on %ld queries\n",
+        printf("[%.3f s] Perform a search on %ld queries in batches of %ld\n",
                std::chrono::duration_cast<milli>(std::chrono::high_resolution_clock::now() - t0).count() / 1000.0,
                //elapsed() - t0,
-               nq);
+               nq, qbs);
 
         // output buffers
         faiss::Index::idx_t* I = new faiss::Index::idx_t[nq * k];
         float* D = new float[nq * k];
+        std::vector<float> xq_batch(qbs * d);
+        std::vector<double> batch_latency_ms; // latency of each index->search call
+        double t_convert = 0; // time spent converting the query batches to float
+        batch_latency_ms.reserve(repeat_time * ((nq + qbs - 1) / qbs));
 	
 	// WENQI: use more iterations to help perf record performance
+        faiss::indexIVF_stats.reset();
+        print_phase_marker("search_start");
         auto t_before_search = std::chrono::high_resolution_clock::now();
         //double t_before_search = elapsed();
         for (int rt = 0; rt < repeat_time; rt++) {
@@ -222,20 +365,36 @@ printf("k=%d k_max=%d\n", k, k_max);
        		p[i] = 0;
    	    }
 */
-            index->search(nq, xq, k, D, I); 
+            for (size_t q0 = 0; q0 < nq; q0 += qbs) {
+                size_t nq_batch = std::min(qbs, nq - q0);
+                auto t_before_convert = std::chrono::high_resolution_clock::now();
+                vecs_to_float(xq_file, q0, nq_batch, xq_batch.data());
+                auto t_before_batch = std::chrono::high_resolution_clock::now();
+                t_convert += std::chrono::duration<double>(t_before_batch - t_before_convert).count();
+                index->search(nq_batch, xq_batch.data(), k, D + q0 * k, I + q0 * k);
+                batch_latency_ms.push_back(std::chrono::duration<double, std::milli>(
+                        std::chrono::high_resolution_clock::now() - t_before_batch).count());
+            }
         }
 
-        double t_search = std::chrono::duration_cast<milli>(std::chrono::high_resolution_clock::now() - t_before_search).count() / 1000.0;
+        // the search time excludes the conversion of the queries
+        double t_search = std::chrono::duration<double>(std::chrono::high_resolution_clock::now() - t_before_search).count() - t_convert;
+        print_phase_marker("search_end");
         //double t_search = elapsed() - t_before_search;
         double QPS = repeat_time * ((double) nq) / t_search;
-        printf("Search complete, takes [%.3f s],  QPS=%.3f\n", t_search, QPS);
+        printf("Search complete, takes [%.3f s],  QPS=%.3f  (query conversion: %.3f s)\n", t_search, QPS, t_convert);
+        std::sort(batch_latency_ms.begin(), batch_latency_ms.end());
+        double p50 = get_percentile(batch_latency_ms, 50);
+        double p95 = get_percentile(batch_latency_ms, 95);
+        double p99 = get_percentile(batch_latency_ms, 99);
+        printf("Latency per batch of %ld queries (ms): p50=%.3f  p95=%.3f  p99=%.3f\n", qbs, p50, p95, p99);
         printf("[%.3f s] Compute recalls\n", std::chrono::duration_cast<milli>(std::chrono::high_resolution_clock::now() - t0).count() / 1000.0);
         //printf("[%.3f s] Compute recalls\n", elapsed() - t0);
 
         // evaluate result by hand.
         int n_1 = 0, n_10 = 0, n_100 = 0, n_k = 0;
         for (int i = 0; i < nq; i++) {
-            int gt_nn = gt[i * k_max];
+            int gt_nn = ((const int*)gt_file.row(i))[0];
             for (int j = 0; j < k; j++) {
                 if (I[i * k + j] == gt_nn) {
                     if (j < 1)
@@ -256,12 +415,46 @@ printf("k=%d k_max=%d\n", k, k_max);
         if (k >= 100) printf("R@100 = %.4f\n", n_100 / float(nq));
         if (k != 1 && k != 10 && k != 100) printf("R@%d = %.4f\n", k, n_k / float(nq));
 
+        // one record per setting, printed as a single JSON line and appended to the results file
+        const faiss::IndexIVFStats& stats = faiss::indexIVF_stats;
+        ResultRecord record;
+        record.add_str("index_key", index_key);
+        record.add_int("nprobe", nprobe);
+        record.add_int("topK", k);
+        record.add_int("qbs", qbs);
+        record.add_int("threads", omp_get_max_threads());
+        record.add_int("nq", nq);
+        record.add_int("repeat_time", repeat_time);
+        record.add_double("t_load", t_load);
+        record.add_double("t_convert", t_convert);
+        record.add_double("t_search", t_search);
+        record.add_double("QPS", QPS);
+        record.add_double("p50_ms", p50);
+        record.add_double("p95_ms", p95);
+        record.add_double("p99_ms", p99);
+        if (k >= 1) { record.add_double("R@1", n_1 / float(nq)); } else { record.add_null("R@1"); }
+        if (k >= 10) { record.add_double("R@10", n_10 / float(nq)); } else { record.add_null("R@10"); }
+        if (k >= 100) { record.add_double("R@100", n_100 / float(nq)); } else { record.add_null("R@100"); }
+        record.add_double("R@topK", n_k / float(nq));
+        record.add_int("ivf_nq", stats.nq);
+        record.add_int("ivf_nlist", stats.nlist);
+        record.add_int("ivf_ndis", stats.ndis);
+        record.add_int("ivf_nheap_updates", stats.nheap_updates);
+        record.add_double("ivf_quantization_ms", stats.quantization_time);
+        record.add_double("ivf_search_ms", stats.search_time);
+        printf("RESULT %s\n", record.to_json().c_str());
+        fflush(stdout);
+        if (!results_file.empty()) {
+            append_result_record(results_file, record);
+        }
+
         delete[] I;
         delete[] D;
+        }
+        }
+        }
     }
 
-    delete[] xq;
-    delete[] gt;
     delete index;
     return 0;
 }
@@ -13,10 +13,14 @@
 
 #include <faiss/AutoTune.h>
 
+#include <omp.h>
+
 #include <cinttypes>
 #include <cmath>
+#include <memory>
 #include <typeinfo>
 
+#include <faiss/clone_index.h>
 #include <faiss/impl/FaissAssert.h>
 #include <faiss/utils/random.h>
 #include <faiss/utils/utils.h>
@@ -257,7 +261,10 @@ ParameterSpace::ParameterSpace()
           n_experiments(500),
           batchsize(1 << 30),
           thread_over_batches(false),
-          min_test_duration(0) {}
+          min_test_duration(0),
+          max_explore_time(0),
+          max_query_time(0),
+          n_explore_threads(1) {}
 
 /* not keeping this constructor as inheritors will call the parent
    initialize()
@@ -720,4 +727,181 @@ void ParameterSpace::explore(
     }
 }
 
+namespace {
+
+// measure of a combination on a prefix of the queries
+struct BudgetedMeasure {
+    size_t cno;
+    double perf;
+    double t; // extrapolated to all the queries, in s
+};
+
+} // namespace
+
+void ParameterSpace::explore_with_budget(
+        Index* index,
+        size_t nq,
+        const float* xq,
+        const AutoTuneCriterion& crit,
+        OperatingPoints* ops) const {
+    FAISS_THROW_IF_NOT_MSG(
+            nq == crit.nq, "criterion does not have the same nb of queries");
+    double t_start = getmillisecs();
+    size_t n_comb = n_combinations();
+
+    // the indexes to evaluate the combinations on, concurrently
+    int nt = std::max(1, std::min(n_explore_threads, int(n_comb)));
+    // concurrent searches run on one thread each, a plain search on all of
+    // them: assume it scales linearly to make the times comparable
+    double t_scale = nt > 1 ? 1.0 / omp_get_max_threads() : 1.0;
+    std::vector<std::unique_ptr<Index>> clones(nt > 1 ? nt : 0);
+    for (auto& clone : clones) {
+        clone.reset(clone_index(index));
+    }
+
+    std::vector<size_t> candidates(n_comb);
+    for (size_t cno = 0; cno < n_comb; cno++) {
+        candidates[cno] = cno;
+    }
+    std::vector<BudgetedMeasure> measures; // of the last completed round
+    size_t nq_round = std::max(nq / 16, size_t(1));
+
+    for (;;) {
+        std::vector<BudgetedMeasure> round(candidates.size());
+        // not vector<bool>, whose elements share words across threads
+        std::vector<char> done(candidates.size(), 0);
+        bool out_of_time = false;
+
+#pragma omp parallel for schedule(dynamic) num_threads(nt) if (nt > 1)
+        for (int64_t ci = 0; ci < candidates.size(); ci++) {
+            if (max_explore_time > 0 &&
+                getmillisecs() - t_start > max_explore_time * 1000) {
+#pragma omp atomic write
+                out_of_time = true;
+                continue;
+            }
+            size_t cno = candidates[ci];
+            Index* ix = nt > 1 ? clones[omp_get_thread_num()].get() : index;
+            set_index_parameters(ix, cno);
+            if (nt > 1) {
+                // also when nested parallelism is enabled
+                omp_set_num_threads(1);
+            }
+
+            // results of the queries beyond nq_round are left to -1
+            std::vector<Index::idx_t> I(nq * crit.nnn, -1);
+            std::vector<float> D(nq * crit.nnn, 0);
+
+            double t0 = getmillisecs();
+            for (size_t q0 = 0; q0 < nq_round; q0 += batchsize) {
+                size_t q1 = std::min(q0 + batchsize, nq_round);
+                ix->search(
+                        q1 - q0,
+                        xq + q0 * ix->d,
+                        crit.nnn,
+                        D.data() + q0 * crit.nnn,
+                        I.data() + q0 * crit.nnn);
+            }
+            double t_search = (getmillisecs() - t0) / 1e3;
+
+            round[ci].cno = cno;
+            round[ci].perf = crit.evaluate(D.data(), I.data()) * nq / nq_round;
+            round[ci].t = t_search * t_scale * nq / nq_round;
+            done[ci] = 1;
+        }
+
+        if (out_of_time) {
+            // keep the last complete measures of the surviving candidates
+            std::vector<BudgetedMeasure> last;
+            for (const BudgetedMeasure& m : measures) {
+                if (std::find(candidates.begin(), candidates.end(), m.cno) !=
+                    candidates.end()) {
+                    last.push_back(m);
+                }
+            }
+            for (size_t ci = 0; ci < candidates.size(); ci++) {
+                // measured in this round but not before
+                if (done[ci] &&
+                    std::find_if(
+                            last.begin(),
+                            last.end(),
+                            [&](const BudgetedMeasure& m) {
+                                return m.cno == round[ci].cno;
+                            }) == last.end()) {
+                    last.push_back(round[ci]);
+                }
+            }
+            measures = last;
+            if (verbose) {
+                printf("  explore budget of %.3f s exhausted at %zd queries\n",
+                       max_explore_time,
+                       nq_round);
+            }
+            break;
+        }
+        measures = round;
+
+        // pruning
+        std::vector<bool> pruned(measures.size(), false);
+        if (max_query_time > 0) {
+            for (size_t i = 0; i < measures.size(); i++) {
+                if (measures[i].t / nq <= max_query_time) {
+                    continue;
+                }
+                for (size_t j = 0; j < measures.size(); j++) {
+                    if (combination_ge(measures[j].cno, measures[i].cno)) {
+                        pruned[j] = true;
+                    }
+                }
+            }
+        }
+        double margin = nq_round < nq ? 1.0 / sqrt(double(nq_round)) : 0;
+        for (size_t i = 0; i < measures.size(); i++) {
+            for (size_t j = 0; j < measures.size() && !pruned[i]; j++) {
+                if (!pruned[j] && j != i &&
+                    measures[j].perf >= measures[i].perf + margin &&
+                    measures[j].t <= measures[i].t) {
+                    pruned[i] = true;
+                }
+            }
+        }
+
+        std::vector<BudgetedMeasure> survivors;
+        for (size_t i = 0; i < measures.size(); i++) {
+            if (!pruned[i]) {
+                survivors.push_back(measures[i]);
+            }
+        }
+        if (verbose) {
+            printf("  explore round on %zd queries: %zd / %zd combinations "
+                   "kept, %.3f s elapsed\n",
+                   nq_round,
+                   survivors.size(),
+                   measures.size(),
+                   (getmillisecs() - t_start) / 1e3);
+        }
+        measures = survivors;
+        candidates.clear();
+        for (const BudgetedMeasure& m : measures) {
+            candidates.push_back(m.cno);
+        }
+
+        if (nq_round == nq || candidates.empty()) {
+            break;
+        }
+        nq_round = std::min(nq_round * 2, nq);
+    }
+
+    for (const BudgetedMeasure& m : measures) {
+        bool keep = ops->add(m.perf, m.t, combination_name(m.cno), m.cno);
+        if (verbose) {
+            printf("  %s perf=%.3f t=%.3f s %s\n",
+                   combination_name(m.cno).c_str(),
+                   m.perf,
+                   m.t,
+                   keep ? "*" : "");
+        }
+    }
+}
+
 } // namespace faiss
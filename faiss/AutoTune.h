@@ -153,6 +153,19 @@ struct ParameterSpace {
     /// duration (to avoid jittering in MT mode)
     double min_test_duration;
 
+    /// wall-clock budget of explore_with_budget, in s (0 = no budget)
+    double max_explore_time;
+
+    /// search time ceiling per query for explore_with_budget, in s. Slower
+    /// combinations and all the more expensive ones are discarded
+    /// (0 = no ceiling)
+    double max_query_time;
+
+    /// nb of combinations that explore_with_budget evaluates concurrently,
+    /// each on a clone of the index with a single-threaded search (<= 1:
+    /// one at a time on the index, with all the threads)
+    int n_explore_threads;
+
     ParameterSpace();
 
     /// nb of combinations, = product of values sizes
@@ -206,6 +219,37 @@ struct ParameterSpace {
             const AutoTuneCriterion& crit,
             OperatingPoints* ops) const;
 
+    /** explore operating points within a time budget
+     *
+     * The combinations are evaluated in rounds on growing prefixes of the
+     * queries (1/16 of them, then doubling). After each round, the
+     * combinations that are slower than max_query_time (and all the more
+     * expensive ones) or dominated by another one in both perf and time
+     * (with a margin of 1/sqrt(nq_round) on perf) are pruned. The survivors
+     * of the last round are added to ops, which then contains the Pareto
+     * front in ops->optimal_pts. If max_explore_time runs out, the
+     * survivors are added with their measures on the last completed round.
+     *
+     * The criterion must average over the queries (as OneRecallAtRCriterion
+     * and IntersectionCriterion do): the results of the queries beyond the
+     * prefix are set to -1 and perf is rescaled accordingly. Times are
+     * extrapolated to nq queries, in s. With n_explore_threads > 1, each
+     * search runs on a single thread and its time is divided by
+     * omp_get_max_threads(), which assumes that the search scales
+     * linearly with the nb of threads.
+     *
+     * @param index   index to run on
+     * @param xq      query vectors (size nq * index.d)
+     * @param crit    selection criterion
+     * @param ops     resulting operating points
+     */
+    void explore_with_budget(
+            Index* index,
+            size_t nq,
+            const float* xq,
+            const AutoTuneCriterion& crit,
+            OperatingPoints* ops) const;
+
     virtual ~ParameterSpace() {}
 };
 
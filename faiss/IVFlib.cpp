@@ -339,16 +339,28 @@ void search_with_parameters(
     FAISS_THROW_IF_NOT(index_ivf);
 
     index_ivf->quantizer->search(n, x, params->nprobe, Dq.data(), Iq.data());
-
-    if (nb_dis_ptr) {
-        *nb_dis_ptr = count_ndis(index_ivf, n * params->nprobe, Iq.data());
-    }
+    index_ivf->invlists->prefetch_lists(Iq.data(), n * params->nprobe);
 
     double t2 = getmillisecs();
 
+    // local stats to stay thread-safe. The nb of distances is taken from
+    // them because the adaptive nprobe may not visit all the lists
+    IndexIVFStats stats;
     index_ivf->search_preassigned(
-            n, x, k, Iq.data(), Dq.data(), distances, labels, false, params);
+            n,
+            x,
+            k,
+            Iq.data(),
+            Dq.data(),
+            distances,
+            labels,
+            false,
+            params,
+            &stats);
     double t3 = getmillisecs();
+    if (nb_dis_ptr) {
+        *nb_dis_ptr = stats.ndis;
+    }
     if (ms_per_stage) {
         ms_per_stage[0] = t1 - t0;
         ms_per_stage[1] = t2 - t1;
@@ -356,6 +368,51 @@ void search_with_parameters(
     }
 }
 
+void search_nprobe_sweep(
+        const Index* index,
+        idx_t n,
+        const float* x,
+        idx_t k,
+        size_t n_nprobes,
+        const idx_t* nprobes,
+        float* distances,
+        idx_t* labels) {
+    FAISS_THROW_IF_NOT(n_nprobes > 0);
+    const float* prev_x = x;
+    ScopeDeleter<float> del;
+
+    if (auto ip = dynamic_cast<const IndexPreTransform*>(index)) {
+        x = ip->apply_chain(n, x);
+        if (x != prev_x) {
+            del.set(x);
+        }
+        index = ip->index;
+    }
+
+    const IndexIVF* index_ivf = dynamic_cast<const IndexIVF*>(index);
+    FAISS_THROW_IF_NOT(index_ivf);
+
+    idx_t max_nprobe = nprobes[n_nprobes - 1];
+    FAISS_THROW_IF_NOT(max_nprobe > 0);
+    std::vector<idx_t> Iq(max_nprobe * n);
+    std::vector<float> Dq(max_nprobe * n);
+
+    index_ivf->quantizer->search(n, x, max_nprobe, Dq.data(), Iq.data());
+    index_ivf->invlists->prefetch_lists(Iq.data(), n * max_nprobe);
+
+    index_ivf->search_preassigned_sweep(
+            n,
+            x,
+            k,
+            n_nprobes,
+            nprobes,
+            Iq.data(),
+            Dq.data(),
+            distances,
+            labels,
+            &indexIVF_stats);
+}
+
 void range_search_with_parameters(
         const Index* index,
         idx_t n,
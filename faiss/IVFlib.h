@@ -134,6 +134,25 @@ void search_with_parameters(
         size_t* nb_dis = nullptr,
         double* ms_per_stage = nullptr);
 
+/** search an IndexIVF, possibly embedded in an IndexPreTransform, for
+ * several increasing values of nprobe at once. The coarse quantizer is
+ * run once for the largest nprobe, see
+ * IndexIVF::search_preassigned_sweep.
+ *
+ * @param nprobes    increasing nprobe values, size n_nprobes
+ * @param distances  output distances, size n_nprobes * n * k
+ * @param labels     output labels, size n_nprobes * n * k
+ */
+void search_nprobe_sweep(
+        const Index* index,
+        idx_t n,
+        const float* x,
+        idx_t k,
+        size_t n_nprobes,
+        const idx_t* nprobes,
+        float* distances,
+        idx_t* labels);
+
 /** same as search_with_parameters but for range search */
 void range_search_with_parameters(
         const Index* index,
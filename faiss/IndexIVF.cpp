@@ -29,6 +29,26 @@ namespace faiss {
 using ScopedIds = InvertedLists::ScopedIds;
 using ScopedCodes = InvertedLists::ScopedCodes;
 
+namespace {
+
+/// adds the cycles spent in its scope to a counter (if enabled)
+struct StageTimer {
+    uint64_t* counter;
+    uint64_t t0;
+
+    StageTimer(uint64_t& counter, bool enabled)
+            : counter(enabled ? &counter : nullptr),
+              t0(enabled ? get_cycles() : 0) {}
+
+    ~StageTimer() {
+        if (counter) {
+            *counter += get_cycles() - t0;
+        }
+    }
+};
+
+} // anonymous namespace
+
 /*****************************************
  * Level1Quantizer implementation
  ******************************************/
@@ -320,7 +340,11 @@ void IndexIVF::search(
         std::unique_ptr<float[]> coarse_dis(new float[n * nprobe]);
 
         double t0 = getmillisecs();
-        quantizer->search(n, x, nprobe, coarse_dis.get(), idx.get());
+        {
+            StageTimer timer(
+                    ivf_stats->quantization_cycles, indexIVF_stage_timers);
+            quantizer->search(n, x, nprobe, coarse_dis.get(), idx.get());
+        }
 
         double t1 = getmillisecs();
         invlists->prefetch_lists(idx.get(), n * nprobe);
@@ -401,7 +425,32 @@ void IndexIVF::search_preassigned(
 
     idx_t max_codes = params ? params->max_codes : this->max_codes;
 
-    size_t nlistv = 0, ndis = 0, nheap = 0;
+    // adaptive nprobe, see IVFSearchParameters
+    float coarse_dis_ratio = params ? params->coarse_dis_ratio : 0;
+    size_t stable_probes = params ? params->stable_probes : 0;
+    FAISS_THROW_IF_NOT_MSG(
+            coarse_dis_ratio == 0 || metric_type == METRIC_L2,
+            "coarse_dis_ratio is supported only for L2");
+
+    // should the lists of query i be visited only up to probe ik excluded
+    auto coarse_cutoff = [&](idx_t i, idx_t ik) {
+        if (coarse_dis_ratio == 0 || ik == 0) {
+            return false;
+        }
+        const float* cd = coarse_dis + i * nprobe;
+        // the query is (up to rounding) on its nearest centroid, a ratio to
+        // that distance is meaningless: visit all the lists
+        if (cd[0] <= 1e-3f * cd[1]) {
+            return false;
+        }
+        return cd[ik] > coarse_dis_ratio * cd[0];
+    };
+
+    size_t nlistv = 0, ndis = 0, nheap = 0, nskip = 0;
+
+    // per-stage cycle counters, see IndexIVFStats
+    bool do_timers = indexIVF_stage_timers;
+    uint64_t lut_cycles = 0, scan_cycles = 0, heap_cycles = 0;
 
     using HeapForIP = CMin<float, idx_t>;
     using HeapForL2 = CMax<float, idx_t>;
@@ -419,11 +468,15 @@ void IndexIVF::search_preassigned(
                      : pmode == 1 ? nprobe > 1
                                   : nprobe * n > 1);
 
-#pragma omp parallel if (do_parallel) reduction(+ : nlistv, ndis, nheap)
+#pragma omp parallel if (do_parallel) reduction( \
+        + : nlistv, ndis, nheap, nskip, lut_cycles, scan_cycles, heap_cycles)
     {
         InvertedListScanner* scanner = get_InvertedListScanner(store_pairs);
         ScopeDeleter1<InvertedListScanner> del(scanner);
 
+        // nb of heap updates of the last list scanned by this thread
+        size_t list_nheap = 0;
+
         /*****************************************************
          * Depending on parallel_mode, there are two possible ways
          * to organize the search. Here we define local functions
@@ -435,6 +488,7 @@ void IndexIVF::search_preassigned(
         auto init_result = [&](float* simi, idx_t* idxi) {
             if (!do_heap_init)
                 return;
+            StageTimer timer(heap_cycles, do_timers);
             if (metric_type == METRIC_INNER_PRODUCT) {
                 heap_heapify<HeapForIP>(k, simi, idxi);
             } else {
@@ -446,6 +500,7 @@ void IndexIVF::search_preassigned(
                                      const idx_t* local_idx,
                                      float* simi,
                                      idx_t* idxi) {
+            StageTimer timer(heap_cycles, do_timers);
             if (metric_type == METRIC_INNER_PRODUCT) {
                 heap_addn<HeapForIP>(k, simi, idxi, local_dis, local_idx, k);
             } else {
@@ -456,6 +511,7 @@ void IndexIVF::search_preassigned(
         auto reorder_result = [&](float* simi, idx_t* idxi) {
             if (!do_heap_init)
                 return;
+            StageTimer timer(heap_cycles, do_timers);
             if (metric_type == METRIC_INNER_PRODUCT) {
                 heap_reorder<HeapForIP>(k, simi, idxi);
             } else {
@@ -469,6 +525,7 @@ void IndexIVF::search_preassigned(
                                  float coarse_dis_i,
                                  float* simi,
                                  idx_t* idxi) {
+            list_nheap = 0;
             if (key < 0) {
                 // not enough centroids for multiprobe
                 return (size_t)0;
@@ -486,11 +543,15 @@ void IndexIVF::search_preassigned(
                 return (size_t)0;
             }
 
-            scanner->set_list(key, coarse_dis_i);
+            {
+                StageTimer timer(lut_cycles, do_timers);
+                scanner->set_list(key, coarse_dis_i);
+            }
 
             nlistv++;
 
             try {
+                StageTimer timer(scan_cycles, do_timers);
                 InvertedLists::ScopedCodes scodes(invlists, key);
 
                 std::unique_ptr<InvertedLists::ScopedIds> sids;
@@ -501,8 +562,9 @@ void IndexIVF::search_preassigned(
                     ids = sids->get();
                 }
 
-                nheap += scanner->scan_codes(
+                list_nheap = scanner->scan_codes(
                         list_size, scodes.get(), ids, simi, idxi, k);
+                nheap += list_nheap;
 
             } catch (const std::exception& e) {
                 std::lock_guard<std::mutex> lock(exception_mutex);
@@ -527,21 +589,37 @@ void IndexIVF::search_preassigned(
                 }
 
                 // loop over queries
-                scanner->set_query(x + i * d);
+                {
+                    StageTimer timer(lut_cycles, do_timers);
+                    scanner->set_query(x + i * d);
+                }
                 float* simi = distances + i * k;
                 idx_t* idxi = labels + i * k;
 
                 init_result(simi, idxi);
 
                 idx_t nscan = 0;
+                size_t nstable = 0;
 
                 // loop over probes
                 for (size_t ik = 0; ik < nprobe; ik++) {
-                    nscan += scan_one_list(
+                    if (coarse_cutoff(i, ik) ||
+                        (stable_probes && nstable >= stable_probes)) {
+                        nskip += nprobe - ik;
+                        break;
+                    }
+
+                    size_t list_size = scan_one_list(
                             keys[i * nprobe + ik],
                             coarse_dis[i * nprobe + ik],
                             simi,
                             idxi);
+                    nscan += list_size;
+
+                    // missing and empty lists do not count as stable
+                    if (list_size > 0) {
+                        nstable = list_nheap == 0 ? nstable + 1 : 0;
+                    }
 
                     if (max_codes && nscan >= max_codes) {
                         break;
@@ -561,11 +639,18 @@ void IndexIVF::search_preassigned(
             std::vector<float> local_dis(k);
 
             for (size_t i = 0; i < n; i++) {
-                scanner->set_query(x + i * d);
+                {
+                    StageTimer timer(lut_cycles, do_timers);
+                    scanner->set_query(x + i * d);
+                }
                 init_result(local_dis.data(), local_idx.data());
 
 #pragma omp for schedule(dynamic)
                 for (idx_t ik = 0; ik < nprobe; ik++) {
+                    if (coarse_cutoff(i, ik)) {
+                        nskip++;
+                        continue;
+                    }
                     ndis += scan_one_list(
                             keys[i * nprobe + ik],
                             coarse_dis[i * nprobe + ik],
@@ -605,7 +690,15 @@ void IndexIVF::search_preassigned(
                 size_t i = ij / nprobe;
                 size_t j = ij % nprobe;
 
-                scanner->set_query(x + i * d);
+                if (coarse_cutoff(i, j)) {
+                    nskip++;
+                    continue;
+                }
+
+                {
+                    StageTimer timer(lut_cycles, do_timers);
+                    scanner->set_query(x + i * d);
+                }
                 init_result(local_dis.data(), local_idx.data());
                 ndis += scan_one_list(
                         keys[ij],
@@ -639,6 +732,139 @@ void IndexIVF::search_preassigned(
         }
     }
 
+    if (ivf_stats) {
+        ivf_stats->nq += n;
+        ivf_stats->nlist += nlistv;
+        ivf_stats->ndis += ndis;
+        ivf_stats->nheap_updates += nheap;
+        ivf_stats->nprobe_skipped += nskip;
+        ivf_stats->lut_cycles += lut_cycles;
+        ivf_stats->scan_cycles += scan_cycles;
+        ivf_stats->heap_cycles += heap_cycles;
+    }
+}
+
+void IndexIVF::search_preassigned_sweep(
+        idx_t n,
+        const float* x,
+        idx_t k,
+        size_t n_nprobes,
+        const idx_t* nprobes,
+        const idx_t* keys,
+        const float* coarse_dis,
+        float* distances,
+        idx_t* labels,
+        IndexIVFStats* ivf_stats) const {
+    FAISS_THROW_IF_NOT(k > 0);
+    FAISS_THROW_IF_NOT(n_nprobes > 0);
+    for (size_t s = 0; s < n_nprobes; s++) {
+        FAISS_THROW_IF_NOT_MSG(
+                nprobes[s] > 0 && (s == 0 || nprobes[s] >= nprobes[s - 1]),
+                "nprobes should be positive and increasing");
+    }
+    // stride of keys and coarse_dis
+    idx_t max_nprobe = nprobes[n_nprobes - 1];
+
+    size_t nlistv = 0, ndis = 0, nheap = 0;
+
+    using HeapForIP = CMin<float, idx_t>;
+    using HeapForL2 = CMax<float, idx_t>;
+
+    bool interrupt = false;
+    std::mutex exception_mutex;
+    std::string exception_string;
+
+#pragma omp parallel if (n > 1) reduction(+ : nlistv, ndis, nheap)
+    {
+        InvertedListScanner* scanner = get_InvertedListScanner(false);
+        ScopeDeleter1<InvertedListScanner> del(scanner);
+
+        // persistent result heap of the current query
+        std::vector<float> simi(k);
+        std::vector<idx_t> idxi(k);
+
+#pragma omp for
+        for (idx_t i = 0; i < n; i++) {
+            if (interrupt) {
+                continue;
+            }
+
+            scanner->set_query(x + i * d);
+            if (metric_type == METRIC_INNER_PRODUCT) {
+                heap_heapify<HeapForIP>(k, simi.data(), idxi.data());
+            } else {
+                heap_heapify<HeapForL2>(k, simi.data(), idxi.data());
+            }
+
+            idx_t ik = 0;
+            for (size_t s = 0; s < n_nprobes; s++) {
+                // scan the lists added by this nprobe only
+                for (; ik < nprobes[s]; ik++) {
+                    idx_t key = keys[i * max_nprobe + ik];
+                    if (key < 0) {
+                        // not enough centroids for multiprobe
+                        continue;
+                    }
+                    try {
+                        FAISS_THROW_IF_NOT_FMT(
+                                key < (idx_t)nlist,
+                                "Invalid key=%" PRId64 " nlist=%zd\n",
+                                key,
+                                nlist);
+                        size_t list_size = invlists->list_size(key);
+                        if (list_size == 0) {
+                            continue;
+                        }
+                        scanner->set_list(key, coarse_dis[i * max_nprobe + ik]);
+                        nlistv++;
+
+                        InvertedLists::ScopedCodes scodes(invlists, key);
+                        InvertedLists::ScopedIds sids(invlists, key);
+                        nheap += scanner->scan_codes(
+                                list_size,
+                                scodes.get(),
+                                sids.get(),
+                                simi.data(),
+                                idxi.data(),
+                                k);
+                        ndis += list_size;
+                    } catch (const std::exception& e) {
+                        std::lock_guard<std::mutex> lock(exception_mutex);
+                        exception_string =
+                                demangle_cpp_symbol(typeid(e).name()) + "  " +
+                                e.what();
+                        interrupt = true;
+                        break;
+                    }
+                }
+
+                // output a sorted copy of the heap
+                float* D_s = distances + (s * n + i) * k;
+                idx_t* I_s = labels + (s * n + i) * k;
+                std::copy(simi.begin(), simi.end(), D_s);
+                std::copy(idxi.begin(), idxi.end(), I_s);
+                if (metric_type == METRIC_INNER_PRODUCT) {
+                    heap_reorder<HeapForIP>(k, D_s, I_s);
+                } else {
+                    heap_reorder<HeapForL2>(k, D_s, I_s);
+                }
+            }
+
+            if (InterruptCallback::is_interrupted()) {
+                interrupt = true;
+            }
+        }
+    }
+
+    if (interrupt) {
+        if (!exception_string.empty()) {
+            FAISS_THROW_FMT(
+                    "search interrupted with: %s", exception_string.c_str());
+        } else {
+            FAISS_THROW_MSG("computation interrupted");
+        }
+    }
+
     if (ivf_stats) {
         ivf_stats->nq += n;
         ivf_stats->nlist += nlistv;
@@ -1102,12 +1328,19 @@ void IndexIVFStats::add(const IndexIVFStats& other) {
     nlist += other.nlist;
     ndis += other.ndis;
     nheap_updates += other.nheap_updates;
+    nprobe_skipped += other.nprobe_skipped;
     quantization_time += other.quantization_time;
     search_time += other.search_time;
+    quantization_cycles += other.quantization_cycles;
+    lut_cycles += other.lut_cycles;
+    scan_cycles += other.scan_cycles;
+    heap_cycles += other.heap_cycles;
 }
 
 IndexIVFStats indexIVF_stats;
 
+bool indexIVF_stage_timers = false;
+
 /*************************************************************************
  * InvertedListScanner
  *************************************************************************/
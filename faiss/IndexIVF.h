@@ -65,7 +65,24 @@ struct Level1Quantizer {
 struct IVFSearchParameters {
     size_t nprobe;    ///< number of probes at query time
     size_t max_codes; ///< max nb of codes to visit to do a query
-    IVFSearchParameters() : nprobe(1), max_codes(0) {}
+
+    /** Adaptive nprobe: stop visiting the lists of a query before the
+     * nprobe-th when one of the criteria below is met. The skipped probes
+     * are counted in IndexIVFStats::nprobe_skipped. */
+
+    /// stop at the first list whose coarse distance is larger than
+    /// coarse_dis_ratio times the one of the nearest list (L2 only,
+    /// 0 = disabled). Not applied to the queries whose nearest coarse
+    /// distance is below 1/1000 of the second nearest one.
+    float coarse_dis_ratio;
+
+    /// stop after this many consecutive non-empty lists that did not update
+    /// the result heap. Like max_codes, applied only with parallel_mode 0
+    /// and 3 (0 = disabled)
+    size_t stable_probes;
+
+    IVFSearchParameters()
+            : nprobe(1), max_codes(0), coarse_dis_ratio(0), stable_probes(0) {}
     virtual ~IVFSearchParameters() {}
 };
 
@@ -212,6 +229,35 @@ struct IndexIVF : Index, Level1Quantizer {
             const IVFSearchParameters* params = nullptr,
             IndexIVFStats* stats = nullptr) const;
 
+    /** search the preassigned lists for several values of nprobe at once.
+     *
+     * The per-query result heaps persist across the sweep: for each
+     * nprobe, only the lists added since the previous (smaller) nprobe
+     * are scanned, and a sorted copy of the heaps is output. The results
+     * for nprobes[s] are the same as those of search_preassigned with
+     * nprobe = nprobes[s].
+     *
+     * @param n_nprobes  nb of nprobe values
+     * @param nprobes    increasing nprobe values, size n_nprobes
+     * @param assign     coarse assignment, size n * nprobes[n_nprobes - 1]
+     * @param centroid_dis
+     *                   coarse distances, size n * nprobes[n_nprobes - 1]
+     * @param distances  output distances, size n_nprobes * n * k
+     * @param labels     output labels, size n_nprobes * n * k
+     * @param stats      search stats to be updated (can be null)
+     */
+    void search_preassigned_sweep(
+            idx_t n,
+            const float* x,
+            idx_t k,
+            size_t n_nprobes,
+            const idx_t* nprobes,
+            const idx_t* assign,
+            const float* centroid_dis,
+            float* distances,
+            idx_t* labels,
+            IndexIVFStats* stats = nullptr) const;
+
     /** assign the vectors, then call search_preassign */
     void search(
             idx_t n,
@@ -416,9 +462,17 @@ struct IndexIVFStats {
     size_t nlist;             // nb of inverted lists scanned
     size_t ndis;              // nb of distances computed
     size_t nheap_updates;     // nb of times the heap was updated
+    size_t nprobe_skipped;    // nb of probes skipped by the adaptive nprobe
     double quantization_time; // time spent quantizing vectors (in ms)
     double search_time;       // time spent searching lists (in ms)
 
+    // per-stage timings, measured with the CPU RTC and summed over all
+    // threads. Collected only when indexIVF_stage_timers is set
+    uint64_t quantization_cycles; // coarse quantizer + nprobe selection
+    uint64_t lut_cycles;          // scanner set_query / set_list (tables)
+    uint64_t scan_cycles;         // scanning the codes of inverted lists
+    uint64_t heap_cycles;         // result heap init, merge and reorder
+
     IndexIVFStats() {
         reset();
     }
@@ -429,6 +483,9 @@ struct IndexIVFStats {
 // global var that collects them all
 FAISS_API extern IndexIVFStats indexIVF_stats;
 
+/// enable the per-stage cycle counters of IndexIVFStats (default false)
+FAISS_API extern bool indexIVF_stage_timers;
+
 } // namespace faiss
 
 #endif
@@ -16,6 +16,7 @@
 
 #include <faiss/impl/AuxIndexStructures.h>
 #include <faiss/impl/FaissAssert.h>
+#include <faiss/utils/utils.h>
 
 namespace faiss {
 
@@ -23,6 +24,12 @@ namespace faiss {
  * IndexPreTransform
  *********************************************/
 
+IndexPreTransformStats indexPreTransform_stats;
+
+void IndexPreTransformStats::reset() {
+    memset(this, 0, sizeof(*this));
+}
+
 IndexPreTransform::IndexPreTransform() : index(nullptr), own_fields(false) {}
 
 IndexPreTransform::IndexPreTransform(Index* index)
@@ -166,7 +173,10 @@ void IndexPreTransform::search(
     FAISS_THROW_IF_NOT(k > 0);
 
     FAISS_THROW_IF_NOT(is_trained);
+    uint64_t t0 = get_cycles();
     const float* xt = apply_chain(n, x);
+    indexPreTransform_stats.nq += n;
+    indexPreTransform_stats.transform_cycles += get_cycles() - t0;
     ScopeDeleter<float> del(xt == x ? nullptr : xt);
     index->search(n, xt, k, distances, labels);
 }
@@ -177,7 +187,10 @@ void IndexPreTransform::range_search(
         float radius,
         RangeSearchResult* result) const {
     FAISS_THROW_IF_NOT(is_trained);
+    uint64_t t0 = get_cycles();
     const float* xt = apply_chain(n, x);
+    indexPreTransform_stats.nq += n;
+    indexPreTransform_stats.transform_cycles += get_cycles() - t0;
     ScopeDeleter<float> del(xt == x ? nullptr : xt);
     index->range_search(n, xt, radius, result);
 }
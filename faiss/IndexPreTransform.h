@@ -11,6 +11,7 @@
 
 #include <faiss/Index.h>
 #include <faiss/VectorTransform.h>
+#include <faiss/impl/platform_macros.h>
 
 namespace faiss {
 
@@ -87,4 +88,19 @@ struct IndexPreTransform : Index {
     ~IndexPreTransform() override;
 };
 
+struct IndexPreTransformStats {
+    size_t nq; ///< nb of queries transformed by search and range_search
+
+    // timing measured with the CPU RTC
+    uint64_t transform_cycles; ///< applying the chain to the queries
+
+    IndexPreTransformStats() {
+        reset();
+    }
+    void reset();
+};
+
+// global var that collects them all
+FAISS_API extern IndexPreTransformStats indexPreTransform_stats;
+
 } // namespace faiss
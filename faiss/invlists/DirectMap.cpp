@@ -14,6 +14,7 @@
 
 #include <faiss/impl/AuxIndexStructures.h>
 #include <faiss/impl/FaissAssert.h>
+#include <faiss/invlists/OnDiskInvertedLists.h>
 
 namespace faiss {
 
@@ -149,6 +150,12 @@ size_t DirectMap::remove_ids(const IDSelector& sel, InvertedLists* invlists) {
     size_t nremove = 0;
 
     if (type == NoMap) {
+        // the update log marks the entries as deleted instead of moving
+        // them, which would not be visible in the lists being scanned
+        OnDiskInvertedLists* od = dynamic_cast<OnDiskInvertedLists*>(invlists);
+        if (od && od->update_log) {
+            return od->remove_ids(sel);
+        }
         // exhaustive scan of IVF
 #pragma omp parallel for
         for (idx_t i = 0; i < nlist; i++) {
@@ -9,7 +9,12 @@
 
 #include <faiss/invlists/InvertedLists.h>
 
+#include <algorithm>
+#include <condition_variable>
 #include <cstdio>
+#include <cstring>
+#include <list>
+#include <mutex>
 
 #include <faiss/impl/FaissAssert.h>
 #include <faiss/utils/utils.h>
@@ -632,4 +637,389 @@ void StopWordsInvertedLists::prefetch_lists(const idx_t* list_nos, int nlist)
     il0->prefetch_lists(list0.data(), list0.size());
 }
 
+/*****************************************
+ * CachedInvertedLists implementation
+ ******************************************/
+
+void InvertedListsCacheStats::reset() {
+    memset(this, 0, sizeof(*this));
+}
+
+namespace {
+
+enum CacheSegment { SEG_PROBATION, SEG_PROTECTED, SEG_PINNED };
+
+enum CacheEntryState { ENTRY_LOADING, ENTRY_READY, ENTRY_FAILED };
+
+} // namespace
+
+struct CachedInvertedLists::Cache {
+    struct Entry {
+        std::vector<uint8_t> codes;
+        std::vector<idx_t> ids;
+        size_t nbytes;
+        int nref;
+        CacheEntryState state;
+        CacheSegment segment;
+        std::list<idx_t>::iterator pos;
+    };
+
+    CachedInvertedLists* owner;
+
+    std::mutex mutex;
+    std::condition_variable loaded;
+
+    std::vector<Entry*> entries; // size nlist, nullptr if not cached
+
+    // most recently used at the front
+    std::list<idx_t> probation, protected_lists;
+    size_t size, protected_size;
+
+    // TinyLFU frequencies. The key space (nlist) is small enough to
+    // count exactly rather than with a sketch.
+    std::vector<uint32_t> freq;
+    size_t nincrement, sample_size;
+
+    explicit Cache(CachedInvertedLists* owner)
+            : owner(owner),
+              entries(owner->nlist, nullptr),
+              size(0),
+              protected_size(0),
+              freq(owner->nlist, 0),
+              nincrement(0),
+              sample_size(std::max(owner->nlist * 10, size_t(1000))) {}
+
+    ~Cache() {
+        for (Entry* e : entries) {
+            delete e;
+        }
+    }
+
+    std::list<idx_t>& segment_list(Entry* e) {
+        return e->segment == SEG_PROBATION ? probation : protected_lists;
+    }
+
+    void record_access(size_t list_no) {
+        freq[list_no]++;
+        if (++nincrement >= sample_size) {
+            // aging
+            for (uint32_t& f : freq) {
+                f >>= 1;
+            }
+            nincrement = 0;
+        }
+    }
+
+    void detach(size_t list_no) {
+        Entry* e = entries[list_no];
+        if (e->segment != SEG_PINNED) {
+            segment_list(e).erase(e->pos);
+        }
+        if (e->segment == SEG_PROTECTED) {
+            protected_size -= e->nbytes;
+        }
+        size -= e->nbytes;
+        entries[list_no] = nullptr;
+    }
+
+    void push_front(size_t list_no, CacheSegment segment) {
+        Entry* e = entries[list_no];
+        e->segment = segment;
+        std::list<idx_t>& l = segment_list(e);
+        l.push_front(list_no);
+        e->pos = l.begin();
+        if (segment == SEG_PROTECTED) {
+            protected_size += e->nbytes;
+        }
+    }
+
+    /// move the list to the MRU position of its segment, promote it to
+    /// the protected segment if it was on probation
+    void touch(size_t list_no) {
+        Entry* e = entries[list_no];
+        if (e->segment == SEG_PINNED) {
+            return;
+        }
+        segment_list(e).erase(e->pos);
+        if (e->segment == SEG_PROTECTED) {
+            protected_size -= e->nbytes;
+        }
+        push_front(list_no, SEG_PROTECTED);
+        size_t max_protected = owner->max_cache_size * owner->protected_ratio;
+        while (protected_size > max_protected) {
+            idx_t victim = protected_lists.back();
+            protected_lists.pop_back();
+            protected_size -= entries[victim]->nbytes;
+            push_front(victim, SEG_PROBATION);
+        }
+    }
+
+    /** find the lists to evict to make room for nbytes. Returns false if
+     * there are not enough evictable lists. */
+    bool select_victims(size_t nbytes, std::vector<idx_t>& victims) {
+        size_t max_size = owner->max_cache_size;
+        size_t freed = 0;
+        for (std::list<idx_t>* l : {&probation, &protected_lists}) {
+            for (auto it = l->rbegin(); it != l->rend(); ++it) {
+                if (size + nbytes - freed <= max_size) {
+                    return true;
+                }
+                Entry* e = entries[*it];
+                if (e->nref > 0) {
+                    continue;
+                }
+                victims.push_back(*it);
+                freed += e->nbytes;
+            }
+        }
+        return size + nbytes - freed <= max_size;
+    }
+
+    void evict(idx_t list_no) {
+        Entry* e = entries[list_no];
+        detach(list_no);
+        delete e;
+        owner->stats.nevict++;
+    }
+
+    /** get the entry of a list, loading it if needed. Returns nullptr if
+     * the list should be read from the backing lists instead. The entry
+     * is returned with a reference that must be released.
+     *
+     * @param is_access  count as an access for the statistics and policy,
+     *                   lists are loaded only on accesses
+     * @param force      load the list, bypassing the admission policy
+     *                   (for pinning)
+     */
+    Entry* acquire(size_t list_no, bool is_access, bool force) {
+        std::unique_lock<std::mutex> lock(mutex);
+        if (is_access) {
+            record_access(list_no);
+        }
+        Entry* e = entries[list_no];
+        if (e) {
+            e->nref++;
+            if (is_access) {
+                owner->stats.nhit++;
+                touch(list_no);
+            }
+            while (e->state == ENTRY_LOADING) {
+                loaded.wait(lock);
+            }
+            if (e->state == ENTRY_FAILED) {
+                unref(e);
+                return nullptr;
+            }
+            return e;
+        }
+        if (is_access) {
+            owner->stats.nmiss++;
+        } else if (!force) {
+            // only get_codes loads lists, get_ids follows its decision
+            return nullptr;
+        }
+
+        size_t ls = owner->il->list_size(list_no);
+        size_t nbytes = ls * (owner->code_size + sizeof(idx_t));
+        std::vector<idx_t> victims;
+        bool admit = nbytes > 0 &&
+                (force || nbytes <= owner->max_cache_size) &&
+                (select_victims(nbytes, victims) || force);
+        if (admit && owner->frequency_admission && !force) {
+            for (idx_t victim : victims) {
+                if (freq[victim] >= freq[list_no]) {
+                    admit = false;
+                    break;
+                }
+            }
+        }
+        if (!admit) {
+            owner->stats.nreject++;
+            return nullptr;
+        }
+        for (idx_t victim : victims) {
+            evict(victim);
+        }
+
+        e = new Entry();
+        e->nbytes = nbytes;
+        e->nref = 1;
+        e->state = ENTRY_LOADING;
+        e->codes.resize(ls * owner->code_size);
+        e->ids.resize(ls);
+        entries[list_no] = e;
+        size += nbytes;
+        push_front(list_no, SEG_PROBATION);
+        owner->stats.nadmit++;
+
+        // copy the list without holding the lock, so that other lists
+        // can be accessed meanwhile
+        lock.unlock();
+        try {
+            const InvertedLists* il = owner->il;
+            memcpy(e->codes.data(),
+                   ScopedCodes(il, list_no).get(),
+                   e->codes.size());
+            memcpy(e->ids.data(),
+                   ScopedIds(il, list_no).get(),
+                   ls * sizeof(idx_t));
+        } catch (...) {
+            lock.lock();
+            detach(list_no);
+            e->state = ENTRY_FAILED;
+            unref(e);
+            loaded.notify_all();
+            throw;
+        }
+        lock.lock();
+        e->state = ENTRY_READY;
+        owner->stats.bytes_loaded += nbytes;
+        loaded.notify_all();
+        return e;
+    }
+
+    void unref(Entry* e) {
+        e->nref--;
+        if (e->nref == 0 && e->state == ENTRY_FAILED) {
+            delete e;
+        }
+    }
+
+    /// returns false if ptr does not belong to the cached list
+    bool release(size_t list_no, const void* ptr) {
+        std::unique_lock<std::mutex> lock(mutex);
+        Entry* e = entries[list_no];
+        if (!e ||
+            (ptr != e->codes.data() && ptr != (const void*)e->ids.data())) {
+            return false;
+        }
+        unref(e);
+        return true;
+    }
+};
+
+CachedInvertedLists::CachedInvertedLists(
+        const InvertedLists* il,
+        size_t max_cache_size,
+        float protected_ratio,
+        bool frequency_admission)
+        : ReadOnlyInvertedLists(il->nlist, il->code_size),
+          il(il),
+          max_cache_size(max_cache_size),
+          protected_ratio(protected_ratio),
+          frequency_admission(frequency_admission) {
+    FAISS_THROW_IF_NOT(protected_ratio >= 0 && protected_ratio <= 1);
+    cache = new Cache(this);
+}
+
+CachedInvertedLists::~CachedInvertedLists() {
+    delete cache;
+}
+
+size_t CachedInvertedLists::list_size(size_t list_no) const {
+    return il->list_size(list_no);
+}
+
+const uint8_t* CachedInvertedLists::get_codes(size_t list_no) const {
+    Cache::Entry* e = cache->acquire(list_no, true, false);
+    return e ? e->codes.data() : il->get_codes(list_no);
+}
+
+const idx_t* CachedInvertedLists::get_ids(size_t list_no) const {
+    Cache::Entry* e = cache->acquire(list_no, false, false);
+    return e ? e->ids.data() : il->get_ids(list_no);
+}
+
+void CachedInvertedLists::release_codes(size_t list_no, const uint8_t* codes)
+        const {
+    if (!cache->release(list_no, codes)) {
+        il->release_codes(list_no, codes);
+    }
+}
+
+void CachedInvertedLists::release_ids(size_t list_no, const idx_t* ids) const {
+    if (!cache->release(list_no, ids)) {
+        il->release_ids(list_no, ids);
+    }
+}
+
+idx_t CachedInvertedLists::get_single_id(size_t list_no, size_t offset) const {
+    return il->get_single_id(list_no, offset);
+}
+
+const uint8_t* CachedInvertedLists::get_single_code(
+        size_t list_no,
+        size_t offset) const {
+    return il->get_single_code(list_no, offset);
+}
+
+void CachedInvertedLists::prefetch_lists(const idx_t* list_nos, int nlist)
+        const {
+    std::vector<idx_t> to_fetch;
+    {
+        std::lock_guard<std::mutex> lock(cache->mutex);
+        for (int i = 0; i < nlist; i++) {
+            idx_t list_no = list_nos[i];
+            if (list_no >= 0 && !cache->entries[list_no]) {
+                to_fetch.push_back(list_no);
+            }
+        }
+    }
+    il->prefetch_lists(to_fetch.data(), to_fetch.size());
+}
+
+void CachedInvertedLists::pin_lists(size_t n, const idx_t* list_nos) {
+    for (size_t i = 0; i < n; i++) {
+        idx_t list_no = list_nos[i];
+        FAISS_THROW_IF_NOT(list_no >= 0 && list_no < nlist);
+        Cache::Entry* e = cache->acquire(list_no, false, true);
+        if (!e) { // empty list
+            continue;
+        }
+        std::lock_guard<std::mutex> lock(cache->mutex);
+        if (e->segment != SEG_PINNED) {
+            cache->segment_list(e).erase(e->pos);
+            if (e->segment == SEG_PROTECTED) {
+                cache->protected_size -= e->nbytes;
+            }
+            e->segment = SEG_PINNED;
+        }
+        cache->unref(e);
+    }
+}
+
+void CachedInvertedLists::unpin_lists(size_t n, const idx_t* list_nos) {
+    std::lock_guard<std::mutex> lock(cache->mutex);
+    for (size_t i = 0; i < n; i++) {
+        idx_t list_no = list_nos[i];
+        FAISS_THROW_IF_NOT(list_no >= 0 && list_no < nlist);
+        Cache::Entry* e = cache->entries[list_no];
+        if (e && e->segment == SEG_PINNED) {
+            cache->push_front(list_no, SEG_PROBATION);
+        }
+    }
+}
+
+void CachedInvertedLists::clear_cache() {
+    std::lock_guard<std::mutex> lock(cache->mutex);
+    for (size_t list_no = 0; list_no < nlist; list_no++) {
+        Cache::Entry* e = cache->entries[list_no];
+        if (e && e->nref == 0) {
+            cache->detach(list_no);
+            delete e;
+        }
+    }
+}
+
+size_t CachedInvertedLists::cache_size() const {
+    std::lock_guard<std::mutex> lock(cache->mutex);
+    return cache->size;
+}
+
+bool CachedInvertedLists::is_cached(size_t list_no) const {
+    std::lock_guard<std::mutex> lock(cache->mutex);
+    Cache::Entry* e = cache->entries[list_no];
+    return e && e->state == ENTRY_READY;
+}
+
 } // namespace faiss
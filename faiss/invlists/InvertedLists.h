@@ -361,6 +361,99 @@ struct StopWordsInvertedLists : ReadOnlyInvertedLists {
     void prefetch_lists(const idx_t* list_nos, int nlist) const override;
 };
 
+/// statistics of a CachedInvertedLists
+struct InvertedListsCacheStats {
+    size_t nhit;     ///< get_codes calls served from the cache
+    size_t nmiss;    ///< get_codes calls that had to access the backing lists
+    size_t nadmit;   ///< lists copied into the cache
+    size_t nreject;  ///< misses not admitted, served by the backing lists
+    size_t nevict;   ///< lists evicted from the cache
+    size_t bytes_loaded; ///< bytes copied into the cache
+
+    InvertedListsCacheStats() {
+        reset();
+    }
+    void reset();
+};
+
+/** Memory-budgeted cache of the lists of another InvertedLists
+ *
+ * The codes and ids of the accessed lists are copied into RAM, up to
+ * max_cache_size bytes, so that their residency does not depend on the
+ * page cache (e.g. for an OnDiskInvertedLists or a VStackInvertedLists
+ * of those).
+ *
+ * Eviction is a segmented LRU: lists enter a probation segment and move
+ * to a protected segment (at most protected_ratio of the cache) when
+ * they are accessed again. The victims are taken from the LRU end of the
+ * probation segment first. With frequency_admission (TinyLFU), the
+ * access frequencies of all lists are counted (and halved periodically
+ * to age them), and a list that is not in the cache is admitted only if
+ * it is more frequent than the lists it would evict. Otherwise it is
+ * served directly by the backing lists. protected_ratio = 0 and
+ * frequency_admission = false is a plain LRU.
+ *
+ * The lists returned by get_codes / get_ids are pinned until
+ * release_codes / release_ids, so the cache may temporarily exceed its
+ * budget. Lists larger than the whole cache are never cached.
+ *
+ * The cache is not aware of updates of the backing lists: call
+ * clear_cache after modifying them.
+ */
+struct CachedInvertedLists : ReadOnlyInvertedLists {
+    const InvertedLists* il;
+    size_t max_cache_size;   ///< budget in bytes for the cached lists
+    float protected_ratio;   ///< fraction of the budget for the protected segment
+    bool frequency_admission; ///< TinyLFU admission of new lists
+
+    /// accesses and cache behavior
+    mutable InvertedListsCacheStats stats;
+
+    CachedInvertedLists(
+            const InvertedLists* il,
+            size_t max_cache_size,
+            float protected_ratio = 0.8,
+            bool frequency_admission = true);
+
+    size_t list_size(size_t list_no) const override;
+    const uint8_t* get_codes(size_t list_no) const override;
+    const idx_t* get_ids(size_t list_no) const override;
+
+    void release_codes(size_t list_no, const uint8_t* codes) const override;
+    void release_ids(size_t list_no, const idx_t* ids) const override;
+
+    idx_t get_single_id(size_t list_no, size_t offset) const override;
+
+    const uint8_t* get_single_code(size_t list_no, size_t offset)
+            const override;
+
+    /// forwarded to the backing lists, for the lists that are not cached
+    void prefetch_lists(const idx_t* list_nos, int nlist) const override;
+
+    /** load lists in the cache and keep them out of the eviction policy
+     * (they still count in the budget) */
+    void pin_lists(size_t n, const idx_t* list_nos);
+
+    /// make pinned lists evictable again
+    void unpin_lists(size_t n, const idx_t* list_nos);
+
+    /// drop all the cached lists that are not in use (pinned ones too)
+    void clear_cache();
+
+    /// nb of bytes currently in the cache
+    size_t cache_size() const;
+
+    /// is the list currently in the cache
+    bool is_cached(size_t list_no) const;
+
+    ~CachedInvertedLists() override;
+
+    // private
+
+    struct Cache;
+    Cache* cache;
+};
+
 } // namespace faiss
 
 #endif
@@ -11,13 +11,27 @@
 
 #include <pthread.h>
 
+#include <algorithm>
+#include <atomic>
+#include <chrono>
+#include <cinttypes>
+#include <condition_variable>
+#include <deque>
+#include <map>
+#include <memory>
+#include <mutex>
+#include <thread>
+#include <unordered_map>
 #include <unordered_set>
 
+#include <fcntl.h>
+
 #include <sys/mman.h>
 #include <sys/stat.h>
 #include <sys/types.h>
 #include <unistd.h>
 
+#include <faiss/impl/AuxIndexStructures.h>
 #include <faiss/impl/FaissAssert.h>
 #include <faiss/utils/utils.h>
 
@@ -154,8 +168,8 @@ struct OnDiskInvertedLists::OngoingPrefetch {
             const OnDiskInvertedLists* od = pf->od;
             od->locks->lock_1(list_no);
             size_t n = od->list_size(list_no);
-            const Index::idx_t* idx = od->get_ids(list_no);
-            const uint8_t* codes = od->get_codes(list_no);
+            const Index::idx_t* idx = od->mapped_ids(list_no);
+            const uint8_t* codes = od->mapped_codes(list_no);
             int cs = 0;
             for (size_t i = 0; i < n; i++) {
                 cs += idx[i];
@@ -256,8 +270,1556 @@ struct OnDiskInvertedLists::OngoingPrefetch {
 
 int OnDiskInvertedLists::OngoingPrefetch::global_cs = 0;
 
+#define INVALID_OFFSET (size_t)(-1)
+
+/**********************************************
+ * AsyncReader
+ **********************************************/
+
+void OnDiskIOStats::reset() {
+    memset(this, 0, sizeof(*this));
+}
+
+struct OnDiskInvertedLists::AsyncReader {
+    const OnDiskInvertedLists* od;
+    int fd;
+    size_t pool_size;
+
+    // a list read from the file: codes (size * code_size) followed by ids
+    struct Buffer {
+        enum State { QUEUED, READING, READY } state;
+        std::vector<uint8_t> data;
+        size_t size = 0;
+        int npin = 0;
+        bool used = false; // accessed since it was read
+        bool error = false;
+        uint64_t last_use = 0;
+    };
+
+    std::mutex mutex;
+    std::condition_variable cv_queue; // new lists to read
+    std::condition_variable cv_ready; // a read completed
+    std::condition_variable cv_space; // space in the pool
+    std::unordered_map<idx_t, std::unique_ptr<Buffer>> buffers;
+    std::deque<idx_t> queue;
+    size_t pool_used = 0; // bytes of the buffers being read or ready
+    uint64_t clock = 0;
+    bool stop = false;
+    std::vector<std::thread> threads;
+
+    AsyncReader(
+            const OnDiskInvertedLists* od,
+            int queue_depth,
+            size_t pool_size)
+            : od(od), pool_size(pool_size) {
+        fd = open(od->filename.c_str(), O_RDONLY);
+        FAISS_THROW_IF_NOT_FMT(
+                fd >= 0,
+                "could not open %s: %s",
+                od->filename.c_str(),
+                strerror(errno));
+        for (int i = 0; i < queue_depth; i++) {
+            threads.emplace_back([this] { io_loop(); });
+        }
+    }
+
+    ~AsyncReader() {
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            stop = true;
+        }
+        cv_queue.notify_all();
+        cv_space.notify_all();
+        for (auto& th : threads) {
+            th.join();
+        }
+        close(fd);
+    }
+
+    OnDiskIOStats& io_stats() {
+        return od->io_stats;
+    }
+
+    size_t list_nbytes(idx_t list_no) const {
+        return od->lists[list_no].size * (od->code_size + sizeof(idx_t));
+    }
+
+    void pread_all(uint8_t* dest, size_t n, size_t offset) {
+        while (n > 0) {
+            ssize_t nr = pread(fd, dest, n, offset);
+            FAISS_THROW_IF_NOT_FMT(
+                    nr > 0,
+                    "read error on %s: %s",
+                    od->filename.c_str(),
+                    nr == 0 ? "unexpected EOF" : strerror(errno));
+            dest += nr;
+            offset += nr;
+            n -= nr;
+        }
+    }
+
+    // called without the lock, on a buffer in state READING. Sets
+    // b->error if the read fails
+    void read_list(idx_t list_no, Buffer* b) {
+        const List& l = od->lists[list_no];
+        size_t codes_size = l.size * od->code_size;
+        b->size = l.size;
+        try {
+            b->data.resize(list_nbytes(list_no));
+            if (l.size == l.capacity) {
+                // codes and ids are contiguous
+                pread_all(b->data.data(), b->data.size(), l.offset);
+            } else {
+                pread_all(b->data.data(), codes_size, l.offset);
+                pread_all(
+                        b->data.data() + codes_size,
+                        l.size * sizeof(idx_t),
+                        l.offset + l.capacity * od->code_size);
+            }
+        } catch (const FaissException&) {
+            b->error = true;
+        }
+    }
+
+    // evict the least recently used unpinned buffer, possibly only among
+    // those that were accessed already
+    bool evict_one(bool used_only) {
+        auto victim = buffers.end();
+        for (auto it = buffers.begin(); it != buffers.end(); ++it) {
+            const Buffer& b = *it->second;
+            if (b.state != Buffer::READY || b.npin > 0 ||
+                (used_only && !b.used)) {
+                continue;
+            }
+            if (victim == buffers.end() || b.used > victim->second->used ||
+                (b.used == victim->second->used &&
+                 b.last_use < victim->second->last_use)) {
+                victim = it;
+            }
+        }
+        if (victim == buffers.end()) {
+            return false;
+        }
+        pool_used -= victim->second->data.size();
+        buffers.erase(victim);
+        io_stats().nevict++;
+        return true;
+    }
+
+    void io_loop() {
+        std::unique_lock<std::mutex> lock(mutex);
+        for (;;) {
+            cv_queue.wait(lock, [this] { return stop || !queue.empty(); });
+            if (stop) {
+                return;
+            }
+            idx_t list_no = queue.front();
+            queue.pop_front();
+            auto it = buffers.find(list_no);
+            if (it == buffers.end() || it->second->state != Buffer::QUEUED) {
+                continue; // read on demand in the meantime
+            }
+            Buffer* b = it->second.get();
+            size_t nbytes = list_nbytes(list_no);
+            // the prefetched lists that were not accessed yet are not
+            // evicted to make room for further ones: wait
+            bool skip = false;
+            while (pool_used > 0 && pool_used + nbytes > pool_size &&
+                   !evict_one(true)) {
+                cv_space.wait(lock);
+                if (stop) {
+                    return;
+                }
+                it = buffers.find(list_no);
+                if (it == buffers.end() || it->second.get() != b ||
+                    b->state != Buffer::QUEUED) {
+                    skip = true; // read on demand or dropped meanwhile
+                    break;
+                }
+            }
+            if (skip) {
+                continue;
+            }
+            b->state = Buffer::READING;
+            pool_used += nbytes;
+            lock.unlock();
+            read_list(list_no, b);
+            lock.lock();
+            if (b->error) {
+                // dropped, the list is read again on demand
+                pool_used -= nbytes;
+                buffers.erase(list_no);
+                cv_space.notify_all();
+            } else {
+                b->state = Buffer::READY;
+                io_stats().nread++;
+                io_stats().bytes_read += nbytes;
+            }
+            cv_ready.notify_all();
+        }
+    }
+
+    void prefetch(const idx_t* list_nos, int n) {
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            for (int i = 0; i < n; i++) {
+                idx_t list_no = list_nos[i];
+                if (list_no < 0 || od->lists[list_no].size == 0 ||
+                    buffers.count(list_no)) {
+                    continue;
+                }
+                Buffer* b = new Buffer();
+                b->state = Buffer::QUEUED;
+                buffers[list_no].reset(b);
+                queue.push_back(list_no);
+            }
+        }
+        cv_queue.notify_all();
+    }
+
+    // get and pin the buffer of a list
+    Buffer* acquire(idx_t list_no) {
+        std::unique_lock<std::mutex> lock(mutex);
+        bool waited = false;
+        Buffer* b;
+        for (;;) {
+            auto it = buffers.find(list_no);
+            if (it != buffers.end() && it->second->state == Buffer::READY) {
+                b = it->second.get();
+                if (waited) {
+                    io_stats().nwait++;
+                } else {
+                    io_stats().nhit++;
+                }
+                break;
+            }
+            if (it != buffers.end() && it->second->state == Buffer::READING) {
+                // the buffer may be gone when we wake up: look it up again
+                cv_ready.wait(lock);
+                waited = true;
+                continue;
+            }
+            // not prefetched or not started yet: read it now, possibly
+            // beyond the pool size
+            if (it == buffers.end()) {
+                b = new Buffer();
+                buffers[list_no].reset(b);
+            } else {
+                b = it->second.get();
+            }
+            b->state = Buffer::READING;
+            size_t nbytes = list_nbytes(list_no);
+            while (pool_used > 0 && pool_used + nbytes > pool_size &&
+                   evict_one(false)) {
+            }
+            pool_used += nbytes;
+            lock.unlock();
+            read_list(list_no, b);
+            lock.lock();
+            if (b->error) {
+                pool_used -= nbytes;
+                buffers.erase(list_no);
+                cv_ready.notify_all();
+                cv_space.notify_all();
+                FAISS_THROW_FMT(
+                        "could not read list %" PRId64 " of %s",
+                        list_no,
+                        od->filename.c_str());
+            }
+            b->state = Buffer::READY;
+            io_stats().nread_sync++;
+            io_stats().bytes_read += nbytes;
+            cv_ready.notify_all();
+            break;
+        }
+        b->npin++;
+        b->used = true;
+        b->last_use = ++clock;
+        return b;
+    }
+
+    void release(idx_t list_no) {
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            auto it = buffers.find(list_no);
+            FAISS_THROW_IF_NOT(it != buffers.end() && it->second->npin > 0);
+            it->second->npin--;
+        }
+        cv_space.notify_all();
+    }
+
+    // drop the buffer of a list that is being updated
+    void invalidate(idx_t list_no) {
+        std::lock_guard<std::mutex> lock(mutex);
+        auto it = buffers.find(list_no);
+        if (it == buffers.end()) {
+            return;
+        }
+        FAISS_THROW_IF_NOT_MSG(
+                it->second->npin == 0 && it->second->state != Buffer::READING,
+                "list updated while it is being read");
+        pool_used -= it->second->data.size();
+        buffers.erase(it);
+    }
+};
+
+/**********************************************
+ * UpdateLog
+ **********************************************/
+
+void OnDiskUpdateStats::reset() {
+    memset(this, 0, sizeof(*this));
+}
+
+namespace {
+
+// records of the update log file, followed by their payload
+enum LogRecordType : uint64_t {
+    LOG_ADD = 1,       // n ids + codes appended to the log
+    LOG_SET = 2,       // n ids + codes overwrite the list from offset a
+    LOG_RESIZE = 3,    // the log is resized to n entries
+    LOG_TOMBSTONE = 4, // n positions of base entries are deleted
+    LOG_ERASE = 5,     // n positions (increasing) are erased from the log
+    LOG_MOVE_BASE = 6, // the live base entries are moved to the log
+    LOG_DROP_BASE = 7, // the base entries are dropped
+};
+
+struct LogRecord {
+    uint64_t type;
+    uint64_t list_no;
+    uint64_t a;
+    uint64_t n;
+};
+
+// the last list size that list_size returned in this thread, in update
+// log mode
+struct ObservedSize {
+    const void* owner = nullptr;
+    size_t list_no = 0;
+    size_t size = 0;
+};
+
+thread_local ObservedSize observed_size;
+
+} // namespace
+
+struct OnDiskInvertedLists::UpdateLog {
+    OnDiskInvertedLists* od;
+    size_t code_size, entry_size;
+
+    // a mapping of the whole file. Readers pin the mapping their pointers
+    // belong to, so that a compaction can switch to a new one meanwhile
+    struct Mapping {
+        uint8_t* ptr;
+        size_t size;
+        int nref;
+    };
+
+    // log entries of a list. They are only modified by appending in
+    // place, the other updates copy them
+    struct LogEntries {
+        size_t capacity;
+        std::unique_ptr<uint8_t[]> codes;
+        std::unique_ptr<idx_t[]> ids;
+
+        LogEntries(size_t capacity, size_t code_size)
+                : capacity(capacity),
+                  codes(new uint8_t[capacity * code_size]),
+                  ids(new idx_t[capacity]) {}
+    };
+
+    // updates of a list since its base entries were written. A copy of
+    // it is a snapshot that readers can use without the lock
+    struct ListLog {
+        // tombstones of the base entries, replaced when updated
+        std::shared_ptr<const std::vector<bool>> dead;
+        size_t ndead = 0;
+        bool base_dropped = false;
+        std::shared_ptr<LogEntries> entries;
+        size_t n = 0; // nb of log entries
+        // entries removed since the last compaction, oldest first
+        std::shared_ptr<LogEntries> removed;
+        size_t nremoved = 0;
+        uint64_t version = 0;
+
+        bool empty() const {
+            return ndead == 0 && !base_dropped && n == 0;
+        }
+        const uint8_t* codes() const {
+            return entries->codes.get();
+        }
+        const idx_t* ids() const {
+            return entries->ids.get();
+        }
+    };
+
+    std::mutex mutex;
+    Mapping* current;
+    std::vector<Mapping*> retired;
+    std::vector<ListLog> logs;
+    // list sizes, readable without the lock
+    std::vector<std::atomic<size_t>> sizes;
+    // a list handed out to a thread: the mapped list, pinned, or a
+    // materialized snapshot of it
+    struct Reader {
+        int nref = 0;
+        Mapping* m = nullptr;
+        size_t n = 0; // nb of entries
+        const uint8_t* codes = nullptr;
+        const uint8_t* codes_end = nullptr;
+        const idx_t* ids = nullptr;
+        std::vector<uint8_t> codes_buf;
+        std::vector<idx_t> ids_buf;
+
+        bool owns(const void* p) const {
+            return (p >= codes && p < codes_end) || (p >= ids && p < ids + n);
+        }
+    };
+    std::map<std::pair<std::thread::id, size_t>, Reader> readers;
+    // freed regions that readers of the retired mappings may still access
+    std::vector<Slot> pending_free;
+    size_t nbase;  // nb of entries of the base lists
+    size_t ndirty; // nb of log entries, tombstones and dropped entries
+
+    std::string log_fname;
+    FILE* log_file;
+    bool unsynced; // records written since the last fsync
+    // hashes of the earlier layouts of the lists that the layout of the
+    // log file replaces
+    std::vector<uint64_t> prev_layouts;
+
+    // one compaction or fsync of the log file at a time
+    std::mutex compact_mutex;
+    std::condition_variable cv_background;
+    float compact_ratio;
+    double sync_interval;
+    bool stop;
+    std::thread background;
+
+    explicit UpdateLog(OnDiskInvertedLists* od)
+            : od(od),
+              code_size(od->code_size),
+              entry_size(od->code_size + sizeof(idx_t)),
+              logs(od->nlist),
+              sizes(od->nlist),
+              nbase(0),
+              ndirty(0),
+              log_fname(od->filename + ".log"),
+              log_file(nullptr),
+              unsynced(false),
+              compact_ratio(0),
+              sync_interval(0),
+              stop(false) {
+        current = new Mapping{od->ptr, od->totsize, 0};
+        init_base();
+
+        try {
+            replay();
+            if (!log_file) {
+                write_checkpoint();
+            }
+        } catch (...) {
+            if (log_file) {
+                fclose(log_file);
+            }
+            delete current;
+            throw;
+        }
+    }
+
+    ~UpdateLog() {
+        set_background(0, 0);
+        if (log_file) {
+            fflush(log_file);
+            fsync(fileno(log_file));
+            fclose(log_file);
+        }
+        for (Mapping* m : retired) {
+            if (m->ptr) {
+                munmap(m->ptr, m->size);
+            }
+            delete m;
+        }
+        for (const Slot& s : pending_free) {
+            od->free_slot(s.offset, s.capacity);
+        }
+        delete current; // the current mapping is od->ptr
+    }
+
+    /*************** background compaction and fsync */
+
+    bool need_compaction() const {
+        return compact_ratio > 0 &&
+                ndirty > compact_ratio * std::max(nbase, size_t(1000));
+    }
+
+    void set_background(float ratio, double interval) {
+        if (background.joinable()) {
+            {
+                std::lock_guard<std::mutex> lock(mutex);
+                stop = true;
+            }
+            cv_background.notify_all();
+            background.join();
+        }
+        compact_ratio = ratio;
+        sync_interval = interval;
+        stop = false;
+        if (ratio > 0 || interval > 0) {
+            background = std::thread([this] { background_loop(); });
+        }
+    }
+
+    void background_loop() {
+        // without sync_interval, wake up only to compact
+        auto period = std::chrono::duration<double>(
+                sync_interval > 0 ? sync_interval : 3600.0);
+        std::unique_lock<std::mutex> lock(mutex);
+        for (;;) {
+            cv_background.wait_for(
+                    lock, period, [this] { return stop || need_compaction(); });
+            if (stop) {
+                return;
+            }
+            bool compaction = need_compaction();
+            if (!compaction && !(sync_interval > 0 && unsynced)) {
+                continue;
+            }
+            lock.unlock();
+            try {
+                if (compaction) {
+                    compact(); // makes the log durable as well
+                } else {
+                    sync_log();
+                }
+            } catch (const std::exception& e) {
+                fprintf(stderr,
+                        "%s of %s failed: %s\n",
+                        compaction ? "compaction" : "sync",
+                        od->filename.c_str(),
+                        e.what());
+                std::this_thread::sleep_for(std::chrono::seconds(1));
+            }
+            lock.lock();
+        }
+    }
+
+    void notify_update() {
+        if (need_compaction()) {
+            cv_background.notify_one();
+        }
+    }
+
+    /*************** log file */
+
+    // the list layout identifies the data file state the log applies to
+    static uint64_t layout_hash(
+            const std::vector<List>& lists,
+            size_t totsize) {
+        uint64_t h = hash_bytes(
+                (const uint8_t*)lists.data(), lists.size() * sizeof(List));
+        return h * 1000003 ^ totsize;
+    }
+
+    // recompute what depends on the base lists
+    void init_base() {
+        nbase = 0;
+        for (size_t list_no = 0; list_no < od->nlist; list_no++) {
+            nbase += od->lists[list_no].size;
+            publish_size(list_no);
+        }
+        od->set_slots_from_lists();
+    }
+
+    // switch to the layout of the log file: it was written by a
+    // compaction after the lists of od were saved
+    void adopt_layout(const std::vector<List>& lists, size_t totsize) {
+        struct stat st;
+        FAISS_THROW_IF_NOT_FMT(
+                stat(od->filename.c_str(), &st) == 0 &&
+                        size_t(st.st_size) >= totsize,
+                "%s is smaller than the layout of %s",
+                od->filename.c_str(),
+                log_fname.c_str());
+        if (od->ptr) {
+            munmap(od->ptr, od->totsize);
+            od->ptr = nullptr;
+        }
+        od->lists = lists;
+        od->totsize = totsize;
+        if (totsize > 0) {
+            od->do_mmap();
+        }
+        current->ptr = od->ptr;
+        current->size = totsize;
+        init_base();
+    }
+
+    // fsync the records written so far
+    void sync_log() {
+        std::lock_guard<std::mutex> compact_lock(compact_mutex);
+        int fd;
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            if (!log_file || !unsynced) {
+                return;
+            }
+            FAISS_THROW_IF_NOT_FMT(
+                    fflush(log_file) == 0,
+                    "write error on %s: %s",
+                    log_fname.c_str(),
+                    strerror(errno));
+            unsynced = false;
+            fd = fileno(log_file);
+        }
+        // the log file is replaced only under compact_mutex
+        FAISS_THROW_IF_NOT_FMT(
+                fsync(fd) == 0,
+                "fsync error on %s: %s",
+                log_fname.c_str(),
+                strerror(errno));
+    }
+
+    void open_log(const char* fname, const char* mode) {
+        log_file = fopen(fname, mode);
+        FAISS_THROW_IF_NOT_FMT(
+                log_file, "could not open %s: %s", fname, strerror(errno));
+        setvbuf(log_file, nullptr, _IOFBF, 1 << 20);
+    }
+
+    void write_record(
+            uint64_t type,
+            size_t list_no,
+            size_t a,
+            size_t n,
+            const void* data1 = nullptr,
+            size_t size1 = 0,
+            const void* data2 = nullptr,
+            size_t size2 = 0) {
+        if (!log_file) {
+            return; // replaying
+        }
+        LogRecord r = {type, list_no, a, n};
+        bool ok = fwrite(&r, sizeof(r), 1, log_file) == 1;
+        if (size1 > 0) {
+            ok = ok && fwrite(data1, size1, 1, log_file) == 1;
+        }
+        if (size2 > 0) {
+            ok = ok && fwrite(data2, size2, 1, log_file) == 1;
+        }
+        // made durable by sync_log
+        unsynced = true;
+        FAISS_THROW_IF_NOT_FMT(
+                ok,
+                "write error on %s: %s",
+                log_fname.c_str(),
+                strerror(errno));
+    }
+
+    void replay() {
+        FILE* f = fopen(log_fname.c_str(), "r");
+        if (!f) {
+            return;
+        }
+        // header: layout of the lists and hashes of the earlier layouts
+        uint32_t h = 0;
+        size_t totsize = 0, nlist = 0, nprev = 0;
+        bool ok = fread(&h, sizeof(h), 1, f) == 1 &&
+                fread(&totsize, sizeof(totsize), 1, f) == 1 &&
+                fread(&nlist, sizeof(nlist), 1, f) == 1 &&
+                h == fourcc("odlg") && nlist == od->nlist;
+        std::vector<List> lists(ok ? nlist : 0);
+        ok = ok && fread(lists.data(), sizeof(List), nlist, f) == nlist &&
+                fread(&nprev, sizeof(nprev), 1, f) == 1 && nprev < (1 << 20);
+        std::vector<uint64_t> prev(ok ? nprev : 0);
+        ok = ok && fread(prev.data(), sizeof(uint64_t), nprev, f) == nprev;
+        uint64_t od_layout = layout_hash(od->lists, od->totsize);
+        bool same_layout = ok && layout_hash(lists, totsize) == od_layout;
+        if (!same_layout &&
+            !(ok && std::count(prev.begin(), prev.end(), od_layout) > 0)) {
+            fclose(f);
+            FAISS_THROW_FMT(
+                    "%s does not match the lists of %s",
+                    log_fname.c_str(),
+                    od->filename.c_str());
+        }
+        if (same_layout) {
+            // the lists were saved after the last compaction
+            prev_layouts.clear();
+        } else {
+            // interrupted before the lists were saved after a compaction
+            try {
+                adopt_layout(lists, totsize);
+            } catch (...) {
+                fclose(f);
+                throw;
+            }
+            prev_layouts = prev;
+        }
+        LogRecord r;
+        std::vector<uint8_t> payload;
+        long valid_size = ftell(f);
+        while (fread(&r, sizeof(r), 1, f) == 1) {
+            if (r.type < LOG_ADD || r.type > LOG_DROP_BASE) {
+                break;
+            }
+            size_t payload_size = r.type == LOG_ADD || r.type == LOG_SET
+                    ? r.n * entry_size
+                    : r.type == LOG_TOMBSTONE || r.type == LOG_ERASE
+                    ? r.n * sizeof(uint64_t)
+                    : 0;
+            payload.resize(payload_size);
+            if (payload_size > 0 &&
+                fread(payload.data(), payload_size, 1, f) != 1) {
+                break; // truncated by a crash while appending
+            }
+            if (r.list_no >= od->nlist) {
+                break;
+            }
+            const idx_t* ids = (const idx_t*)payload.data();
+            const uint8_t* codes = payload.data() + r.n * sizeof(idx_t);
+            const uint64_t* positions = (const uint64_t*)payload.data();
+            switch (r.type) {
+                case LOG_ADD:
+                    add(r.list_no, r.n, ids, codes);
+                    break;
+                case LOG_SET:
+                    update(r.list_no, r.a, r.n, ids, codes);
+                    break;
+                case LOG_RESIZE:
+                    resize(r.list_no, base_live(r.list_no) + r.n);
+                    break;
+                case LOG_TOMBSTONE:
+                    tombstone(r.list_no, r.n, positions);
+                    break;
+                case LOG_ERASE:
+                    erase(r.list_no, r.n, positions);
+                    break;
+                case LOG_MOVE_BASE:
+                    move_base(r.list_no);
+                    break;
+                case LOG_DROP_BASE:
+                    drop_base(r.list_no);
+                    break;
+            }
+            valid_size = ftell(f);
+        }
+        fclose(f);
+        // drop the torn record, if any, before appending
+        FAISS_THROW_IF_NOT_FMT(
+                truncate(log_fname.c_str(), valid_size) == 0,
+                "truncate %s: %s",
+                log_fname.c_str(),
+                strerror(errno));
+        open_log(log_fname.c_str(), "a");
+    }
+
+    // rewrite the log file with the layout of the lists and the current
+    // state of the logs
+    void write_checkpoint() {
+        std::string tmp_fname = log_fname + ".tmp";
+        if (log_file) {
+            fclose(log_file);
+            log_file = nullptr;
+        }
+        open_log(tmp_fname.c_str(), "w");
+        uint32_t h = fourcc("odlg");
+        size_t totsize = od->totsize, nlist = od->nlist;
+        size_t nprev = prev_layouts.size();
+        bool ok = fwrite(&h, sizeof(h), 1, log_file) == 1 &&
+                fwrite(&totsize, sizeof(totsize), 1, log_file) == 1 &&
+                fwrite(&nlist, sizeof(nlist), 1, log_file) == 1 &&
+                fwrite(od->lists.data(), sizeof(List), nlist, log_file) ==
+                        nlist &&
+                fwrite(&nprev, sizeof(nprev), 1, log_file) == 1 &&
+                fwrite(prev_layouts.data(),
+                       sizeof(uint64_t),
+                       nprev,
+                       log_file) == nprev;
+        for (size_t list_no = 0; ok && list_no < od->nlist; list_no++) {
+            const ListLog& lg = logs[list_no];
+            if (lg.base_dropped) {
+                write_record(LOG_DROP_BASE, list_no, 0, 0);
+            } else if (lg.ndead > 0) {
+                std::vector<uint64_t> positions;
+                for (size_t j = 0; j < lg.dead->size(); j++) {
+                    if ((*lg.dead)[j]) {
+                        positions.push_back(j);
+                    }
+                }
+                write_record(
+                        LOG_TOMBSTONE,
+                        list_no,
+                        0,
+                        positions.size(),
+                        positions.data(),
+                        positions.size() * sizeof(uint64_t));
+            }
+            if (lg.n > 0) {
+                write_record(
+                        LOG_ADD,
+                        list_no,
+                        0,
+                        lg.n,
+                        lg.ids(),
+                        lg.n * sizeof(idx_t),
+                        lg.codes(),
+                        lg.n * code_size);
+            }
+        }
+        ok = ok && fflush(log_file) == 0 && fsync(fileno(log_file)) == 0;
+        fclose(log_file);
+        log_file = nullptr;
+        ok = ok && rename(tmp_fname.c_str(), log_fname.c_str()) == 0;
+        FAISS_THROW_IF_NOT_FMT(
+                ok,
+                "could not write %s: %s",
+                log_fname.c_str(),
+                strerror(errno));
+        // make the rename durable
+        size_t slash = log_fname.find_last_of('/');
+        std::string dirname = slash == std::string::npos
+                ? "."
+                : log_fname.substr(0, slash + 1);
+        int dir_fd = open(dirname.c_str(), O_RDONLY);
+        if (dir_fd >= 0) {
+            fsync(dir_fd);
+            close(dir_fd);
+        }
+        unsynced = false;
+        open_log(log_fname.c_str(), "a");
+    }
+
+    /*************** list contents, called with the mutex held */
+
+    size_t base_live(size_t list_no) const {
+        const ListLog& lg = logs[list_no];
+        return lg.base_dropped ? 0 : od->lists[list_no].size - lg.ndead;
+    }
+
+    size_t list_size(size_t list_no) const {
+        return base_live(list_no) + logs[list_no].n;
+    }
+
+    void publish_size(size_t list_no) {
+        sizes[list_no] = list_size(list_no);
+    }
+
+    size_t dirty(size_t list_no) const {
+        const ListLog& lg = logs[list_no];
+        return (lg.base_dropped ? od->lists[list_no].size : lg.ndead) + lg.n;
+    }
+
+    const idx_t* base_ids_of(const uint8_t* mptr, const List& base) const {
+        return (const idx_t*)(mptr + base.offset + base.capacity * code_size);
+    }
+
+    /// copy the live entries of a list to codes / ids (either can be null)
+    void read_list(
+            const uint8_t* mptr,
+            const List& base,
+            const ListLog& lg,
+            uint8_t* codes,
+            idx_t* ids) const {
+        size_t o = 0;
+        if (!lg.base_dropped && base.size > 0) {
+            const uint8_t* base_codes = mptr + base.offset;
+            const idx_t* base_ids = base_ids_of(mptr, base);
+            for (size_t j = 0; j < base.size; j++) {
+                if (lg.ndead > 0 && (*lg.dead)[j]) {
+                    continue;
+                }
+                if (codes) {
+                    memcpy(codes + o * code_size,
+                           base_codes + j * code_size,
+                           code_size);
+                }
+                if (ids) {
+                    ids[o] = base_ids[j];
+                }
+                o++;
+            }
+        }
+        if (codes && lg.n > 0) {
+            memcpy(codes + o * code_size, lg.codes(), lg.n * code_size);
+        }
+        if (ids && lg.n > 0) {
+            memcpy(ids + o, lg.ids(), lg.n * sizeof(idx_t));
+        }
+    }
+
+    // replace the log entries of lg with a copy of its n first ones (the
+    // others are zero), that no reader accesses
+    LogEntries& copy_entries(ListLog& lg, size_t n) {
+        auto e = std::make_shared<LogEntries>(n, code_size);
+        size_t ncopy = std::min(n, lg.n);
+        if (ncopy > 0) {
+            memcpy(e->codes.get(), lg.codes(), ncopy * code_size);
+            memcpy(e->ids.get(), lg.ids(), ncopy * sizeof(idx_t));
+        }
+        memset(e->codes.get() + ncopy * code_size, 0, (n - ncopy) * code_size);
+        std::fill(e->ids.get() + ncopy, e->ids.get() + n, 0);
+        lg.entries = e;
+        lg.n = n;
+        return *e;
+    }
+
+    // append n entries to the ne entries of e: in place, where readers
+    // do not access them, or in a larger copy
+    void append_entries(
+            std::shared_ptr<LogEntries>& e,
+            size_t& ne,
+            size_t n,
+            const idx_t* ids,
+            const uint8_t* codes) {
+        if (!e || ne + n > e->capacity) {
+            auto e2 = std::make_shared<LogEntries>(
+                    std::max(ne + n, 2 * ne), code_size);
+            if (ne > 0) {
+                memcpy(e2->codes.get(), e->codes.get(), ne * code_size);
+                memcpy(e2->ids.get(), e->ids.get(), ne * sizeof(idx_t));
+            }
+            e = e2;
+        }
+        memcpy(e->ids.get() + ne, ids, n * sizeof(idx_t));
+        memcpy(e->codes.get() + ne * code_size, codes, n * code_size);
+        ne += n;
+    }
+
+    // keep removed entries for the readers that got the size of the list
+    // before the removal (see acquire)
+    void bury(ListLog& lg, size_t n, const idx_t* ids, const uint8_t* codes) {
+        if (log_file && n > 0) { // no readers while replaying
+            append_entries(lg.removed, lg.nremoved, n, ids, codes);
+        }
+    }
+
+    size_t add(
+            size_t list_no,
+            size_t n,
+            const idx_t* ids,
+            const uint8_t* codes) {
+        ListLog& lg = logs[list_no];
+        size_t o = list_size(list_no);
+        append_entries(lg.entries, lg.n, n, ids, codes);
+        lg.version++;
+        ndirty += n;
+        publish_size(list_no);
+        write_record(
+                LOG_ADD,
+                list_no,
+                0,
+                n,
+                ids,
+                n * sizeof(idx_t),
+                codes,
+                n * code_size);
+        return o;
+    }
+
+    void drop_base(size_t list_no) {
+        ListLog& lg = logs[list_no];
+        size_t d0 = dirty(list_no);
+        lg.base_dropped = true;
+        lg.dead.reset();
+        lg.ndead = 0;
+        lg.version++;
+        ndirty += dirty(list_no) - d0;
+        publish_size(list_no);
+        write_record(LOG_DROP_BASE, list_no, 0, 0);
+    }
+
+    // make the log hold all the live entries of the list
+    void move_base(size_t list_no) {
+        ListLog& lg = logs[list_no];
+        size_t d0 = dirty(list_no);
+        size_t n = list_size(list_no);
+        auto e = std::make_shared<LogEntries>(n, code_size);
+        read_list(
+                current->ptr,
+                od->lists[list_no],
+                lg,
+                e->codes.get(),
+                e->ids.get());
+        lg.entries = e;
+        lg.n = n;
+        lg.base_dropped = true;
+        lg.dead.reset();
+        lg.ndead = 0;
+        lg.version++;
+        ndirty += dirty(list_no) - d0;
+        od->update_stats.nmove++;
+        write_record(LOG_MOVE_BASE, list_no, 0, 0);
+    }
+
+    void update(
+            size_t list_no,
+            size_t offset,
+            size_t n,
+            const idx_t* ids,
+            const uint8_t* codes) {
+        if (offset < base_live(list_no)) {
+            move_base(list_no);
+        }
+        ListLog& lg = logs[list_no];
+        size_t o = offset - base_live(list_no);
+        FAISS_THROW_IF_NOT(o + n <= lg.n);
+        LogEntries& e = copy_entries(lg, lg.n);
+        memcpy(e.ids.get() + o, ids, n * sizeof(idx_t));
+        memcpy(e.codes.get() + o * code_size, codes, n * code_size);
+        lg.version++;
+        write_record(
+                LOG_SET,
+                list_no,
+                offset,
+                n,
+                ids,
+                n * sizeof(idx_t),
+                codes,
+                n * code_size);
+    }
+
+    void resize(size_t list_no, size_t new_size) {
+        if (new_size < base_live(list_no)) {
+            move_base(list_no);
+        }
+        ListLog& lg = logs[list_no];
+        size_t n = new_size - base_live(list_no);
+        if (n < lg.n) {
+            bury(lg, lg.n - n, lg.ids() + n, lg.codes() + n * code_size);
+        }
+        ndirty += n - lg.n;
+        copy_entries(lg, n);
+        lg.version++;
+        publish_size(list_no);
+        write_record(LOG_RESIZE, list_no, 0, n);
+    }
+
+    void tombstone(size_t list_no, size_t n, const uint64_t* positions) {
+        ListLog& lg = logs[list_no];
+        FAISS_THROW_IF_NOT(!lg.base_dropped);
+        const List& base = od->lists[list_no];
+        auto dead = lg.dead ? std::make_shared<std::vector<bool>>(*lg.dead)
+                            : std::make_shared<std::vector<bool>>(base.size);
+        std::vector<idx_t> removed_ids;
+        std::vector<uint8_t> removed_codes;
+        for (size_t i = 0; i < n; i++) {
+            size_t j = positions[i];
+            FAISS_THROW_IF_NOT(j < dead->size());
+            if (!(*dead)[j]) {
+                (*dead)[j] = true;
+                lg.ndead++;
+                ndirty++;
+                if (log_file) {
+                    const uint8_t* code =
+                            current->ptr + base.offset + j * code_size;
+                    removed_ids.push_back(base_ids_of(current->ptr, base)[j]);
+                    removed_codes.insert(
+                            removed_codes.end(), code, code + code_size);
+                }
+            }
+        }
+        bury(lg, removed_ids.size(), removed_ids.data(), removed_codes.data());
+        lg.dead = dead;
+        lg.version++;
+        publish_size(list_no);
+        write_record(
+                LOG_TOMBSTONE, list_no, 0, n, positions, n * sizeof(uint64_t));
+    }
+
+    void erase(size_t list_no, size_t n, const uint64_t* positions) {
+        ListLog& lg = logs[list_no];
+        FAISS_THROW_IF_NOT(n <= lg.n);
+        auto e = std::make_shared<LogEntries>(lg.n - n, code_size);
+        size_t o = 0, i = 0;
+        for (size_t j = 0; j < lg.n; j++) {
+            if (i < n && positions[i] == j) {
+                bury(lg, 1, lg.ids() + j, lg.codes() + j * code_size);
+                i++;
+                continue;
+            }
+            FAISS_THROW_IF_NOT(o < e->capacity);
+            e->ids[o] = lg.ids()[j];
+            memcpy(e->codes.get() + o * code_size,
+                   lg.codes() + j * code_size,
+                   code_size);
+            o++;
+        }
+        FAISS_THROW_IF_NOT(i == n);
+        lg.entries = e;
+        lg.n = o;
+        ndirty -= n;
+        lg.version++;
+        publish_size(list_no);
+        write_record(LOG_ERASE, list_no, 0, n, positions, n * sizeof(uint64_t));
+    }
+
+    /*************** readers */
+
+    void unpin(Mapping* m) {
+        m->nref--;
+        if (m == current || m->nref > 0) {
+            return;
+        }
+        if (m->ptr) {
+            munmap(m->ptr, m->size);
+        }
+        retired.erase(std::find(retired.begin(), retired.end(), m));
+        delete m;
+        if (retired.empty()) {
+            // nobody can access the freed regions anymore
+            for (const Slot& s : pending_free) {
+                od->free_slot(s.offset, s.capacity);
+            }
+            pending_free.clear();
+        }
+    }
+
+    /** returns the codes or the ids of a list, pinned until release.
+     *
+     * The codes and the ids that a thread holds for a list come from the
+     * same snapshot of the list, with at least as many entries as the
+     * last list_size of the list in the thread returned. If the list
+     * shrank since, the entries removed meanwhile are appended to it
+     * (most recent first), so that the reader sees the list as it was
+     * when it got the size. If a compaction dropped them, the entries
+     * are padded with id -1.
+     */
+    const uint8_t* acquire(size_t list_no, bool want_ids) {
+        auto key = std::make_pair(std::this_thread::get_id(), list_no);
+        std::unique_lock<std::mutex> lock(mutex);
+        auto it = readers.find(key);
+        if (it == readers.end()) {
+            size_t n = list_size(list_no);
+            const ObservedSize& o = observed_size;
+            size_t nbuf = o.owner == this && o.list_no == list_no
+                    ? std::max(n, o.size)
+                    : n;
+            if (nbuf == 0) {
+                return nullptr;
+            }
+            Reader r;
+            r.n = nbuf;
+            r.m = current;
+            r.m->nref++;
+            const List base = od->lists[list_no];
+            if (logs[list_no].empty() && nbuf == n) {
+                r.codes = r.m->ptr + base.offset;
+                r.ids = base_ids_of(r.m->ptr, base);
+            } else {
+                // materialize a snapshot of the list without the lock
+                ListLog lg = logs[list_no];
+                lock.unlock();
+                materialize(r, base, lg, n);
+                lock.lock();
+                unpin(r.m);
+                r.m = nullptr;
+            }
+            r.codes_end = r.codes + nbuf * code_size;
+            it = readers.emplace(key, std::move(r)).first;
+        }
+        Reader& r = it->second;
+        r.nref++;
+        return want_ids ? (const uint8_t*)r.ids : r.codes;
+    }
+
+    // copy the n entries of the list and the padding to r.n entries
+    void materialize(Reader& r, const List& base, const ListLog& lg, size_t n)
+            const {
+        r.codes_buf.resize(r.n * code_size);
+        r.ids_buf.resize(r.n);
+        uint8_t* codes = r.codes_buf.data();
+        idx_t* ids = r.ids_buf.data();
+        read_list(r.m->ptr, base, lg, codes, ids);
+        for (size_t j = n; j < r.n; j++) {
+            size_t k = j - n;
+            if (k < lg.nremoved) {
+                size_t src = lg.nremoved - 1 - k;
+                memcpy(codes + j * code_size,
+                       lg.removed->codes.get() + src * code_size,
+                       code_size);
+                ids[j] = lg.removed->ids[src];
+            } else {
+                memset(codes + j * code_size, 0, code_size);
+                ids[j] = -1;
+            }
+        }
+        r.codes = codes;
+        r.ids = ids;
+    }
+
+    void release(size_t list_no, const void* ptr) {
+        if (!ptr) {
+            return;
+        }
+        std::lock_guard<std::mutex> lock(mutex);
+        auto it = readers.find(
+                std::make_pair(std::this_thread::get_id(), list_no));
+        if (it == readers.end() || !it->second.owns(ptr)) {
+            // released by another thread than the one that acquired it
+            for (it = readers.begin(); it != readers.end(); ++it) {
+                if (it->first.second == list_no && it->second.owns(ptr)) {
+                    break;
+                }
+            }
+            if (it == readers.end()) {
+                return;
+            }
+        }
+        Reader& r = it->second;
+        if (--r.nref == 0) {
+            if (r.m) {
+                unpin(r.m);
+            }
+            readers.erase(it);
+        }
+    }
+
+    idx_t get_single_id(size_t list_no, size_t offset) {
+        std::lock_guard<std::mutex> lock(mutex);
+        const ListLog& lg = logs[list_no];
+        size_t nb = base_live(list_no);
+        if (offset >= nb) {
+            FAISS_THROW_IF_NOT(offset - nb < lg.n);
+            return lg.ids()[offset - nb];
+        }
+        const List& base = od->lists[list_no];
+        size_t j = offset;
+        if (lg.ndead > 0) {
+            // offset-th live entry
+            for (j = 0;; j++) {
+                if (!(*lg.dead)[j] && offset-- == 0) {
+                    break;
+                }
+            }
+        }
+        return base_ids_of(current->ptr, base)[j];
+    }
+
+    size_t remove_ids(const IDSelector& sel) {
+        size_t nremove = 0;
+#pragma omp parallel for reduction(+ : nremove)
+        for (idx_t list_no = 0; list_no < od->nlist; list_no++) {
+            std::unique_lock<std::mutex> lock(mutex);
+            for (;;) {
+                // find the base entries to remove without the lock
+                const List base = od->lists[list_no];
+                uint64_t version = logs[list_no].version;
+                bool scan_base = !logs[list_no].base_dropped && base.size > 0;
+                Mapping* m = current;
+                m->nref++;
+                lock.unlock();
+                std::vector<uint64_t> to_tombstone;
+                if (scan_base) {
+                    const idx_t* base_ids = base_ids_of(m->ptr, base);
+                    for (size_t j = 0; j < base.size; j++) {
+                        if (sel.is_member(base_ids[j])) {
+                            to_tombstone.push_back(j);
+                        }
+                    }
+                }
+                lock.lock();
+                unpin(m);
+                ListLog& lg = logs[list_no];
+                if (lg.version != version) {
+                    continue; // updated meanwhile
+                }
+                size_t n0 = list_size(list_no);
+                std::vector<uint64_t> positions;
+                for (uint64_t j : to_tombstone) {
+                    if (lg.ndead == 0 || !(*lg.dead)[j]) {
+                        positions.push_back(j);
+                    }
+                }
+                if (!positions.empty()) {
+                    tombstone(list_no, positions.size(), positions.data());
+                }
+                positions.clear();
+                for (size_t j = 0; j < lg.n; j++) {
+                    if (sel.is_member(lg.ids()[j])) {
+                        positions.push_back(j);
+                    }
+                }
+                if (!positions.empty()) {
+                    erase(list_no, positions.size(), positions.data());
+                }
+                nremove += n0 - list_size(list_no);
+                break;
+            }
+        }
+        std::lock_guard<std::mutex> lock(mutex);
+        od->update_stats.nremove += nremove;
+        notify_update();
+        return nremove;
+    }
+
+    /*************** compaction */
+
+    // first fit in the free regions, returns INVALID_OFFSET if none fits
+    size_t take_slot(size_t nbytes) {
+        for (auto it = od->slots.begin(); it != od->slots.end(); ++it) {
+            if (it->capacity < nbytes) {
+                continue;
+            }
+            size_t o = it->offset;
+            if (it->capacity == nbytes) {
+                od->slots.erase(it);
+            } else {
+                it->offset += nbytes;
+                it->capacity -= nbytes;
+            }
+            return o;
+        }
+        return INVALID_OFFSET;
+    }
+
+    void compact() {
+        std::lock_guard<std::mutex> compact_lock(compact_mutex);
+
+        struct Job {
+            size_t list_no;
+            uint64_t version;
+            List base;
+            ListLog lg;
+            size_t size;
+            size_t offset;
+        };
+        std::vector<Job> jobs;
+        Mapping* src;
+        size_t new_totsize;
+
+        std::unique_lock<std::mutex> lock(mutex);
+        for (size_t list_no = 0; list_no < od->nlist; list_no++) {
+            if (!logs[list_no].empty()) {
+                jobs.push_back(
+                        {list_no,
+                         logs[list_no].version,
+                         od->lists[list_no],
+                         logs[list_no],
+                         list_size(list_no),
+                         INVALID_OFFSET});
+            }
+        }
+        if (jobs.empty()) {
+            return;
+        }
+        // place the lists in the holes of the file or at its end
+        new_totsize = od->totsize;
+        for (Job& job : jobs) {
+            size_t nbytes = job.size * entry_size;
+            if (nbytes == 0) {
+                continue;
+            }
+            job.offset = take_slot(nbytes);
+            if (job.offset == INVALID_OFFSET) {
+                job.offset = new_totsize;
+                new_totsize += nbytes;
+            } else {
+                od->update_stats.bytes_reused += nbytes;
+            }
+        }
+        src = current;
+        src->nref++;
+        lock.unlock();
+
+        // a new mapping, even if the size does not change, so that the
+        // readers of the old list regions can be tracked
+        Mapping* dst = new Mapping{nullptr, new_totsize, 0};
+        try {
+            int fd = open(od->filename.c_str(), O_RDWR | O_CREAT, 0644);
+            FAISS_THROW_IF_NOT_FMT(
+                    fd >= 0,
+                    "could not open %s: %s",
+                    od->filename.c_str(),
+                    strerror(errno));
+            // the new size is durable before the log refers to it
+            int err = new_totsize > od->totsize
+                    ? ftruncate(fd, new_totsize) || fsync(fd)
+                    : 0;
+            if (err == 0 && new_totsize > 0) {
+                void* p =
+                        mmap(nullptr,
+                             new_totsize,
+                             PROT_READ | PROT_WRITE,
+                             MAP_SHARED,
+                             fd,
+                             0);
+                err = p == MAP_FAILED ? -1 : 0;
+                dst->ptr = (uint8_t*)p;
+            }
+            close(fd);
+            FAISS_THROW_IF_NOT_FMT(
+                    err == 0,
+                    "could not grow %s: %s",
+                    od->filename.c_str(),
+                    strerror(errno));
+
+            size_t page_size = sysconf(_SC_PAGESIZE);
+            for (const Job& job : jobs) {
+                if (job.size == 0) {
+                    continue;
+                }
+                uint8_t* codes = dst->ptr + job.offset;
+                read_list(
+                        src->ptr,
+                        job.base,
+                        job.lg,
+                        codes,
+                        (idx_t*)(codes + job.size * code_size));
+                size_t begin = job.offset / page_size * page_size;
+                err =
+                        msync(dst->ptr + begin,
+                              job.offset + job.size * entry_size - begin,
+                              MS_SYNC);
+                FAISS_THROW_IF_NOT_FMT(
+                        err == 0, "msync error: %s", strerror(errno));
+            }
+        } catch (...) {
+            lock.lock();
+            if (dst->ptr) {
+                munmap(dst->ptr, dst->size);
+            }
+            delete dst;
+            for (const Job& job : jobs) {
+                if (job.offset != INVALID_OFFSET &&
+                    job.offset + job.size * entry_size <= od->totsize) {
+                    od->free_slot(job.offset, job.size * entry_size);
+                }
+            }
+            unpin(src);
+            throw;
+        }
+
+        // switch to the new mapping and lists
+        lock.lock();
+        uint64_t old_layout = layout_hash(od->lists, od->totsize);
+        retired.push_back(current);
+        current = dst;
+        od->ptr = dst->ptr;
+        od->totsize = new_totsize;
+        size_t nbytes = 0, ncompacted = 0;
+        for (const Job& job : jobs) {
+            size_t list_no = job.list_no;
+            ListLog& lg = logs[list_no];
+            size_t job_bytes = job.size * entry_size;
+            if (lg.version != job.version) {
+                // updated meanwhile: leave it for the next compaction
+                if (job_bytes > 0) {
+                    od->free_slot(job.offset, job_bytes);
+                }
+                continue;
+            }
+            const List& old = od->lists[list_no];
+            if (old.offset != INVALID_OFFSET && old.capacity > 0) {
+                pending_free.push_back(
+                        Slot(old.offset, old.capacity * entry_size));
+            }
+            ndirty -= dirty(list_no);
+            nbase += job.size - old.size;
+            List& l = od->lists[list_no];
+            l.size = l.capacity = job.size;
+            l.offset = job_bytes > 0 ? job.offset : INVALID_OFFSET;
+            lg = ListLog();
+            lg.version = job.version + 1;
+            nbytes += job_bytes;
+            ncompacted++;
+        }
+        // the readers that got the size of a list before this compaction
+        // do not see the entries removed before it anymore
+        for (ListLog& lg : logs) {
+            lg.removed.reset();
+            lg.nremoved = 0;
+        }
+        od->update_stats.ncompact++;
+        od->update_stats.nlist_compacted += ncompacted;
+        od->update_stats.bytes_compacted += nbytes;
+        // the log now applies to the new layout. If the lists are not
+        // saved before a crash, it replaces the old layout at replay
+        prev_layouts.push_back(old_layout);
+        write_checkpoint();
+        unpin(src); // unmaps it if there are no readers left
+    }
+};
+
+void OnDiskInvertedLists::set_update_log(
+        bool enable,
+        float compact_ratio,
+        double sync_interval) {
+    if (!enable) {
+        if (update_log) {
+            update_log->set_background(0, 0);
+            update_log->compact();
+            std::string log_fname = update_log->log_fname;
+            delete update_log;
+            update_log = nullptr;
+            remove(log_fname.c_str());
+        }
+        return;
+    }
+    FAISS_THROW_IF_NOT(!read_only);
+    FAISS_THROW_IF_NOT_MSG(
+            !async_reader, "the update log is not supported with async I/O");
+    if (!update_log) {
+        update_log = new UpdateLog(this);
+    }
+    update_log->set_background(compact_ratio, sync_interval);
+}
+
+void OnDiskInvertedLists::compact() {
+    FAISS_THROW_IF_NOT_MSG(update_log, "update log not enabled");
+    update_log->compact();
+}
+
+void OnDiskInvertedLists::sync_log() {
+    FAISS_THROW_IF_NOT_MSG(update_log, "update log not enabled");
+    update_log->sync_log();
+}
+
+size_t OnDiskInvertedLists::remove_ids(const IDSelector& sel) {
+    FAISS_THROW_IF_NOT_MSG(update_log, "update log not enabled");
+    return update_log->remove_ids(sel);
+}
+
+void OnDiskInvertedLists::set_async_io(
+        int queue_depth,
+        size_t buffer_pool_size) {
+    FAISS_THROW_IF_NOT_MSG(
+            !update_log || queue_depth == 0,
+            "async I/O is not supported with the update log");
+    delete async_reader;
+    async_reader = nullptr;
+    if (queue_depth > 0) {
+        async_reader = new AsyncReader(this, queue_depth, buffer_pool_size);
+    }
+}
+
 void OnDiskInvertedLists::prefetch_lists(const idx_t* list_nos, int n) const {
-    pf->prefetch_lists(list_nos, n);
+    if (update_log) {
+        // the list sizes do not match the mapped lists
+        return;
+    }
+    if (async_reader) {
+        async_reader->prefetch(list_nos, n);
+    } else {
+        pf->prefetch_lists(list_nos, n);
+    }
+}
+
+void OnDiskInvertedLists::release_codes(size_t list_no, const uint8_t* codes)
+        const {
+    if (update_log) {
+        update_log->release(list_no, codes);
+    } else if (async_reader && codes) {
+        async_reader->release(list_no);
+    }
+}
+
+void OnDiskInvertedLists::release_ids(size_t list_no, const idx_t* ids) const {
+    if (update_log) {
+        update_log->release(list_no, ids);
+    } else if (async_reader && ids) {
+        async_reader->release(list_no);
+    }
 }
 
 /**********************************************
@@ -335,8 +1897,6 @@ void OnDiskInvertedLists::update_totsize(size_t new_size) {
  * OnDiskInvertedLists
  **********************************************/
 
-#define INVALID_OFFSET (size_t)(-1)
-
 OnDiskOneList::OnDiskOneList() : size(0), capacity(0), offset(INVALID_OFFSET) {}
 
 OnDiskInvertedLists::Slot::Slot(size_t offset, size_t capacity)
@@ -355,7 +1915,9 @@ OnDiskInvertedLists::OnDiskInvertedLists(
           read_only(false),
           locks(new LockLevels()),
           pf(new OngoingPrefetch(this)),
-          prefetch_nthread(32) {
+          prefetch_nthread(32),
+          async_reader(nullptr),
+          update_log(nullptr) {
     lists.resize(nlist);
 
     // slots starts empty
@@ -364,6 +1926,8 @@ OnDiskInvertedLists::OnDiskInvertedLists(
 OnDiskInvertedLists::OnDiskInvertedLists() : OnDiskInvertedLists(0, 0, "") {}
 
 OnDiskInvertedLists::~OnDiskInvertedLists() {
+    delete async_reader;
+    delete update_log;
     delete pf;
 
     // unmap all lists
@@ -377,10 +1941,17 @@ OnDiskInvertedLists::~OnDiskInvertedLists() {
 }
 
 size_t OnDiskInvertedLists::list_size(size_t list_no) const {
+    if (update_log) {
+        size_t n = update_log->sizes[list_no];
+        observed_size.owner = update_log;
+        observed_size.list_no = list_no;
+        observed_size.size = n;
+        return n;
+    }
     return lists[list_no].size;
 }
 
-const uint8_t* OnDiskInvertedLists::get_codes(size_t list_no) const {
+uint8_t* OnDiskInvertedLists::mapped_codes(size_t list_no) const {
     if (lists[list_no].offset == INVALID_OFFSET) {
         return nullptr;
     }
@@ -388,13 +1959,49 @@ const uint8_t* OnDiskInvertedLists::get_codes(size_t list_no) const {
     return ptr + lists[list_no].offset;
 }
 
-const Index::idx_t* OnDiskInvertedLists::get_ids(size_t list_no) const {
+Index::idx_t* OnDiskInvertedLists::mapped_ids(size_t list_no) const {
     if (lists[list_no].offset == INVALID_OFFSET) {
         return nullptr;
     }
 
-    return (
-        const idx_t*)(ptr + lists[list_no].offset + code_size * lists[list_no].capacity);
+    return (idx_t*)(ptr + lists[list_no].offset +
+                    code_size * lists[list_no].capacity);
+}
+
+const uint8_t* OnDiskInvertedLists::get_codes(size_t list_no) const {
+    if (update_log) {
+        return update_log->acquire(list_no, false);
+    }
+    if (async_reader) {
+        // nullptr for the empty lists, that are not in the buffer pool
+        if (lists[list_no].size == 0) {
+            return nullptr;
+        }
+        return async_reader->acquire(list_no)->data.data();
+    }
+    return mapped_codes(list_no);
+}
+
+const Index::idx_t* OnDiskInvertedLists::get_ids(size_t list_no) const {
+    if (update_log) {
+        return (const idx_t*)update_log->acquire(list_no, true);
+    }
+    if (async_reader) {
+        if (lists[list_no].size == 0) {
+            return nullptr;
+        }
+        const uint8_t* data = async_reader->acquire(list_no)->data.data();
+        return (const idx_t*)(data + lists[list_no].size * code_size);
+    }
+    return mapped_ids(list_no);
+}
+
+Index::idx_t OnDiskInvertedLists::get_single_id(size_t list_no, size_t offset)
+        const {
+    if (update_log) {
+        return update_log->get_single_id(list_no, offset);
+    }
+    return InvertedLists::get_single_id(list_no, offset);
 }
 
 void OnDiskInvertedLists::update_entries(
@@ -406,11 +2013,19 @@ void OnDiskInvertedLists::update_entries(
     FAISS_THROW_IF_NOT(!read_only);
     if (n_entry == 0)
         return;
+    if (update_log) {
+        std::lock_guard<std::mutex> lock(update_log->mutex);
+        update_log->update(list_no, offset, n_entry, ids_in, codes_in);
+        return;
+    }
     const List& l = lists[list_no];
     assert(n_entry + offset <= l.size);
-    idx_t* ids = const_cast<idx_t*>(get_ids(list_no));
+    if (async_reader) {
+        async_reader->invalidate(list_no);
+    }
+    idx_t* ids = mapped_ids(list_no);
     memcpy(ids + offset, ids_in, sizeof(ids_in[0]) * n_entry);
-    uint8_t* codes = const_cast<uint8_t*>(get_codes(list_no));
+    uint8_t* codes = mapped_codes(list_no);
     memcpy(codes + offset * code_size, codes_in, code_size * n_entry);
 }
 
@@ -420,6 +2035,13 @@ size_t OnDiskInvertedLists::add_entries(
         const idx_t* ids,
         const uint8_t* code) {
     FAISS_THROW_IF_NOT(!read_only);
+    if (update_log) {
+        std::lock_guard<std::mutex> lock(update_log->mutex);
+        size_t o = update_log->add(list_no, n_entry, ids, code);
+        update_stats.nadd += n_entry;
+        update_log->notify_update();
+        return o;
+    }
     locks->lock_1(list_no);
     size_t o = list_size(list_no);
     resize_locked(list_no, n_entry + o);
@@ -430,6 +2052,12 @@ size_t OnDiskInvertedLists::add_entries(
 
 void OnDiskInvertedLists::resize(size_t list_no, size_t new_size) {
     FAISS_THROW_IF_NOT(!read_only);
+    if (update_log) {
+        std::lock_guard<std::mutex> lock(update_log->mutex);
+        update_log->resize(list_no, new_size);
+        update_log->notify_update();
+        return;
+    }
     locks->lock_1(list_no);
     resize_locked(list_no, new_size);
     locks->unlock_1(list_no);
@@ -438,6 +2066,10 @@ void OnDiskInvertedLists::resize(size_t list_no, size_t new_size) {
 void OnDiskInvertedLists::resize_locked(size_t list_no, size_t new_size) {
     List& l = lists[list_no];
 
+    if (async_reader) {
+        async_reader->invalidate(list_no);
+    }
+
     if (new_size <= l.capacity && new_size > l.capacity / 2) {
         l.size = new_size;
         return;
@@ -466,9 +2098,9 @@ void OnDiskInvertedLists::resize_locked(size_t list_no, size_t new_size) {
     if (l.offset != new_l.offset) {
         size_t n = std::min(new_size, l.size);
         if (n > 0) {
-            memcpy(ptr + new_l.offset, get_codes(list_no), n * code_size);
+            memcpy(ptr + new_l.offset, mapped_codes(list_no), n * code_size);
             memcpy(ptr + new_l.offset + new_l.capacity * code_size,
-                   get_ids(list_no),
+                   mapped_ids(list_no),
                    n * sizeof(idx_t));
         }
     }
@@ -561,6 +2193,28 @@ void OnDiskInvertedLists::free_slot(size_t offset, size_t capacity) {
     // TODO shrink global storage if needed
 }
 
+void OnDiskInvertedLists::set_slots_from_lists() {
+    size_t entry_size = code_size + sizeof(idx_t);
+    std::vector<std::pair<size_t, size_t>> used;
+    for (const List& l : lists) {
+        if (l.offset != INVALID_OFFSET && l.capacity > 0) {
+            used.emplace_back(l.offset, l.capacity * entry_size);
+        }
+    }
+    std::sort(used.begin(), used.end());
+    slots.clear();
+    size_t pos = 0;
+    for (auto& u : used) {
+        if (u.first > pos) {
+            slots.push_back(Slot(pos, u.first - pos));
+        }
+        pos = std::max(pos, u.first + u.second);
+    }
+    if (pos < totsize) {
+        slots.push_back(Slot(pos, totsize - pos));
+    }
+}
+
 /*****************************************
  * Compact form
  *****************************************/
@@ -569,8 +2223,76 @@ size_t OnDiskInvertedLists::merge_from(
         const InvertedLists** ils,
         int n_il,
         bool verbose) {
+    return merge_from_ordered(ils, n_il, nullptr, 0, 0, verbose);
+}
+
+size_t OnDiskInvertedLists::merge_from_ordered(
+        const InvertedLists** ils,
+        int n_il,
+        const idx_t* list_order,
+        size_t n_aligned,
+        size_t alignment,
+        bool verbose) {
+    size_t ntotal =
+            prepare_merge(ils, n_il, list_order, n_aligned, alignment, false);
+
+    size_t nmerged = 0;
+    double t0 = getmillisecs(), last_t = t0;
+
+#pragma omp parallel for
+    for (size_t jj = 0; jj < nlist; jj++) {
+        idx_t j = list_order ? list_order[jj] : jj;
+        fill_lists_from(ils, n_il, 1, &j);
+        if (verbose) {
+#pragma omp critical
+            {
+                nmerged++;
+                double t1 = getmillisecs();
+                if (t1 - last_t > 500) {
+                    printf("merged %zd lists in %.3f s\r",
+                           nmerged,
+                           (t1 - t0) / 1000.0);
+                    fflush(stdout);
+                    last_t = t1;
+                }
+            }
+        }
+    }
+    if (verbose) {
+        printf("\n");
+    }
+
+    return ntotal;
+}
+
+size_t OnDiskInvertedLists::prepare_merge(
+        const InvertedLists** ils,
+        int n_il,
+        const idx_t* list_order,
+        size_t n_aligned,
+        size_t alignment,
+        bool reuse_file) {
     FAISS_THROW_IF_NOT_MSG(
             totsize == 0, "works only on an empty InvertedLists");
+    FAISS_THROW_IF_NOT(n_aligned <= nlist);
+    FAISS_THROW_IF_NOT(n_aligned == 0 || alignment > 0);
+
+    std::vector<idx_t> order(nlist);
+    if (list_order) {
+        std::vector<bool> seen(nlist);
+        for (size_t j = 0; j < nlist; j++) {
+            idx_t l = list_order[j];
+            FAISS_THROW_IF_NOT_MSG(
+                    l >= 0 && l < nlist && !seen[l],
+                    "list_order should be a permutation of the lists");
+            seen[l] = true;
+            order[j] = l;
+        }
+    } else {
+        for (size_t j = 0; j < nlist; j++) {
+            order[j] = j;
+        }
+    }
 
     std::vector<size_t> sizes(nlist);
     for (int i = 0; i < n_il; i++) {
@@ -584,54 +2306,71 @@ size_t OnDiskInvertedLists::merge_from(
 
     size_t cums = 0;
     size_t ntotal = 0;
-    for (size_t j = 0; j < nlist; j++) {
+    for (size_t jj = 0; jj < nlist; jj++) {
+        size_t j = order[jj];
+        if (jj < n_aligned) {
+            cums = (cums + alignment - 1) / alignment * alignment;
+        }
         ntotal += sizes[j];
-        lists[j].size = 0;
+        lists[j].size = sizes[j];
         lists[j].capacity = sizes[j];
         lists[j].offset = cums;
         cums += lists[j].capacity * (sizeof(idx_t) + code_size);
     }
 
-    update_totsize(cums);
+    struct stat buf;
+    if (reuse_file && stat(filename.c_str(), &buf) == 0 &&
+        (size_t)buf.st_size == cums) {
+        // keep the data written by a previous, interrupted merge
+        totsize = cums;
+        do_mmap();
+    } else {
+        update_totsize(cums);
+    }
+    // only the alignment padding is free
+    set_slots_from_lists();
 
-    size_t nmerged = 0;
-    double t0 = getmillisecs(), last_t = t0;
+    return ntotal;
+}
 
-#pragma omp parallel for
-    for (size_t j = 0; j < nlist; j++) {
-        List& l = lists[j];
+void OnDiskInvertedLists::fill_lists_from(
+        const InvertedLists** ils,
+        int n_il,
+        size_t n,
+        const idx_t* list_nos,
+        bool sync) {
+    size_t begin = totsize, end = 0;
+    for (size_t jj = 0; jj < n; jj++) {
+        idx_t j = list_nos[jj];
+        FAISS_THROW_IF_NOT(j >= 0 && j < nlist);
+        const List& l = lists[j];
+        size_t ofs = 0;
         for (int i = 0; i < n_il; i++) {
             const InvertedLists* il = ils[i];
             size_t n_entry = il->list_size(j);
-            l.size += n_entry;
+            FAISS_THROW_IF_NOT(ofs + n_entry <= l.size);
             update_entries(
                     j,
-                    l.size - n_entry,
+                    ofs,
                     n_entry,
                     ScopedIds(il, j).get(),
                     ScopedCodes(il, j).get());
+            ofs += n_entry;
         }
-        assert(l.size == l.capacity);
-        if (verbose) {
-#pragma omp critical
-            {
-                nmerged++;
-                double t1 = getmillisecs();
-                if (t1 - last_t > 500) {
-                    printf("merged %zd lists in %.3f s\r",
-                           nmerged,
-                           (t1 - t0) / 1000.0);
-                    fflush(stdout);
-                    last_t = t1;
-                }
-            }
+        FAISS_THROW_IF_NOT_MSG(
+                ofs == l.size, "the lists do not match prepare_merge");
+        if (l.size > 0) {
+            begin = std::min(begin, l.offset);
+            end = std::max(
+                    end, l.offset + l.capacity * (sizeof(idx_t) + code_size));
         }
     }
-    if (verbose) {
-        printf("\n");
+    if (sync && begin < end) {
+        size_t page_size = sysconf(_SC_PAGESIZE);
+        begin = begin / page_size * page_size;
+        int err = msync(ptr + begin, end - begin, MS_SYNC);
+        FAISS_THROW_IF_NOT_FMT(err == 0, "msync error: %s", strerror(errno));
     }
-
-    return ntotal;
 }
 
 size_t OnDiskInvertedLists::merge_from_1(
@@ -22,6 +22,37 @@ namespace faiss {
 
 struct LockLevels;
 
+/// statistics of the asynchronous reads, see OnDiskInvertedLists::set_async_io
+struct OnDiskIOStats {
+    size_t nread;      ///< lists read by the I/O threads
+    size_t nread_sync; ///< lists read on demand by the calling thread
+    size_t nhit;       ///< accesses to a list already in the buffer pool
+    size_t nwait;      ///< accesses that waited for a read in flight
+    size_t nevict;     ///< lists evicted from the buffer pool
+    size_t bytes_read;
+
+    OnDiskIOStats() {
+        reset();
+    }
+    void reset();
+};
+
+/// statistics of the update log, see OnDiskInvertedLists::set_update_log
+struct OnDiskUpdateStats {
+    size_t nadd;            ///< entries appended to the log
+    size_t nremove;         ///< entries removed by remove_ids
+    size_t nmove;           ///< lists moved to the log by an in-place update
+    size_t ncompact;        ///< compactions
+    size_t nlist_compacted; ///< lists rewritten by the compactions
+    size_t bytes_compacted; ///< bytes written by the compactions
+    size_t bytes_reused;    ///< of which in reclaimed holes of the file
+
+    OnDiskUpdateStats() {
+        reset();
+    }
+    void reset();
+};
+
 struct OnDiskOneList {
     size_t size;     // size of inverted list (entries)
     size_t capacity; // allocated size (entries)
@@ -56,6 +87,9 @@ struct OnDiskOneList {
  * When it is known that a set of lists will be accessed, it is useful
  * to call prefetch_lists, that launches a set of threads to read the
  * lists in parallel.
+ *
+ * Alternatively, with set_async_io, the lists are not accessed through
+ * the mmap but read with asynchronous I/O into a bounded buffer pool.
  */
 struct OnDiskInvertedLists : InvertedLists {
     using List = OnDiskOneList;
@@ -109,11 +143,128 @@ struct OnDiskInvertedLists : InvertedLists {
     /// same as merge_from for a single invlist
     size_t merge_from_1(const InvertedLists* il, bool verbose = false);
 
+    /** same as merge_from, but the lists are stored in the order of
+     * list_order (a permutation of 0..nlist-1, nullptr = list number
+     * order), and the first n_aligned lists of that order start at a
+     * multiple of alignment bytes.
+     */
+    size_t merge_from_ordered(
+            const InvertedLists** ils,
+            int n_il,
+            const idx_t* list_order,
+            size_t n_aligned = 0,
+            size_t alignment = 4096,
+            bool verbose = false);
+
+    /** First step of a merge that is done piecewise: compute the sizes
+     * of the merged lists and lay them out as merge_from_ordered does.
+     * The list contents are left to fill_lists_from.
+     *
+     * @param reuse_file  if the file already has the size of the layout,
+     *                    keep its contents (to resume a merge that was
+     *                    interrupted), otherwise it is recreated
+     * @return            total nb of entries
+     */
+    size_t prepare_merge(
+            const InvertedLists** ils,
+            int n_il,
+            const idx_t* list_order = nullptr,
+            size_t n_aligned = 0,
+            size_t alignment = 4096,
+            bool reuse_file = false);
+
+    /** Second step: copy the lists list_nos[0..n-1] of ils into the lists
+     * laid out by prepare_merge. The calls for disjoint sets of lists can
+     * run in parallel. With sync, the written range of the file is
+     * flushed to disk before returning.
+     */
+    void fill_lists_from(
+            const InvertedLists** ils,
+            int n_il,
+            size_t n,
+            const idx_t* list_nos,
+            bool sync = false);
+
     /// restrict the inverted lists to l0:l1 without touching the mmapped region
     void crop_invlists(size_t l0, size_t l1);
 
+    idx_t get_single_id(size_t list_no, size_t offset) const override;
+
     void prefetch_lists(const idx_t* list_nos, int nlist) const override;
 
+    /** Read the lists with asynchronous I/O instead of mmap page faults.
+     *
+     * prefetch_lists queues reads of the lists, served by queue_depth I/O
+     * threads (the max nb of reads in flight) into a buffer pool of about
+     * buffer_pool_size bytes. get_codes / get_ids return the buffered list,
+     * waiting for its read if it is in flight, or reading it on the spot if
+     * it was not prefetched. The buffers are pinned until release_codes /
+     * release_ids. IndexIVF::search prefetches all the lists of a batch
+     * before scanning them in the same order, so the scan of a list
+     * overlaps with the reads of the next ones.
+     *
+     * This is for read accesses: updating a list drops its buffer.
+     *
+     * @param queue_depth  nb of concurrent reads, 0 = back to the mmap
+     */
+    void set_async_io(int queue_depth, size_t buffer_pool_size = 256 << 20);
+
+    /// statistics of the async reads
+    mutable OnDiskIOStats io_stats;
+
+    /** Log-structured updates, for indexes with continuous inserts and
+     * deletes.
+     *
+     * add_entries appends the entries to an in-memory log of the list
+     * and to an append-only log file (filename + ".log") instead of
+     * reallocating the list in the file. remove_ids marks the removed
+     * entries of the lists as deleted (tombstones). The other in-place
+     * updates (update_entries, resize) move the list to the log
+     * entirely. Readers see the list as its live entries followed by the
+     * log, materialized in a buffer until the list is compacted. A thread
+     * gets at least as many entries as list_size last returned to it: if
+     * the list shrank meanwhile, the removed entries are still visible.
+     *
+     * compact() rewrites the lists that have a log or tombstones in a
+     * compact form, in the holes of the file or at its end, and switches
+     * readers to a new mapping of the file. The readers of the previous
+     * mapping keep it until they release their lists, and the freed space
+     * is reused once they are all done. With compact_ratio > 0, a
+     * background thread compacts when the logs and tombstones exceed
+     * compact_ratio times the nb of entries of the lists.
+     *
+     * The log file records are written through a buffer and fsynced
+     * every sync_interval seconds by the background thread (0 = only by
+     * sync_log and compact), so a crash loses at most the updates of the
+     * last interval.
+     *
+     * compact() rewrites the log file with the new layout of the lists.
+     * The log file is replayed when the mode is enabled, if the lists
+     * have the layout of the log or of one it replaces (the index was
+     * not written after a compaction): then the lists are switched to the
+     * layout of the log. Disabling the mode compacts all the lists and
+     * removes the log file, write the index afterwards.
+     */
+    void set_update_log(
+            bool enable,
+            float compact_ratio = 0.1,
+            double sync_interval = 0.1);
+
+    /// rewrite the lists with a log or tombstones (update log mode)
+    void compact();
+
+    /// make the updates so far durable (update log mode)
+    void sync_log();
+
+    /// mark the entries selected by sel as deleted (update log mode)
+    size_t remove_ids(const IDSelector& sel);
+
+    /// statistics of the update log
+    mutable OnDiskUpdateStats update_stats;
+
+    void release_codes(size_t list_no, const uint8_t* codes) const override;
+    void release_ids(size_t list_no, const idx_t* ids) const override;
+
     ~OnDiskInvertedLists() override;
 
     // private
@@ -125,11 +276,25 @@ struct OnDiskInvertedLists : InvertedLists {
     OngoingPrefetch* pf;
     int prefetch_nthread;
 
+    // the I/O threads and buffer pool of set_async_io
+    struct AsyncReader;
+    AsyncReader* async_reader;
+
+    // the logs, tombstones and mappings of set_update_log
+    struct UpdateLog;
+    UpdateLog* update_log;
+
+    /// pointers into the mmap, regardless of async_reader
+    uint8_t* mapped_codes(size_t list_no) const;
+    idx_t* mapped_ids(size_t list_no) const;
+
     void do_mmap();
     void update_totsize(size_t new_totsize);
     void resize_locked(size_t list_no, size_t new_size);
     size_t allocate_slot(size_t capacity);
     void free_slot(size_t offset, size_t capacity);
+    /// make the parts of the file that no list uses the free slots
+    void set_slots_from_lists();
 
     /// override all list sizes and make a packed storage
     void set_all_lists_sizes(const size_t* sizes);
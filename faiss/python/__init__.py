@@ -682,6 +682,15 @@ def handle_ParameterSpace(the_class):
         return ops
     replace_method(the_class, 'explore', replacement_explore)
 
+    def replacement_explore_with_budget(self, index, xq, crit):
+        assert xq.shape == (crit.nq, index.d)
+        ops = OperatingPoints()
+        self.explore_with_budget_c(index, crit.nq, swig_ptr(xq),
+                                   crit, ops)
+        return ops
+    replace_method(the_class, 'explore_with_budget',
+                   replacement_explore_with_budget)
+
 
 def handle_MatrixStats(the_class):
     original_init = the_class.__init__
@@ -859,6 +868,7 @@ add_ref_in_method(IndexBinaryReplicas, 'addIndex', 0)
 
 add_ref_in_constructor(BufferedIOWriter, 0)
 add_ref_in_constructor(BufferedIOReader, 0)
+add_ref_in_constructor(CachedInvertedLists, 0)
 
 # seems really marginal...
 # remove_ref_from_method(IndexReplicas, 'removeIndex', 0)
@@ -1357,6 +1367,22 @@ def search_with_parameters(index, x, k, params=None, output_stats=False):
         }
         return distances, labels, stats
 
+search_nprobe_sweep_c = search_nprobe_sweep
+
+def search_nprobe_sweep(index, x, k, nprobes):
+    """search an IVF index for each of the increasing nprobes, running the
+    coarse quantizer once. Returns D, I of size (len(nprobes), n, k)"""
+    n, d = x.shape
+    assert d == index.d
+    nprobes = np.ascontiguousarray(nprobes, dtype='int64')
+    distances = np.empty((len(nprobes), n, k), dtype=np.float32)
+    labels = np.empty((len(nprobes), n, k), dtype=np.int64)
+    search_nprobe_sweep_c(
+        index, n, swig_ptr(x), k, len(nprobes), swig_ptr(nprobes),
+        swig_ptr(distances), swig_ptr(labels)
+    )
+    return distances, labels
+
 range_search_with_parameters_c = range_search_with_parameters
 
 def range_search_with_parameters(index, x, radius, params=None, output_stats=False):
@@ -7,6 +7,8 @@
 import unittest
 import faiss
 
+from faiss.contrib import datasets
+
 
 class TestParameterSpace(unittest.TestCase):
 
@@ -45,3 +47,51 @@ class TestParameterSpace(unittest.TestCase):
         ps.set_index_parameter(index, "quantizer_efSearch", 5)
         index2 = faiss.downcast_index(index.quantizer)
         self.assertEqual(index2.hnsw.efSearch, 5)
+
+
+class TestExploreWithBudget(unittest.TestCase):
+
+    def make_problem(self):
+        ds = datasets.SyntheticDataset(32, 2000, 5000, 200)
+        index = faiss.index_factory(ds.d, "IVF32,Flat")
+        index.train(ds.get_train())
+        index.add(ds.get_database())
+        crit = faiss.OneRecallAtRCriterion(ds.nq, 1)
+        crit.set_groundtruth(None, ds.get_groundtruth(1))
+        crit.nnn = 10
+        ps = faiss.ParameterSpace()
+        ps.verbose = 0
+        ps.initialize(index)
+        return ds, index, crit, ps
+
+    def test_pareto_front(self):
+        ds, index, crit, ps = self.make_problem()
+        ops = ps.explore_with_budget(index, ds.get_queries(), crit)
+        pts = ops.optimal_pts
+        self.assertGreater(pts.size(), 1)
+        # the best operating point is as good as with an exhaustive explore
+        ref_ops = ps.explore(index, ds.get_queries(), crit)
+        ref = ref_ops.optimal_pts
+        self.assertEqual(pts.at(pts.size() - 1).perf,
+                         ref.at(ref.size() - 1).perf)
+        # recall at nprobe=1 matches a plain search
+        index.nprobe = 1
+        _, I = index.search(ds.get_queries(), 1)
+        recall = (I[:, 0] == ds.get_groundtruth(1)[:, 0]).mean()
+        self.assertIn(recall, [pts.at(i).perf for i in range(pts.size())])
+
+    def test_concurrent(self):
+        ds, index, crit, ps = self.make_problem()
+        ps.n_explore_threads = 2
+        ops = ps.explore_with_budget(index, ds.get_queries(), crit)
+        pts = ops.optimal_pts
+        ref_ops = ps.explore(index, ds.get_queries(), crit)
+        ref = ref_ops.optimal_pts
+        self.assertEqual(pts.at(pts.size() - 1).perf,
+                         ref.at(ref.size() - 1).perf)
+
+    def test_latency_ceiling(self):
+        ds, index, crit, ps = self.make_problem()
+        ps.max_query_time = 1e-12
+        ops = ps.explore_with_budget(index, ds.get_queries(), crit)
+        self.assertEqual(ops.all_pts.size(), 0)
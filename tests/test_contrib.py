@@ -7,11 +7,20 @@ import faiss
 import unittest
 import numpy as np
 import platform
+import os
+import asyncio
+import socket
+import tempfile
+import threading
+import time
 
 from faiss.contrib import datasets
 from faiss.contrib import inspect_tools
 from faiss.contrib import evaluation
 from faiss.contrib import ivf_tools
+from faiss.contrib import client_server
+from faiss.contrib import rpc
+from faiss.contrib import ondisk
 
 from common_faiss_tests import get_dataset_2
 try:
@@ -391,6 +400,47 @@ class TestPreassigned(unittest.TestCase):
             self.assertTrue(set(I[q]) <= set(IR[l0:l1]))
 
 
+class TestNprobeSolver(unittest.TestCase):
+
+    def test_min_nprobe(self):
+        ds = datasets.SyntheticDataset(32, 2000, 5000, 200)
+        index = faiss.index_factory(ds.d, "OPQ8,IVF32,PQ8")
+        index.train(ds.get_train())
+        index.add(ds.get_database())
+        gt = ds.get_groundtruth()
+        solver = ivf_tools.NprobeSolver(index, ds.get_queries(), gt, max_k=10)
+
+        # reference: full searches with increasing nprobe
+        index_ivf = faiss.extract_index_ivf(index)
+        recalls = []
+        for nprobe in range(1, index_ivf.nlist + 1):
+            index_ivf.nprobe = nprobe
+            D, I = index.search(ds.get_queries(), 10)
+            recalls.append((I == gt[:, :1]).sum() / len(gt))
+            self.assertAlmostEqual(solver.recall(nprobe, 10), recalls[-1])
+
+        # the binary search returns the nprobe where the recall crosses the goal
+        for recall_goal in 0.5, 0.7, recalls[-1]:
+            nprobe = solver.min_nprobe(10, recall_goal)
+            self.assertGreaterEqual(recalls[nprobe - 1], recall_goal)
+            if nprobe > 1:
+                self.assertLess(recalls[nprobe - 2], recall_goal)
+        self.assertIsNone(solver.min_nprobe(10, 1.1))
+
+        # the galloping search only assigns the queries to the lists it needs
+        solver = ivf_tools.NprobeSolver(index, ds.get_queries(), gt, max_k=10)
+        nprobe = solver.min_nprobe(10, 0.5)
+        self.assertGreaterEqual(recalls[nprobe - 1], 0.5)
+        self.assertLess(solver.list_nos.shape[1], 2 * nprobe)
+
+    def test_table_io(self):
+        table = {'SIFT1M': {'IVF1024,PQ16': {10: {0.8: 13, 0.99: None}}}}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'nprobe_table.json')
+            ivf_tools.save_nprobe_table(fname, table)
+            self.assertEqual(ivf_tools.load_nprobe_table(fname), table)
+
+
 class TestRangeSearchMaxResults(unittest.TestCase):
 
     def do_test(self, metric_type):
@@ -424,3 +474,429 @@ class TestRangeSearchMaxResults(unittest.TestCase):
 
     def test_IP(self):
         self.do_test(faiss.METRIC_INNER_PRODUCT)
+
+
+def start_index_server(index, n_workers=1, use_asyncio=False):
+    """ serve the index on a free port in a background thread """
+    s = socket.socket()
+    s.bind(('', 0))
+    port = s.getsockname()[1]
+    s.close()
+    if use_asyncio:
+        run_server = client_server.run_index_server_async
+    else:
+        run_server = client_server.run_index_server
+    threading.Thread(
+        target=run_server, args=(index, port, False, n_workers),
+        daemon=True).start()
+    return port
+
+
+def connect_when_ready(connect, timeout=10):
+    t0 = time.time()
+    while True:
+        try:
+            return connect()
+        except ConnectionRefusedError:
+            if time.time() - t0 > timeout:
+                raise
+            time.sleep(0.05)
+
+
+class TestClientServer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        ds = datasets.SyntheticDataset(32, 2000, 4000, 100)
+        index = faiss.index_factory(ds.d, "IVF32,Flat")
+        index.train(ds.get_train())
+        index.nprobe = 4
+        xb = ds.get_database()
+        cls.shards = []
+        for i0 in 0, 2000:
+            shard = faiss.clone_index(index)
+            shard.add_with_ids(xb[i0:i0 + 2000], np.arange(i0, i0 + 2000))
+            cls.shards.append(shard)
+        index.add(xb)
+        cls.index = index
+        cls.xq = ds.get_queries()
+        cls.ports = [start_index_server(shard, n_workers=2)
+                     for shard in cls.shards]
+        cls.async_ports = [start_index_server(shard, 2, use_asyncio=True)
+                           for shard in cls.shards]
+
+    def test_search(self):
+        client = connect_when_ready(lambda: client_server.ClientIndex(
+            [('localhost', port) for port in self.ports]))
+        self.assertEqual(client.ntotal, self.index.ntotal)
+        Dref, Iref = self.index.search(self.xq, 10)
+        D, I = client.search(self.xq, 10)
+        np.testing.assert_array_equal(I, Iref)
+        np.testing.assert_allclose(D, Dref, rtol=1e-5)
+
+    def test_wire_formats(self):
+        Dref, Iref = self.shards[0].search(self.xq, 10)
+        for binary in True, False:
+            client = connect_when_ready(lambda: rpc.Client(
+                'localhost', self.ports[0], binary=binary))
+            D, I = client.search(self.xq, 10)
+            np.testing.assert_array_equal(I, Iref)
+            np.testing.assert_array_equal(D, Dref)
+            # non-array results and server-side exceptions
+            self.assertEqual(client.get_ntotal(), 2000)
+            with self.assertRaises(rpc.ServerException):
+                client.search(self.xq[:, :10], 10)
+
+    def test_batched_search(self):
+        client = connect_when_ready(lambda: client_server.ClientIndex(
+            [('localhost', port) for port in self.ports], batch_size=30))
+        Dref, Iref = self.index.search(self.xq, 10)
+        D, I = client.search(self.xq, 10)
+        np.testing.assert_array_equal(I, Iref)
+        np.testing.assert_allclose(D, Dref, rtol=1e-5)
+
+    def test_pipelined_requests(self):
+        client = connect_when_ready(
+            lambda: rpc.Client('localhost', self.ports[0]))
+        futures = [client.submit('search', self.xq[i:i + 1], 5)
+                   for i in range(len(self.xq))]
+        bad = client.submit('no_such_method')
+        Dref, Iref = self.shards[0].search(self.xq, 5)
+        for i, fut in enumerate(futures):
+            D, I = fut.result()
+            np.testing.assert_array_equal(I[0], Iref[i])
+        with self.assertRaises(rpc.ServerException):
+            bad.result()
+        client.close()
+
+    def test_asyncio(self):
+        Dref, Iref = self.index.search(self.xq, 10)
+
+        async def run():
+            client = await client_server.AsyncClientIndex.connect(
+                [('localhost', port) for port in self.async_ports])
+            self.assertEqual(client.ntotal, self.index.ntotal)
+            # concurrent searches on the same connections
+            res = await asyncio.gather(*[
+                client.search(self.xq[i0:i0 + 25], 10)
+                for i0 in range(0, len(self.xq), 25)
+            ])
+            await client.close()
+            return res
+
+        for port in self.async_ports:
+            connect_when_ready(
+                lambda: socket.create_connection(('localhost', port))).close()
+        res = asyncio.run(run())
+        for i, (D, I) in enumerate(res):
+            np.testing.assert_array_equal(I, Iref[i * 25:(i + 1) * 25])
+
+    def test_asyncio_cancel_while_sending(self):
+
+        async def run():
+            client = await rpc.AsyncClient.connect(
+                'localhost', self.async_ports[0])
+            # cancelled while its frame is sent
+            big = np.zeros(1 << 26, dtype='uint8')
+            call = asyncio.ensure_future(client.call('get_ntotal', big))
+            await asyncio.sleep(0.01)
+            call.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await call
+            # the connection is still usable
+            ntotal = await asyncio.wait_for(client.call('get_ntotal'), 10)
+            await client.close()
+            return ntotal
+
+        connect_when_ready(lambda: socket.create_connection(
+            ('localhost', self.async_ports[0]))).close()
+        self.assertEqual(asyncio.run(run()), 2000)
+
+    def test_asyncio_server_sync_client(self):
+        client = connect_when_ready(lambda: client_server.ClientIndex(
+            [('localhost', port) for port in self.async_ports]))
+        Dref, Iref = self.index.search(self.xq, 10)
+        D, I = client.search(self.xq, 10)
+        np.testing.assert_array_equal(I, Iref)
+
+
+class TestSearchBatcher(unittest.TestCase):
+
+    def test_batcher(self):
+        ds = datasets.SyntheticDataset(32, 0, 1000, 100)
+        index = faiss.IndexFlatL2(ds.d)
+        index.add(ds.get_database())
+        xq = ds.get_queries()
+        Dref, Iref = index.search(xq, 10)
+
+        batcher = client_server.SearchBatcher(
+            index, max_batch_size=1000, max_wait_ms=50)
+        results = {}
+
+        def search(i):
+            k = 5 + i % 6    # different k's in the same batch
+            results[i] = batcher.search(xq[i:i + 1], k)
+
+        threads = [threading.Thread(target=search, args=(i, ))
+                   for i in range(len(xq))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        batcher.stop()
+
+        for i in range(len(xq)):
+            D, I = results[i]
+            k = 5 + i % 6
+            np.testing.assert_array_equal(I[0], Iref[i, :k])
+            np.testing.assert_array_equal(D[0], Dref[i, :k])
+
+        stats = batcher.get_stats()
+        self.assertEqual(stats['n_requests'], len(xq))
+        self.assertEqual(stats['n_queries'], len(xq))
+        self.assertLess(stats['n_batches'], len(xq))
+        self.assertGreater(stats['max_queue_depth'], 1)
+
+    def test_server(self):
+        ds = datasets.SyntheticDataset(32, 1000, 1000, 100)
+        index = faiss.index_factory(ds.d, "IVF16,Flat")
+        index.train(ds.get_train())
+        index.add(ds.get_database())
+        xq = ds.get_queries()
+        Dref, Iref = index.search(xq, 10)
+
+        s = socket.socket()
+        s.bind(('', 0))
+        port = s.getsockname()[1]
+        s.close()
+        threading.Thread(
+            target=client_server.run_index_server, args=(index, port),
+            kwargs=dict(n_workers=16, max_batch_size=64, max_wait_ms=20),
+            daemon=True).start()
+
+        client = connect_when_ready(lambda: rpc.Client('localhost', port))
+        futures = [client.submit('search', xq[i:i + 1], 10)
+                   for i in range(len(xq))]
+        for i, fut in enumerate(futures):
+            D, I = fut.result()
+            np.testing.assert_array_equal(I[0], Iref[i])
+        stats = client.get_batcher_stats()
+        self.assertEqual(stats['n_requests'], len(xq))
+        self.assertLess(stats['n_batches'], len(xq))
+
+
+class SlowSearchServer(client_server.SearchServer):
+
+    def search(self, x, k):
+        time.sleep(0.5)
+        return client_server.SearchServer.search(self, x, k)
+
+
+class TestHedgedRequests(unittest.TestCase):
+
+    def test_slow_replica(self):
+        ds = datasets.SyntheticDataset(32, 1000, 1000, 20)
+        index = faiss.index_factory(ds.d, "IVF16,Flat")
+        index.train(ds.get_train())
+        index.add(ds.get_database())
+        xq = ds.get_queries()
+        Dref, Iref = index.search(xq, 10)
+
+        ports = []
+        for server in SlowSearchServer, client_server.SearchServer:
+            s = socket.socket()
+            s.bind(('', 0))
+            ports.append(s.getsockname()[1])
+            s.close()
+            threading.Thread(
+                target=rpc.run_server,
+                args=(lambda s, server=server: server(s, index), ports[-1]),
+                daemon=True).start()
+
+        # one sub-index with 2 replicas, the slow one is tried first
+        client = connect_when_ready(lambda: client_server.ClientIndex(
+            [[('localhost', port) for port in ports]],
+            min_hedge_delay_ms=50))
+        group = client.sub_indexes[0]
+        for _ in range(3):
+            t0 = time.time()
+            D, I = client.search(xq, 10)
+            self.assertLess(time.time() - t0, 0.4)
+            np.testing.assert_array_equal(I, Iref)
+        # the fast replica is preferred once latencies are known
+        self.assertEqual(group.replica_order()[0], 1)
+        self.assertGreaterEqual(group.n_hedges, 1)
+
+
+class TestCoarseQuantizeOnce(unittest.TestCase):
+
+    def test_pretransform_ivf(self):
+        ds = datasets.SyntheticDataset(32, 2000, 4000, 100)
+        index = faiss.index_factory(ds.d, "PCA16,IVF32,Flat")
+        index.train(ds.get_train())
+        faiss.extract_index_ivf(index).nprobe = 4
+        xb = ds.get_database()
+        ports = []
+        for i0 in 0, 2000:
+            shard = faiss.clone_index(index)
+            shard.add_with_ids(xb[i0:i0 + 2000], np.arange(i0, i0 + 2000))
+            ports.append(start_index_server(shard))
+        index.add(xb)
+        Dref, Iref = index.search(ds.get_queries(), 10)
+
+        client = connect_when_ready(lambda: client_server.ClientIndex(
+            [('localhost', port) for port in ports], batch_size=40))
+        client.enable_coarse_quantization()
+        self.assertEqual(client.nprobe, 4)
+        D, I = client.search(ds.get_queries(), 10)
+        np.testing.assert_array_equal(I, Iref)
+        np.testing.assert_allclose(D, Dref, rtol=1e-5)
+
+        client.set_nprobe(32)
+        faiss.extract_index_ivf(index).nprobe = 32
+        Dref, Iref = index.search(ds.get_queries(), 10)
+        D, I = client.search(ds.get_queries(), 10)
+        np.testing.assert_array_equal(I, Iref)
+
+    def test_route_by_lists(self):
+        # shard i holds the lists 16 * i to 16 * i + 15
+        ds = datasets.SyntheticDataset(32, 2000, 4000, 100)
+        index = faiss.index_factory(ds.d, "IVF32,Flat")
+        index.train(ds.get_train())
+        index.nprobe = 4
+        xb = ds.get_database()
+        _, assign = index.quantizer.search(xb, 1)
+        ports = []
+        for i in 0, 1:
+            ids = np.flatnonzero(assign.ravel() // 16 == i)
+            shard = faiss.clone_index(index)
+            shard.add_with_ids(xb[ids], ids)
+            ports.append(start_index_server(shard, use_asyncio=i == 1))
+        index.add(xb)
+        xq = ds.get_queries()
+        Dref, Iref = index.search(xq, 10)
+
+        client = connect_when_ready(lambda: client_server.ClientIndex(
+            [('localhost', port) for port in ports]))
+        client.enable_coarse_quantization()
+        _, Iq, Dq = client.router.quantize(xq, 4)
+        routes = client.router.route(Iq, Dq)
+        for i, (rows, Iqs, Dqs) in enumerate(routes):
+            # only the queries and probes of the lists of the shard
+            np.testing.assert_array_equal(
+                rows, np.flatnonzero((Iq // 16 == i).any(axis=1)))
+            self.assertTrue(np.all((Iqs == -1) | (Iqs // 16 == i)))
+            self.assertEqual((Iqs >= 0).sum(), (Iq // 16 == i).sum())
+        D, I = client.search(xq, 10)
+        np.testing.assert_array_equal(I, Iref)
+        np.testing.assert_allclose(D, Dref, rtol=1e-5)
+
+        async def run():
+            client = await client_server.AsyncClientIndex.connect(
+                [('localhost', port) for port in ports])
+            await client.enable_coarse_quantization()
+            res = await client.search(xq, 10)
+            await client.close()
+            return res
+
+        D, I = asyncio.run(run())
+        np.testing.assert_array_equal(I, Iref)
+
+
+@unittest.skipIf(platform.system() == 'Windows',
+                 'OnDiskInvertedLists is unsupported on Windows.')
+class TestOndiskLayout(unittest.TestCase):
+
+    def test_rewrite_layout(self):
+        ds = datasets.SyntheticDataset(32, 2000, 5000, 200)
+        index = faiss.index_factory(ds.d, "PCA16,IVF32,Flat")
+        index.train(ds.get_train())
+        index.add(ds.get_database())
+        index_ivf = faiss.extract_index_ivf(index)
+        index_ivf.nprobe = 4
+        Dref, Iref = index.search(ds.get_queries(), 10)
+
+        probed = ondisk.probed_lists_from_queries(index, ds.get_queries())
+        self.assertEqual(probed.shape, (200, 4))
+        order, n_hot = ondisk.compute_list_layout(probed, index_ivf.nlist)
+        self.assertEqual(sorted(order), list(range(index_ivf.nlist)))
+        freq = np.bincount(probed.ravel(), minlength=index_ivf.nlist)
+        self.assertGreater(n_hot, 0)
+        self.assertGreaterEqual(freq[order[:n_hot]].min(),
+                                freq[order[n_hot:]].max())
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ondisk.rewrite_ondisk_layout(
+                index, os.path.join(tmpdir, 'index.ivfdata'), probed)
+            invlists = faiss.downcast_InvertedLists(index_ivf.invlists)
+            self.assertIsInstance(invlists, faiss.OnDiskInvertedLists)
+            # the hot lists are page-aligned
+            self.assertGreaterEqual(invlists.totsize, n_hot * 4096)
+
+            D, I = index.search(ds.get_queries(), 10)
+            np.testing.assert_array_equal(I, Iref)
+            np.testing.assert_array_equal(D, Dref)
+
+            # the file being read from cannot be the destination
+            self.assertRaises(
+                AssertionError, ondisk.rewrite_ondisk_layout,
+                index, os.path.join(tmpdir, '.', 'index.ivfdata'), probed)
+            D, I = index.search(ds.get_queries(), 10)
+            np.testing.assert_array_equal(I, Iref)
+
+    def test_merge_resume(self):
+        ds = datasets.SyntheticDataset(32, 2000, 6000, 100)
+        index = faiss.index_factory(ds.d, "IVF32,Flat")
+        index.train(ds.get_train())
+        index_ivf = faiss.extract_index_ivf(index)
+        index_ivf.nprobe = 4
+        xb = ds.get_database()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            shard_fnames = []
+            for i0 in range(0, 6000, 2000):
+                shard = faiss.clone_index(index)
+                shard.add_with_ids(xb[i0:i0 + 2000],
+                                   np.arange(i0, i0 + 2000))
+                shard_fnames.append(os.path.join(tmpdir, "%d.index" % i0))
+                faiss.write_index(shard, shard_fnames[-1])
+            index_ref = faiss.clone_index(index)
+            index_ref.add(xb)
+            Dref, Iref = index_ref.search(ds.get_queries(), 10)
+
+            # crash after a few chunks
+            ivfdata_fname = os.path.join(tmpdir, "merged.ivfdata")
+            fill_lists_from = faiss.OnDiskInvertedLists.fill_lists_from
+            calls = []
+
+            def failing_fill(self, *args):
+                calls.append(args[2])
+                if len(calls) > 3:
+                    raise RuntimeError("crash")
+                return fill_lists_from(self, *args)
+
+            faiss.OnDiskInvertedLists.fill_lists_from = failing_fill
+            try:
+                self.assertRaises(
+                    RuntimeError, ondisk.merge_ondisk,
+                    faiss.clone_index(index), shard_fnames, ivfdata_fname,
+                    nthread=1, chunk_size=20000)
+            finally:
+                faiss.OnDiskInvertedLists.fill_lists_from = fill_lists_from
+            with open(ivfdata_fname + ".progress") as f:
+                # header + the 3 chunks done
+                lines = f.read().splitlines()
+                self.assertEqual(len(lines), 4)
+            # a chunk number torn by the crash does not count as done
+            not_done = min(set(range(100)) - set(map(int, lines[1:])))
+            with open(ivfdata_fname + ".progress", "a") as f:
+                f.write("%d" % not_done)
+
+            merged = faiss.clone_index(index)
+            ondisk.merge_ondisk(merged, shard_fnames, ivfdata_fname,
+                                nthread=4, chunk_size=20000, resume=True)
+            self.assertFalse(os.path.exists(ivfdata_fname + ".progress"))
+            self.assertEqual(merged.ntotal, 6000)
+            D, I = merged.search(ds.get_queries(), 10)
+            np.testing.assert_array_equal(I, Iref)
+            np.testing.assert_array_equal(D, Dref)
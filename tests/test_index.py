@@ -238,6 +238,52 @@ class EvalIVFPQAccuracy(unittest.TestCase):
 
 
 
+class TestIVFStageTimers(unittest.TestCase):
+
+    def test_stage_cycles(self):
+        d = 32
+        (xt, xb, xq) = get_dataset_2(d, 1500, 1000, 50)
+
+        index = faiss.index_factory(d, "OPQ8,IVF32,PQ8")
+        index.train(xt)
+        index.add(xb)
+        faiss.extract_index_ivf(index).nprobe = 4
+        stats = faiss.cvar.indexIVF_stats
+        stages = ['quantization_cycles', 'lut_cycles', 'scan_cycles',
+                  'heap_cycles']
+
+        # disabled by default
+        stats.reset()
+        Dref, Iref = index.search(xq, 10)
+        for stage in stages:
+            self.assertEqual(getattr(stats, stage), 0)
+
+        faiss.cvar.indexIVF_stage_timers = True
+        try:
+            stats.reset()
+            D, I = index.search(xq, 10)
+        finally:
+            faiss.cvar.indexIVF_stage_timers = False
+
+        for stage in stages:
+            self.assertGreater(getattr(stats, stage), 0)
+        self.assertEqual(stats.nq, len(xq))
+        np.testing.assert_array_equal(I, Iref)
+
+    def test_pretransform_cycles(self):
+        d = 32
+        (xt, xb, xq) = get_dataset_2(d, 1500, 1000, 50)
+
+        index = faiss.index_factory(d, "OPQ8,IVF32,PQ8")
+        index.train(xt)
+        index.add(xb)
+        stats = faiss.cvar.indexPreTransform_stats
+        stats.reset()
+        index.search(xq, 10)
+        self.assertEqual(stats.nq, len(xq))
+        self.assertGreater(stats.transform_cycles, 0)
+
+
 class TestMultiIndexQuantizer(unittest.TestCase):
 
     def test_search_k1(self):
@@ -538,6 +538,105 @@ class TestRenameOndisk(unittest.TestCase):
             shutil.rmtree(dirname)
 
 
+@unittest.skipIf(platform.system() == 'Windows',
+                 'OnDiskInvertedLists is unsupported on Windows.')
+class TestOndiskAsyncIO(unittest.TestCase):
+
+    def test_async_io(self):
+        d = 16
+        xt, xb, xq = get_dataset_2(d, 1000, 5000, 100)
+
+        index = faiss.index_factory(d, "IVF32,Flat")
+        index.train(xt)
+        index.nprobe = 8
+
+        dirname = tempfile.mkdtemp()
+        try:
+            invlists = faiss.OnDiskInvertedLists(
+                index.nlist, index.code_size, dirname + '/aa.ondisk')
+            index.replace_invlists(invlists)
+            index.add(xb[:4000])
+            Dref, Iref = index.search(xq, 10)
+
+            # a pool smaller than the lists of a batch
+            invlists.set_async_io(4, 100000)
+            D, I = index.search(xq, 10)
+            np.testing.assert_array_equal(I, Iref)
+            np.testing.assert_array_equal(D, Dref)
+            stats = invlists.io_stats
+            self.assertGreater(stats.nread + stats.nread_sync, 0)
+            self.assertGreater(stats.nevict, 0)
+            self.assertGreater(stats.bytes_read, 0)
+
+            # updates drop the buffered lists
+            index.add(xb[4000:])
+            invlists.set_async_io(0)
+            Dref, Iref = index.search(xq, 10)
+            invlists.set_async_io(2, 1 << 30)
+            for _ in range(2):
+                D, I = index.search(xq, 10)
+                np.testing.assert_array_equal(I, Iref)
+            self.assertGreater(invlists.io_stats.nhit, 0)
+            invlists.set_async_io(0)
+        finally:
+            shutil.rmtree(dirname)
+
+
+@unittest.skipIf(platform.system() == 'Windows',
+                 'OnDiskInvertedLists is unsupported on Windows.')
+class TestOndiskUpdateLog(unittest.TestCase):
+
+    def test_update_log(self):
+        d = 16
+        xt, xb, xq = get_dataset_2(d, 1000, 6000, 100)
+
+        index_ref = faiss.index_factory(d, "IVF32,Flat")
+        index_ref.train(xt)
+        index_ref.nprobe = 8
+        index = faiss.clone_index(index_ref)
+
+        dirname = tempfile.mkdtemp()
+        try:
+            invlists = faiss.OnDiskInvertedLists(
+                index.nlist, index.code_size, dirname + '/aa.ondisk')
+            index.replace_invlists(invlists)
+            index.add(xb[:4000])
+            index_ref.add(xb[:4000])
+            invlists.set_update_log(True, 0)
+
+            # appends and tombstones
+            index.add(xb[4000:])
+            index_ref.add(xb[4000:])
+            sel = faiss.IDSelectorRange(1000, 2000)
+            self.assertEqual(index.remove_ids(sel), 1000)
+            index_ref.remove_ids(sel)
+            self.assertEqual(index.ntotal, index_ref.ntotal)
+            Dref, Iref = index_ref.search(xq, 10)
+            D, I = index.search(xq, 10)
+            np.testing.assert_array_equal(I, Iref)
+            np.testing.assert_array_equal(D, Dref)
+
+            # more tombstones
+            sel = faiss.IDSelectorRange(4500, 5000)
+            self.assertEqual(index.remove_ids(sel), 500)
+            index_ref.remove_ids(sel)
+            self.assertEqual(index.ntotal, index_ref.ntotal)
+            self.assertEqual(invlists.update_stats.nremove, 1500)
+            Dref, Iref = index_ref.search(xq, 10)
+
+            invlists.compact()
+            self.assertEqual(invlists.update_stats.ncompact, 1)
+            D, I = index.search(xq, 10)
+            np.testing.assert_array_equal(I, Iref)
+            np.testing.assert_array_equal(D, Dref)
+
+            invlists.set_update_log(False)
+            D, I = index.search(xq, 10)
+            np.testing.assert_array_equal(I, Iref)
+        finally:
+            shutil.rmtree(dirname)
+
+
 class TestInvlistMeta(unittest.TestCase):
 
     def test_slice_vstack(self):
@@ -575,6 +674,55 @@ class TestInvlistMeta(unittest.TestCase):
         assert np.all(D == Dref)
         assert np.all(I == Iref)
 
+    def test_cached(self):
+        d = 10
+        xt, xb, xq = get_dataset_2(d, 200, 2000, 100)
+
+        index = faiss.index_factory(d, "IVF32,Flat")
+        index.nprobe = 4
+        index.train(xt)
+        index.add(xb)
+        Dref, Iref = index.search(xq, 10)
+
+        il0 = index.invlists
+        list_bytes = [il0.list_size(i) * (index.code_size + 8)
+                      for i in range(index.nlist)]
+        budget = sum(list_bytes) // 4
+        il = faiss.CachedInvertedLists(il0, budget)
+        index.own_invlists = False
+        index.replace_invlists(il, False)
+
+        D, I = index.search(xq, 10)
+        np.testing.assert_array_equal(I, Iref)
+        np.testing.assert_array_equal(D, Dref)
+        stats = il.stats
+        self.assertEqual(stats.nhit + stats.nmiss, 100 * 4)
+        self.assertGreater(stats.nhit, 0)
+        self.assertLessEqual(il.cache_size(), budget)
+
+        # a hot query keeps its lists against a sweep of cold queries
+        _, hot_lists = index.quantizer.search(xq[:1], index.nprobe)
+        for _ in range(20):
+            index.search(xq[:1], 10)
+        index.search(xq[1:], 10)
+        for l in hot_lists.ravel():
+            self.assertTrue(il.is_cached(int(l)))
+        self.assertGreater(il.stats.nreject, 0)
+
+        # pinned lists stay whatever the accesses
+        il.clear_cache()
+        self.assertEqual(il.cache_size(), 0)
+        cold = np.argsort(list_bytes)[:3].astype('int64')
+        il.pin_lists(3, faiss.swig_ptr(cold))
+        il.stats.reset()
+        D, I = index.search(xq, 10)
+        np.testing.assert_array_equal(I, Iref)
+        for l in cold:
+            self.assertTrue(il.is_cached(int(l)))
+        self.assertEqual(il.stats.nhit + il.stats.nmiss, 100 * 4)
+
+        index.replace_invlists(il0, True)
+
     def test_stop_words(self):
         d = 10
         nb = 1000
@@ -149,6 +149,128 @@ class TestSearchWithParameters(unittest.TestCase):
         self.assertEqual(stats2["ndis"], ref_ndis)
 
 
+class TestSearchNprobeSweep(unittest.TestCase):
+
+    def do_test(self, factory_string, metric=faiss.METRIC_L2):
+        d = 32
+        index = faiss.index_factory(d, factory_string, metric)
+
+        rs = np.random.RandomState(123)
+        xt = rs.rand(5000, d).astype('float32')
+        xb = rs.rand(10000, d).astype('float32')
+        index.train(xt)
+        index.add(xb)
+        k = 10
+        xq = rs.rand(200, d).astype('float32')
+
+        nprobes = [1, 2, 5, 5, 16, 64]
+        stats = faiss.cvar.indexIVF_stats
+        stats.reset()
+        D, I = faiss.search_nprobe_sweep(index, xq, k, nprobes)
+        self.assertEqual(D.shape, (len(nprobes), len(xq), k))
+
+        # each list is scanned once in the sweep
+        index_ivf = faiss.extract_index_ivf(index)
+        index_ivf.nprobe = nprobes[-1]
+        ndis_sweep = stats.ndis
+        stats.reset()
+        index.search(xq, k)
+        self.assertEqual(ndis_sweep, stats.ndis)
+
+        for s, nprobe in enumerate(nprobes):
+            index_ivf.nprobe = nprobe
+            Dref, Iref = index.search(xq, k)
+            np.testing.assert_array_equal(I[s], Iref)
+            np.testing.assert_array_equal(D[s], Dref)
+
+    def test_IVFFlat(self):
+        self.do_test("IVF64,Flat")
+
+    def test_IVFPQ_IP(self):
+        self.do_test("IVF64,PQ8", faiss.METRIC_INNER_PRODUCT)
+
+    def test_OPQ_IVFPQ(self):
+        self.do_test("OPQ8,IVF64,PQ8")
+
+
+class TestAdaptiveNprobe(unittest.TestCase):
+
+    def setUp(self):
+        d = 32
+        rs = np.random.RandomState(123)
+        self.index = faiss.index_factory(d, 'IVF64,Flat')
+        self.index.train(rs.rand(5000, d).astype('float32'))
+        self.index.add(rs.rand(10000, d).astype('float32'))
+        self.xq = rs.rand(300, d).astype('float32')
+        self.k = 10
+        self.params = faiss.IVFSearchParameters()
+        self.params.nprobe = 32
+        self.Dref, self.Iref, self.stats_ref = faiss.search_with_parameters(
+            self.index, self.xq, self.k, self.params, output_stats=True)
+
+    def check_adaptive(self, min_recall):
+        D, I, stats = faiss.search_with_parameters(
+            self.index, self.xq, self.k, self.params, output_stats=True)
+        self.assertLess(stats["ndis"], self.stats_ref["ndis"])
+        recall = np.mean([
+            len(np.intersect1d(I[i], self.Iref[i])) / self.k
+            for i in range(len(I))
+        ])
+        self.assertGreaterEqual(recall, min_recall)
+
+    def test_coarse_dis_ratio(self):
+        from faiss.contrib.ivf_tools import learn_coarse_dis_ratio
+        ratio = learn_coarse_dis_ratio(
+            self.index, self.xq, self.k, self.params.nprobe, quantile=1.0)
+        self.params.coarse_dis_ratio = ratio
+        self.check_adaptive(0.99)
+
+    def test_coarse_dis_ratio_disabled(self):
+        # a ratio that is never reached gives the exact results
+        self.params.coarse_dis_ratio = 1e10
+        D, I = faiss.search_with_parameters(
+            self.index, self.xq, self.k, self.params)
+        np.testing.assert_array_equal(I, self.Iref)
+        np.testing.assert_array_equal(D, self.Dref)
+
+    def test_coarse_dis_ratio_on_centroid(self):
+        # queries on their nearest centroid do not stop after one list
+        index_ivf = faiss.extract_index_ivf(self.index)
+        xq = index_ivf.quantizer.reconstruct_n(0, 30)
+        Dref, Iref = faiss.search_with_parameters(
+            self.index, xq, self.k, self.params)
+        self.params.coarse_dis_ratio = 1.5
+        D, I = faiss.search_with_parameters(
+            self.index, xq, self.k, self.params)
+        np.testing.assert_array_equal(I, Iref)
+
+    def test_stable_probes(self):
+        self.params.stable_probes = 8
+        self.check_adaptive(0.9)
+
+    def test_nprobe_skipped(self):
+        index_ivf = faiss.extract_index_ivf(self.index)
+        coarse_dis, assign = index_ivf.quantizer.search(self.xq, 32)
+        self.params.stable_probes = 8
+        D = np.empty((len(self.xq), self.k), dtype='float32')
+        I = np.empty((len(self.xq), self.k), dtype='int64')
+        stats = faiss.IndexIVFStats()
+        sp = faiss.swig_ptr
+        index_ivf.search_preassigned(
+            len(self.xq), sp(self.xq), self.k, sp(assign), sp(coarse_dis),
+            sp(D), sp(I), False, self.params, stats)
+        self.assertGreater(stats.nprobe_skipped, 0)
+        self.assertEqual(stats.nlist + stats.nprobe_skipped,
+                         len(self.xq) * 32)
+
+    def test_ratio_needs_L2(self):
+        index = faiss.index_factory(32, 'IVF64,Flat', faiss.METRIC_INNER_PRODUCT)
+        index.train(self.xq)
+        self.params.coarse_dis_ratio = 2
+        with self.assertRaises(RuntimeError):
+            faiss.search_with_parameters(index, self.xq, self.k, self.params)
+
+
 class TestSmallData(unittest.TestCase):
     """Test in case of nprobe > nlist."""
 
@@ -5,9 +5,12 @@
  * LICENSE file in the root directory of this source tree.
  */
 
+#include <algorithm>
+#include <atomic>
 #include <cstdio>
 #include <cstdlib>
 #include <random>
+#include <thread>
 
 #include <omp.h>
 #include <unistd.h>
@@ -19,6 +22,8 @@
 
 #include <faiss/IndexFlat.h>
 #include <faiss/IndexIVFFlat.h>
+#include <faiss/impl/AuxIndexStructures.h>
+#include <faiss/impl/FaissException.h>
 #include <faiss/index_io.h>
 #include <faiss/invlists/OnDiskInvertedLists.h>
 #include <faiss/utils/random.h>
@@ -205,3 +210,366 @@ TEST(ONDISK, make_invlists_threaded) {
     }
     EXPECT_EQ(ntot, nadd);
 };
+
+namespace {
+
+typedef faiss::Index::idx_t idx_t;
+
+// the code of an entry is its id, repeated
+void make_code(idx_t id, uint8_t* code, int code_size) {
+    for (int i = 0; i < code_size; i += sizeof(idx_t)) {
+        memcpy(code + i, &id, sizeof(idx_t));
+    }
+}
+
+void check_lists(
+        const faiss::InvertedLists& il,
+        const std::vector<std::vector<idx_t>>& ref) {
+    std::vector<uint8_t> code(il.code_size);
+    for (size_t l = 0; l < il.nlist; l++) {
+        ASSERT_EQ(ref[l].size(), il.list_size(l));
+        faiss::InvertedLists::ScopedIds ids(&il, l);
+        faiss::InvertedLists::ScopedCodes codes(&il, l);
+        for (size_t j = 0; j < ref[l].size(); j++) {
+            ASSERT_EQ(ref[l][j], ids[j]);
+            ASSERT_EQ(ref[l][j], il.get_single_id(l, j));
+            make_code(ref[l][j], code.data(), il.code_size);
+            ASSERT_EQ(
+                    0,
+                    memcmp(code.data(),
+                           codes.get() + j * il.code_size,
+                           il.code_size));
+        }
+    }
+}
+
+} // namespace
+
+TEST(ONDISK, update_log) {
+    int nlist = 20;
+    int code_size = 16;
+    Tempfilename filename;
+    std::string log_fname = std::string(filename.c_str()) + ".log";
+    std::vector<std::vector<idx_t>> ref(nlist);
+    std::vector<faiss::OnDiskOneList> saved_lists, old_lists;
+    size_t saved_totsize, old_totsize;
+
+    std::mt19937 rng;
+    std::vector<uint8_t> code(code_size);
+    idx_t next_id = 0;
+    auto add_some = [&](faiss::InvertedLists& il, int n) {
+        for (int i = 0; i < n; i++) {
+            int list_no = rng() % nlist;
+            make_code(next_id, code.data(), code_size);
+            il.add_entry(list_no, next_id, code.data());
+            ref[list_no].push_back(next_id++);
+        }
+    };
+    auto remove_range = [&](faiss::OnDiskInvertedLists& il,
+                            idx_t i0,
+                            idx_t i1) {
+        size_t nremove = 0;
+        for (auto& l : ref) {
+            size_t n0 = l.size();
+            l.erase(std::remove_if(
+                            l.begin(),
+                            l.end(),
+                            [&](idx_t id) { return id >= i0 && id < i1; }),
+                    l.end());
+            nremove += n0 - l.size();
+        }
+        faiss::IDSelectorRange sel(i0, i1);
+        EXPECT_EQ(nremove, il.remove_ids(sel));
+    };
+
+    {
+        faiss::OnDiskInvertedLists ivf(nlist, code_size, filename.c_str());
+        add_some(ivf, 2000);
+        ivf.set_update_log(true, 0);
+
+        // appends and tombstones
+        add_some(ivf, 500);
+        remove_range(ivf, 100, 300);
+        remove_range(ivf, 2100, 2200);
+        check_lists(ivf, ref);
+        EXPECT_EQ(500, ivf.update_stats.nadd);
+
+        // in-place updates move the list to the log
+        int list_no = 3;
+        ivf.resize(list_no, ref[list_no].size() - 2);
+        ref[list_no].resize(ref[list_no].size() - 2);
+        make_code(next_id, code.data(), code_size);
+        ivf.update_entry(list_no, 1, next_id, code.data());
+        ref[list_no][1] = next_id++;
+        check_lists(ivf, ref);
+        EXPECT_EQ(1, ivf.update_stats.nmove);
+
+        // a reader of the lists keeps them during the compaction
+        size_t totsize0 = ivf.totsize;
+        {
+            faiss::InvertedLists::ScopedIds ids0(&ivf, 0);
+            std::vector<idx_t> ref0(ids0.get(), ids0.get() + ref[0].size());
+            ivf.compact();
+            EXPECT_TRUE(std::equal(ref0.begin(), ref0.end(), ids0.get()));
+        }
+        EXPECT_EQ(1, ivf.update_stats.ncompact);
+        EXPECT_EQ(nlist, ivf.update_stats.nlist_compacted);
+        check_lists(ivf, ref);
+
+        // the second compaction reuses the space freed by the first
+        old_lists = ivf.lists;
+        old_totsize = ivf.totsize;
+        remove_range(ivf, 0, 1000);
+        add_some(ivf, 200);
+        ivf.compact();
+        EXPECT_GT(ivf.update_stats.bytes_reused, 0);
+        EXPECT_LE(ivf.totsize, 2 * totsize0);
+        check_lists(ivf, ref);
+
+        // the log is replayed on the layout of the last compaction
+        saved_lists = ivf.lists;
+        saved_totsize = ivf.totsize;
+        add_some(ivf, 100);
+        remove_range(ivf, 1500, 1600);
+    }
+
+    {
+        // the lists were not saved after the second compaction: the log
+        // switches them to its layout
+        faiss::OnDiskInvertedLists ivf(nlist, code_size, filename.c_str());
+        ivf.lists = old_lists;
+        ivf.totsize = old_totsize;
+        ivf.do_mmap();
+        ivf.set_update_log(true, 0);
+        EXPECT_EQ(saved_totsize, ivf.totsize);
+        check_lists(ivf, ref);
+    }
+
+    {
+        // lists that the log does not know about
+        faiss::OnDiskInvertedLists ivf(nlist, code_size, filename.c_str());
+        EXPECT_THROW(ivf.set_update_log(true, 0), faiss::FaissException);
+    }
+
+    {
+        faiss::OnDiskInvertedLists ivf(nlist, code_size, filename.c_str());
+        ivf.lists = saved_lists;
+        ivf.totsize = saved_totsize;
+        ivf.do_mmap();
+        ivf.set_update_log(true, 0);
+        check_lists(ivf, ref);
+
+        // background compaction with concurrent readers
+        ivf.set_update_log(true, 0.05);
+        std::thread reader([&] {
+            for (int i = 0; i < 200; i++) {
+                for (int l = 0; l < nlist; l++) {
+                    faiss::InvertedLists::ScopedIds ids(&ivf, l);
+                    faiss::InvertedLists::ScopedCodes codes(&ivf, l);
+                }
+            }
+        });
+        for (int i = 0; i < 20; i++) {
+            add_some(ivf, 100);
+        }
+        reader.join();
+        for (int i = 0; i < 100 && ivf.update_stats.ncompact == 0; i++) {
+            usleep(10000);
+        }
+        EXPECT_GT(ivf.update_stats.ncompact, 0);
+
+        ivf.set_update_log(false);
+        check_lists(ivf, ref);
+        EXPECT_NE(0, access(log_fname.c_str(), F_OK));
+    }
+    unlink(filename.c_str());
+
+    {
+        // IndexIVF::remove_ids with entries in the base and in the log
+        int d = 4;
+        faiss::IndexFlatL2 quantizer(d);
+        faiss::IndexIVFFlat index(&quantizer, d, 1);
+        std::vector<float> x(10 * d);
+        for (int i = 0; i < 10; i++) {
+            x[i * d] = i;
+        }
+        index.train(10, x.data());
+        auto il = new faiss::OnDiskInvertedLists(
+                1, index.code_size, filename.c_str());
+        index.replace_invlists(il, true);
+        index.add(4, x.data());
+        il->set_update_log(true, 0);
+        index.add(6, x.data() + 4 * d);
+
+        faiss::IDSelectorRange sel(5, 6);
+        EXPECT_EQ(1, index.remove_ids(sel));
+        EXPECT_EQ(9, index.ntotal);
+        std::vector<idx_t> remaining = {0, 1, 2, 3, 4, 6, 7, 8, 9};
+        ASSERT_EQ(9, il->list_size(0));
+        faiss::InvertedLists::ScopedIds ids(il, 0);
+        EXPECT_TRUE(std::equal(remaining.begin(), remaining.end(), ids.get()));
+        EXPECT_EQ(1, il->update_stats.nremove);
+    }
+    unlink(filename.c_str());
+    unlink(log_fname.c_str());
+}
+
+TEST(ONDISK, update_log_concurrent_remove) {
+    int nlist = 8;
+    int code_size = 16;
+    Tempfilename filename;
+    std::string log_fname = std::string(filename.c_str()) + ".log";
+    std::vector<uint8_t> code(code_size);
+    idx_t next_id = 0;
+
+    faiss::OnDiskInvertedLists ivf(nlist, code_size, filename.c_str());
+    auto add_some = [&](int n) {
+        for (int i = 0; i < n; i++) {
+            make_code(next_id, code.data(), code_size);
+            ivf.add_entry(next_id % nlist, next_id, code.data());
+            next_id++;
+        }
+    };
+    add_some(4000);
+    ivf.set_update_log(true, 0);
+
+    // readers scan as many entries as list_size returned, while the
+    // lists shrink
+    std::atomic<bool> done(false);
+    std::atomic<size_t> nmismatch(0);
+    std::vector<std::thread> readers;
+    for (int t = 0; t < 4; t++) {
+        readers.emplace_back([&] {
+            std::vector<uint8_t> ref_code(code_size);
+            while (!done) {
+                for (int l = 0; l < nlist; l++) {
+                    size_t n = ivf.list_size(l);
+                    if (n == 0) {
+                        continue;
+                    }
+                    faiss::InvertedLists::ScopedCodes codes(&ivf, l);
+                    faiss::InvertedLists::ScopedIds ids(&ivf, l);
+                    for (size_t j = 0; j < n; j++) {
+                        if (ids[j] < 0) {
+                            continue;
+                        }
+                        make_code(ids[j], ref_code.data(), code_size);
+                        if (memcmp(ref_code.data(),
+                                   codes.get() + j * code_size,
+                                   code_size)) {
+                            nmismatch++;
+                        }
+                    }
+                }
+            }
+        });
+    }
+    size_t nremove = 0;
+    for (int i = 0; i < 40; i++) {
+        faiss::IDSelectorRange sel(i * 100, i * 100 + 90);
+        nremove += ivf.remove_ids(sel);
+        add_some(50);
+        if (i % 10 == 9) {
+            ivf.compact();
+        }
+    }
+    done = true;
+    for (auto& th : readers) {
+        th.join();
+    }
+    EXPECT_EQ(40 * 90, nremove);
+    EXPECT_EQ(0, nmismatch);
+    size_t ntotal = 0;
+    for (int l = 0; l < nlist; l++) {
+        ntotal += ivf.list_size(l);
+    }
+    EXPECT_EQ(4000 + 40 * 50 - 40 * 90, ntotal);
+    ivf.set_update_log(false);
+    unlink(log_fname.c_str());
+}
+
+TEST(ONDISK, merge_then_add) {
+    int nlist = 20;
+    int code_size = 16;
+    Tempfilename filename;
+    std::vector<std::vector<idx_t>> ref(nlist);
+
+    std::mt19937 rng;
+    std::vector<uint8_t> code(code_size);
+    idx_t next_id = 0;
+    auto add_some = [&](faiss::InvertedLists& il, int n) {
+        for (int i = 0; i < n; i++) {
+            int list_no = rng() % nlist;
+            make_code(next_id, code.data(), code_size);
+            il.add_entry(list_no, next_id, code.data());
+            ref[list_no].push_back(next_id++);
+        }
+    };
+
+    faiss::ArrayInvertedLists il0(nlist, code_size), il1(nlist, code_size);
+    add_some(il0, 500);
+    add_some(il1, 500);
+    // the merged lists are in shard order
+    std::vector<std::vector<idx_t>> merged_ref(nlist);
+    for (int l = 0; l < nlist; l++) {
+        for (const faiss::InvertedLists* il : {&il0, &il1}) {
+            faiss::InvertedLists::ScopedIds ids(il, l);
+            merged_ref[l].insert(
+                    merged_ref[l].end(),
+                    ids.get(),
+                    ids.get() + il->list_size(l));
+        }
+    }
+    ref = merged_ref;
+    const faiss::InvertedLists* ils[2] = {&il0, &il1};
+
+    {
+        faiss::OnDiskInvertedLists ivf(nlist, code_size, filename.c_str());
+        ivf.merge_from(ils, 2);
+        // the lists that grow are moved to free space, not over other lists
+        add_some(ivf, 300);
+        check_lists(ivf, ref);
+    }
+
+    {
+        // resuming a merge on the complete file keeps its contents
+        ref = merged_ref;
+        faiss::OnDiskInvertedLists ivf(nlist, code_size, filename.c_str());
+        ivf.merge_from(ils, 2);
+        faiss::OnDiskInvertedLists ivf2(nlist, code_size, filename.c_str());
+        ivf2.prepare_merge(ils, 2, nullptr, 0, 4096, true);
+        check_lists(ivf2, ref);
+        add_some(ivf2, 300);
+        check_lists(ivf2, ref);
+    }
+    unlink(filename.c_str());
+}
+
+TEST(ONDISK, async_io_empty_lists) {
+    int nlist = 20;
+    int code_size = 16;
+    Tempfilename filename;
+    std::vector<std::vector<idx_t>> ref(nlist);
+
+    // only the even lists are filled
+    faiss::ArrayInvertedLists il(nlist, code_size);
+    std::vector<uint8_t> code(code_size);
+    for (idx_t id = 0; id < 500; id++) {
+        int list_no = 2 * (id % (nlist / 2));
+        make_code(id, code.data(), code_size);
+        il.add_entry(list_no, id, code.data());
+        ref[list_no].push_back(id);
+    }
+    const faiss::InvertedLists* ils[1] = {&il};
+
+    {
+        faiss::OnDiskInvertedLists ivf(nlist, code_size, filename.c_str());
+        ivf.merge_from(ils, 1);
+        ivf.set_async_io(2, 4096);
+        for (int pass = 0; pass < 2; pass++) {
+            check_lists(ivf, ref);
+        }
+        ivf.set_async_io(0);
+    }
+    unlink(filename.c_str());
+}